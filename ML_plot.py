@@ -11,7 +11,6 @@ from src.utils import utils
 from src.simulation import simulation
 from src import file_loaders
 
-from tinydb import Query
 
 from functools import partial
 from p_tqdm import p_umap, p_uimap
@@ -174,9 +173,8 @@ if __name__ == "__main__":
     with Timer() as t:
 
         db_cfg = utils.get_db_cfg()
-        q = Query()
 
-        db_counts  = np.array([db_cfg.count((q.hash == cfg.hash) & (q.network.ID == cfg.network.ID)) for cfg in cfgs_all])
+        db_counts  = np.array(db_cfg.count_cfgs(cfgs_all))
 
         assert np.max(db_counts) <= 1
 
@@ -191,7 +189,7 @@ if __name__ == "__main__":
         if num_cores == 1 :
             for cfg in tqdm(cfgs) :
                 cfg_out = simulation.run_single_simulation(cfg, save_initial_network=True, verbose=False)
-                simulation.update_database(db_cfg, q, cfg_out)
+                simulation.update_database(db_cfg, cfg_out)
 
         else :
             # First generate the networks
@@ -217,7 +215,7 @@ if __name__ == "__main__":
             print("Running simulations. Please wait")
             f_single_simulation = partial(simulation.run_single_simulation, verbose=False)
             for cfg in p_uimap(f_single_simulation, cfgs, num_cpus=num_cores) :
-                simulation.update_database(db_cfg, q, cfg)
+                simulation.update_database(db_cfg, cfg)
 
 
 print(f"\n{N_files:,} files were generated, total duration {utils.format_time(t.elapsed)}")
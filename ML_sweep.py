@@ -1,8 +1,6 @@
 import numpy as np
 import pandas as pd
 
-from tqdm import tqdm
-
 from src.utils import utils
 from src.simulation import simulation
 from src import file_loaders
@@ -66,34 +64,16 @@ for subset in [{"contact_matrices_name" : "2021_fase1"}] :
     # Load the ABM simulations
     abm_files = file_loaders.ABM_simulations(base_dir="Output/ABM", subset=subset, verbose=True)
 
-    lls_f     = []
-    lls_s     = []
-
-    for cfg in tqdm(
-        abm_files.iter_cfgs(),
-        desc="Calculating log-likelihoods",
-        total=len(abm_files.cfgs)) :
-
-        ll_f = []
-        ll_s = []
-
-        for filename in abm_files.cfg_to_filenames(cfg) :
-
-            # Load
-            I_tot_scaled, f = load_from_file(filename)
-
-            # Evaluate
-            tmp_ll_s = compute_loglikelihood(I_tot_scaled, (logK, logK_sigma, covid_index_offset), transformation_function = lambda x : np.log(x) - beta * np.log(80_000))
-            tmp_ll_f = compute_loglikelihood(f, (fraction, fraction_sigma, fraction_offset))
-
-            ll_s.append(tmp_ll_s)
-            ll_f.append(tmp_ll_f)
-
-        # Store loglikelihoods
-        lls_s.append(np.mean(ll_s))
-        lls_f.append(np.mean(ll_f))
+    # Evaluate the loglikelihoods of all the simulations at once
+    with Timer() as t_ll :
+        lls_s, lls_f = compute_cfg_loglikelihoods(
+            abm_files,
+            (logK, logK_sigma, covid_index_offset),
+            (fraction, fraction_sigma, fraction_offset),
+            beta,
+            num_cores=num_cores_max)
+    print(f"Calculated the log-likelihoods of {len(abm_files)} files in {utils.format_time(t_ll.elapsed)}")
 
-    
     cfgs = [cfg for cfg in abm_files.iter_cfgs()]
     cfg_best = cfgs[np.nanargmax(lls_s)]
     ll_best = lls_s[np.nanargmax(lls_s)]
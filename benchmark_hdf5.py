@@ -0,0 +1,115 @@
+import sys
+import os
+import time
+import numpy as np
+import h5py
+
+from src.utils import utils
+
+# Benchmark of the hdf5 layout of the simulation results (see Simulation._save_simulation_results) :
+# write time, read time (everything and a single day of my_state) and file size,
+# for plain datasets and for chunked and compressed datasets (utils.create_compressed_dataset).
+#
+#   python benchmark_hdf5.py                  (synthetic run with N_tot agents)
+#   python benchmark_hdf5.py network_file.hdf5  (the datasets of an actual run)
+
+N_tot = 580_000
+day_max = 100
+N_repeats = 3
+filename_tmp = "Output/benchmark_hdf5.hdf5"
+
+
+def synthetic_results(N_tot=580_000, day_max=100, f_infected=0.1, seed=0) :
+    """ Datasets of the same shape and type as the results of a simulation :
+        every agent is susceptible (-1) until it is infected, then goes through the 8 E and I states (8 = recovered)
+    """
+    rng = np.random.default_rng(seed)
+    day_infected = np.where(rng.random(N_tot) < f_infected, rng.integers(0, day_max, N_tot), day_max + 1).astype(np.int16)
+    days = np.arange(day_max + 1, dtype=np.int16)[:, np.newaxis]
+    my_state = np.where(days >= day_infected, np.minimum((days - day_infected) // 2, 8), -1).astype(np.int8)
+
+    N_rows = 10 * day_max
+    df = np.zeros(N_rows, dtype=[("time", "<f8")] + [(f"col_{i}", "<u4") for i in range(30)])
+    df["time"] = np.linspace(0, day_max, N_rows)
+    for i in range(30) :
+        df[f"col_{i}"] = np.cumsum(rng.integers(0, 10, N_rows))
+
+    return {
+        "my_state" : my_state,
+        "my_corona_type" : rng.integers(0, 2, N_tot).astype(np.uint8),
+        "my_number_of_contacts" : rng.poisson(40, N_tot).astype(np.uint16),
+        "day_found_infected" : np.where(day_infected <= day_max, day_infected, -1).astype(np.int32),
+        "coordinates" : rng.uniform([8, 54.5], [15, 57.8], size=(N_tot, 2)).astype(np.float32),
+        "df" : df,
+    }
+
+
+def load_results(filename) :
+    names = ["my_state", "my_corona_type", "my_number_of_contacts", "day_found_infected", "coordinates", "df"]
+    with h5py.File(filename, "r") as f :
+        return {name : f[name][()] for name in names if name in f}
+
+
+def write(filename, results, compressed) :
+    with h5py.File(filename, "w") as f :
+        for name, data in results.items() :
+            if not compressed :
+                f.create_dataset(name, data=data)
+            elif name == "my_state" :
+                utils.create_compressed_dataset(f, name, data, chunks=(1, data.shape[1]))
+            else :
+                utils.create_compressed_dataset(f, name, data)
+
+
+def read(filename) :
+    with h5py.File(filename, "r") as f :
+        return {name : f[name][()] for name in f}
+
+
+def read_days(filename, days) :
+    with h5py.File(filename, "r") as f :
+        return [f["my_state"][day] for day in days]
+
+
+def benchmark_hdf5(results, N_repeats=3, filename=filename_tmp) :
+    utils.make_sure_folder_exist(filename)
+    days = np.random.default_rng(0).integers(0, len(results["my_state"]), 10)
+
+    size_raw = sum(data.nbytes for data in results.values())
+    print(f"{size_raw / 1e6:.1f} MB of data, my_state has shape {results['my_state'].shape}")
+    print(f"{'layout':>12} {'write':>10} {'read all':>10} {'read day':>10} {'size':>10} {'ratio':>7}")
+
+    for compressed in [False, True] :
+        time_write = time_read = time_day = np.inf
+        for _ in range(N_repeats) :
+            t = time.time()
+            write(filename, results, compressed)
+            time_write = min(time_write, time.time() - t)
+
+            t = time.time()
+            read(filename)
+            time_read = min(time_read, time.time() - t)
+
+            t = time.time()
+            read_days(filename, days)
+            time_day = min(time_day, (time.time() - t) / len(days))
+
+        size = os.path.getsize(filename)
+        layout = "compressed" if compressed else "plain"
+        print(
+            f"{layout:>12} {time_write:>9.3f}s {time_read:>9.3f}s {time_day * 1e3:>8.2f}ms "
+            f"{size / 1e6:>8.1f}MB {size_raw / size:>6.1f}x",
+            flush=True,
+        )
+
+    utils.delete_file(filename)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 :
+        results = load_results(sys.argv[1])
+    else :
+        results = synthetic_results(N_tot, day_max)
+
+    benchmark_hdf5(results, N_repeats)
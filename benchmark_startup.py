@@ -0,0 +1,56 @@
+import sys
+import subprocess
+
+# Startup benchmark : the time it takes to import the simulation in a fresh python process.
+#
+#   python benchmark_startup.py
+#
+# The import of src.simulation.simulation is profiled with python -X importtime, which lists
+# the modules that take the longest to import (heavy dependencies which are only used by some functions
+# should be imported with utils.lazy_import or inside the functions, not at the top of the modules).
+# The compilation of the numba code is not included, it happens at the first simulation of every process
+# (for sweeps once per worker, see simulation.warm_up).
+
+# Target for the time to import the simulation in a new process (excluding the compilation of the numba code)
+import_module = "src.simulation.simulation"
+import_time_target = 2.0  # seconds
+N_top_imports = 15
+
+
+def profile_import_time(module=import_module) :
+    """ Imports module in a fresh process with python -X importtime.
+        Returns the total import time (in seconds) and a list of (cumulative time, module name)
+        of all the imported modules.
+    """
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    imports = []
+    for line in out.stderr.splitlines() :
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line :
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        imports.append((int(cumulative) / 1e6, name.rstrip()))
+
+    # the top-level modules are the ones that are not indented
+    total = sum(time for time, name in imports if not name.startswith("  "))
+    return total, imports
+
+
+def print_import_time_profile(module=import_module, N_top=15, target=None) :
+    total, imports = profile_import_time(module)
+    print(f"Importing {module} took {total:.2f} s. Slowest imports (cumulative) :")
+    for time_import, name in sorted(imports, reverse=True)[:N_top] :
+        print(f"{time_import:>9.3f}s {name}")
+    if target is not None :
+        status = "OK" if total <= target else "ABOVE TARGET"
+        print(f"Target : {target:.2f} s, {status}", flush=True)
+    return total
+
+
+if __name__ == "__main__":
+    print_import_time_profile(import_module, N_top_imports, import_time_target)
@@ -0,0 +1,15 @@
+from src import ensemble_store
+from src import file_loaders
+
+# Collect the per-run result files (Output/ABM and Output/network) into one ensemble store per hash
+# (Output/ensembles), e.g. for simulations from before the ensemble stores existed.
+# New simulations are added to the ensemble stores when they are added to the database.
+# The per-run files are deleted once they are in the ensemble store, set delete_run_files = False to keep them.
+# The results catalog of Output/db.sqlite is rebuilt afterwards, such that it lists the replicates in the stores.
+
+delete_run_files = True
+
+if __name__ == "__main__":
+    N_added = ensemble_store.consolidate_ensembles(base_dir="Output", delete_run_files=delete_run_files)
+    print(f"Added {N_added} simulations to the ensemble stores")
+    file_loaders.rebuild_catalog(base_dir="Output")
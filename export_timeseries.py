@@ -0,0 +1,13 @@
+from src import timeseries_store
+
+# Export the time series of the ensemble stores (Output/ensembles, see consolidate_ensembles.py)
+# as one Parquet file per hash (Output/timeseries, see timeseries_store), which can then be read
+# for many simulations at once, e.g.
+#
+#   df = timeseries_store.load_timeseries(columns=["time", "I"], filters={"time" : (0, 100)})
+#
+# Single simulations are saved as Parquet when run with save_parquet=True.
+
+if __name__ == "__main__":
+    N_exported = timeseries_store.export_ensembles()
+    print(f"Exported the time series of {N_exported} simulations")
@@ -17,6 +17,7 @@ from src import rc_params
 from src.utils import utils
 from src import animation_utils
 from src import file_loaders
+from src import ensemble_store
 
 rc_params.set_rc_params(dpi=50)  #
 num_cores_max = 40
@@ -91,9 +92,6 @@ def convert_df_byte_cols(df):
     return df
 
 
-from pathos.helpers import cpu_count
-from pathos.multiprocessing import ProcessPool as Pool
-
 # from pathos.threading import ThreadPool as Pool
 from collections.abc import Sized
 
@@ -132,7 +130,8 @@ class AnimationBase:
 
     def _load_data(self):
 
-        with h5py.File(self.filename, "r") as f:
+        # a network file or a replicate of an ensemble store
+        with ensemble_store.open_result(self.filename) as f:
 
             if self.verbose:
                 print("Loading hdf5-file")
@@ -1076,6 +1075,19 @@ def compute_daily_kommune_fraction_recovered(df_kommuner, df_coordinates, my_sta
     return df_kommuner
 
 
+def compute_daily_kommune_fraction_recovered_from_counts(df_kommuner, daily_counts, i_day):
+    """ Same as compute_daily_kommune_fraction_recovered, but from the daily counts saved
+        by the simulation (file_loaders.load_daily_counts) instead of the state of every agent
+    """
+    fracs_all = file_loaders.daily_counts_to_fractions(daily_counts[i_day : i_day + 1], states=[8])[0]
+    shapefile_kommune = df_kommuner["idx"].values
+    fracs = np.full(len(shapefile_kommune), np.nan)
+    mask = shapefile_kommune < len(fracs_all)
+    fracs[mask] = fracs_all[shapefile_kommune[mask]]
+    df_kommuner["frac_R"] = fracs
+    return df_kommuner
+
+
 #%%
 
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -15,6 +15,9 @@ N_tot_max = False
 dry_run = False
 force_rerun = False
 
+# Only add the jobs to the queue and collect the results, the jobs are run by sweep_worker.py (on any node)
+distributed = False
+
 start_date = datetime(2020, 12, 28)
 end_date   = datetime(2021, 4, 1)
 
@@ -98,16 +101,27 @@ if __name__ == "__main__":
 
         for d_simulation_parameters in all_simulation_parameters:
             # break
-            N_files = simulation.run_simulations(
-                d_simulation_parameters,
-                N_runs=N_runs,
-                num_cores_max=num_cores_max,
-                N_tot_max=N_tot_max,
-                verbose=verbose,
-                force_rerun=force_rerun,
-                dry_run=dry_run,
-                save_csv=True,
-            )
+            if distributed and not dry_run:
+                N_files = simulation.coordinate_simulations(
+                    d_simulation_parameters,
+                    N_runs=N_runs,
+                    N_tot_max=N_tot_max,
+                    force_rerun=force_rerun,
+                    verbose=verbose,
+                    save_csv=True,
+                )
+
+            else:
+                N_files = simulation.run_simulations(
+                    d_simulation_parameters,
+                    N_runs=N_runs,
+                    num_cores_max=num_cores_max,
+                    N_tot_max=N_tot_max,
+                    verbose=verbose,
+                    force_rerun=force_rerun,
+                    dry_run=dry_run,
+                    save_csv=True,
+                )
 
         N_files_total += N_files
 
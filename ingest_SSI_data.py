@@ -0,0 +1,10 @@
+from src import file_loaders
+
+# Download the newest SSI kommune data once (needs internet) and store it as a
+# local snapshot in Data/SSI_snapshots, which is what the simulations read
+# when using make_initial_infections_at_kommune.
+
+if __name__ == "__main__":
+    filename = file_loaders.ingest_SSI_data()
+    print(f"Saved SSI snapshot to {filename}")
+    print(f"Local snapshots: {file_loaders.get_SSI_snapshot_dates()}")
@@ -0,0 +1,8 @@
+from src.utils import utils
+
+# Copy the cfgs from the old TinyDB database (Output/db.json)
+# into the SQLite database (Output/db.sqlite) used by utils.get_db_cfg.
+# Cfgs that are already in the SQLite database are skipped.
+
+if __name__ == "__main__":
+    utils.migrate_db_json_to_sqlite(json_path="Output/db.json", sqlite_path="Output/db.sqlite")
@@ -0,0 +1,20 @@
+from src import file_loaders
+from src.utils import utils
+from contexttimer import Timer
+
+# Rebuild the catalog of the result files (the results table of Output/db.sqlite, see file_loaders.rebuild_catalog)
+# from all the files in Output/ABM and Output/network, e.g. for simulations from before the catalog existed
+# or after files have been moved or deleted. New simulations are added to the catalog when they are added to the database.
+# With insert_cfgs = True the cfgs of the files are added to the database as well (if they are not already in it).
+
+insert_cfgs = True
+
+if __name__ == "__main__":
+    with Timer() as t :
+        N_files = file_loaders.rebuild_catalog(base_dir="Output", insert_cfgs=insert_cfgs)
+    print(f"Cataloged {N_files} files in {utils.format_time(t.elapsed)}")
+
+    with Timer() as t :
+        abm_files = file_loaders.ABM_simulations()
+    print(abm_files)
+    print(f"Loaded from the catalog in {utils.format_time(t.elapsed)}")
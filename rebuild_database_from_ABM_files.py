@@ -1,18 +0,0 @@
-import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-from tqdm import tqdm
-from pathlib import Path
-from importlib import reload
-from src.utils import utils
-from src import file_loaders
-
-#%%
-
-# reload(file_loaders)
-
-# abm_files = file_loaders.ABM_simulations(verbose=True)
-# N_files = len(abm_files)
-
-
-ABM_files = file_loaders.get_all_ABM_filenames()
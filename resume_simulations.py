@@ -0,0 +1,22 @@
+from src.utils import utils
+from src.simulation import simulation
+from contexttimer import Timer
+
+# Continue a sweep (started with generate_simulations.py) which was interrupted,
+# from the job queue in Output/queue. The jobs are run with the arguments saved in them
+# (e.g. output_level), the ones given here only apply where a job does not set them.
+
+num_cores_max = 20
+verbose = False
+
+if __name__ == "__main__":
+    with Timer() as t:
+        counts = simulation.resume_simulations(
+            queue_dir="Output/queue",
+            num_cores_max=num_cores_max,
+            verbose=verbose,
+            save_csv=True,
+        )
+
+    print(f"\nQueue : {counts}, total duration {utils.format_time(t.elapsed)}")
+    print("Finished simulating!")
@@ -0,0 +1,60 @@
+from src.utils import utils
+from src.analysis import parameter_search
+from contexttimer import Timer
+
+# Adaptive search for the most likely parameters (see parameter_search.CrossEntropySearch),
+# instead of a wide sweep, a likelihood ranking and a narrower sweep by hand (as in forecaster.py).
+
+params, start_date = utils.load_params("cfg/simulation_parameters_debugging.yaml")
+
+if utils.is_local_computer():
+    f = 0.1
+    num_cores_max = 3
+    N_per_round = 10
+else :
+    f = 0.2
+    num_cores_max = 15
+    N_per_round = 30
+
+# Scale the population
+params["N_tot"]  = int(params["N_tot"]  * f)
+params["N_init"] = int(params["N_init"] * f)
+params["R_init"] = int(params["R_init"] * f)
+
+search_space = {
+    "beta" :               (0.0095, 0.0115),
+    "beta_UK_multiplier" : (1.2, 1.8),
+    "N_init" :             (int(20_000 * f), int(60_000 * f)),
+    "N_init_UK_frac" :     (0.005, 0.03),
+}
+
+N_runs = 1
+max_rounds = 8
+max_cpu_hours = None
+verbose = True
+
+
+if __name__ == "__main__":
+    with Timer() as t:
+
+        search = parameter_search.CrossEntropySearch(
+            params,
+            search_space,
+            parameter_search.load_fit_data(start_date),
+            N_per_round=N_per_round,
+            N_runs=N_runs,
+            max_rounds=max_rounds,
+            max_cpu_hours=max_cpu_hours,
+            num_cores_max=num_cores_max,
+            verbose=verbose,
+        )
+        best = search.run()
+
+    print(f"\n{search.N_simulations:,} simulations, total duration {utils.format_time(t.elapsed)}")
+    print("--- Best parameters ---")
+    if best is None :
+        print("No simulations could be evaluated")
+    else :
+        print(f"Weighted loglikelihood : {best['loglikelihood']:.3f}")
+        for name in search_space :
+            print(f"{name} : {best[name]}")
@@ -3,11 +3,13 @@ import numpy as np
 import pandas as pd
 
 import datetime
+import os
 
 from scipy.stats import norm
 
 from src.utils import utils
 from src import file_loaders
+from src import ensemble_store
 
 
 def aggregate_array(arr, chunk_size=10) :
@@ -24,6 +26,24 @@ def load_from_file(filename) :
     # Load the csv summery file
     df = file_loaders.pandas_load_file(filename)
 
+    return df_to_infected_and_fraction(df, cfg)
+
+
+def load_ensemble(hash_) :
+    """ Same as load_from_file for all the simulations of hash_, from its ensemble store (see ensemble_store).
+        Returns the stacked arrays (one row per simulation, padded with nan) and the network IDs
+    """
+    cfg = utils.read_cfg_from_hdf5_file(ensemble_store.ensemble_filename(hash_))
+    dfs = file_loaders.pandas_load_ensemble(hash_)
+
+    I_tot_scaled, f = zip(*[df_to_infected_and_fraction(df, cfg) for df in dfs])
+    IDs = ensemble_store.get_replicate_IDs(hash_)
+
+    return ensemble_store.stack_replicates(I_tot_scaled), ensemble_store.stack_replicates(f), IDs
+
+
+def df_to_infected_and_fraction(df, cfg) :
+
     # Extract the values
     I_tot    = df["I"].to_numpy()
     I_uk     = df["I^V_1"].to_numpy()
@@ -66,6 +86,150 @@ def compute_loglikelihood(arr, data, transformation_function = lambda x : x) :
         return np.nan
 
 
+#%%
+
+# Vectorized evaluation of the log-likelihoods of many simulations (e.g. all the files of a sweep) :
+# only the I and I^V_1 columns are read from the files (in parallel, and cached on the modification time of the file),
+# stacked into 2D arrays (one row per simulation) and aggregated and evaluated for all the simulations at once.
+# Gives the same results as load_from_file and compute_loglikelihood for each file, including the truncation
+# of the daily and weekly means to integers (aggregate_array writes them into the integer arrays of the counts).
+
+_infected_columns_cache = {}
+
+
+def load_infected_columns(filename) :
+    """ The number of infected (I1 + ... + I4) and of infected with B.1.1.7 (I^V_1) of an ABM file (or a replicate of an
+        ensemble store), with duplicate times removed (as file_loaders.format_df), without building a DataFrame
+    """
+    with ensemble_store.open_result(filename) as f :
+        names = f["df"].dtype.names
+        col_time = "Time" if "Time" in names else "time"
+        cols_I = [col for col in names if "I" in col and len(col) == 2]
+        data = f["df"].fields([col_time, *cols_I, "I^V_1"])[()]
+
+    time = data[col_time]
+    keep = np.ones(len(time), dtype=bool)
+    keep[1:] = time[1:] != time[:-1]
+
+    I = sum(data[col].astype(np.float64) for col in cols_I)[keep]
+    I_uk = data["I^V_1"].astype(np.float64)[keep]
+    return filename, I, I_uk
+
+
+def load_infected_columns_multiple(filenames, num_cores=1) :
+    " load_infected_columns for all the filenames (in parallel), files which have not changed since the last call are not read again "
+    mtimes = {filename : os.path.getmtime(ensemble_store.split_replicate_path(filename)[0]) for filename in filenames}
+    filenames_to_load = [filename for filename in mtimes if _infected_columns_cache.get(filename, (None,))[0] != mtimes[filename]]
+
+    if num_cores > 1 and len(filenames_to_load) > 1 :
+        from p_tqdm import p_umap
+        results = p_umap(load_infected_columns, filenames_to_load, num_cpus=num_cores, disable=True)
+    else :
+        results = map(load_infected_columns, filenames_to_load)
+
+    for filename, I, I_uk in results :
+        _infected_columns_cache[filename] = (mtimes[filename], I, I_uk)
+
+    return [_infected_columns_cache[filename][1] for filename in filenames], [_infected_columns_cache[filename][2] for filename in filenames]
+
+
+def _chunk_mean(arr, chunk_size) :
+    " Means of consecutive chunks of chunk_size columns of the 2D array arr (an incomplete last chunk is dropped) "
+    N_chunks = arr.shape[1] // chunk_size
+    return arr[:, : N_chunks * chunk_size].reshape(len(arr), N_chunks, chunk_size).mean(axis=2)
+
+
+def stacked_infected_and_fraction(I, I_uk, N_tot) :
+    """ Same as df_to_infected_and_fraction for many simulations at once.
+        Parameters :
+            I, I_uk (lists of arrays) : see load_infected_columns
+            N_tot (array) : the number of agents of each simulation
+        Returns the 2D arrays I_tot_scaled and f (one row per simulation, padded with nan)
+    """
+    N_weeks = np.array([len(arr) // 10 // 7 for arr in I])
+    I = ensemble_store.stack_replicates(I)
+    I_uk = ensemble_store.stack_replicates(I_uk)
+
+    # Get daily averages (a day with missing values is nan), truncated as in aggregate_array
+    I_tot = np.floor(_chunk_mean(I, 10))
+    I_uk = np.floor(_chunk_mean(I_uk, 10))
+
+    # Scale the number of infected
+    I_tot_scaled = I_tot / 2.7 * (5_800_000 / np.asarray(N_tot, dtype=np.float64)[:, np.newaxis])
+
+    # Get weekly values
+    I_tot_week = np.floor(_chunk_mean(I_tot, 7))
+    I_uk_week = np.floor(_chunk_mean(I_uk, 7))
+
+    # Get the fraction of UK variants
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = I_uk_week / I_tot_week
+    f[np.isnan(f) & (np.arange(f.shape[1]) < N_weeks[:, np.newaxis])] = -1
+
+    return I_tot_scaled, f
+
+
+def compute_loglikelihood_stacked(arr, data, transformation_function = lambda x : x) :
+    " Same as compute_loglikelihood for each row of the 2D array arr "
+
+    data_values, data_sigma, data_offset = data
+    data_values = np.asarray(data_values, dtype=np.float64)
+    data_sigma = np.asarray(data_sigma, dtype=np.float64)
+
+    if arr.shape[1] < len(data_values) + data_offset :
+        return np.full(len(arr), np.nan)
+
+    arr_model = arr[:, data_offset:data_offset+len(data_values)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_prop = norm.logpdf(transformation_function(arr_model), loc=data_values, scale=data_sigma)
+
+    # simulations which are too short have nan in the range
+    return np.sum(log_prop, axis=1) / len(data_values)
+
+
+def compute_loglikelihoods(filenames, N_tot, covid_index_data, fraction_data, beta, num_cores=1) :
+    """ The log-likelihoods of the covid index and of the B.1.1.7 fraction of each of the files
+        (as in ML_sweep.py), evaluated for all the files at once.
+        Parameters :
+            N_tot (array) : the number of agents of the simulation of each file
+            covid_index_data, fraction_data : see load_covid_index and load_b117_fraction, as (values, sigma, offset)
+            beta : the scaling of the covid index, see load_covid_index
+    """
+    if len(filenames) == 0 :
+        return np.array([]), np.array([])
+
+    I, I_uk = load_infected_columns_multiple(filenames, num_cores)
+    I_tot_scaled, f = stacked_infected_and_fraction(I, I_uk, N_tot)
+
+    with np.errstate(divide='ignore'):
+        ll_s = compute_loglikelihood_stacked(I_tot_scaled, covid_index_data, transformation_function = lambda x : np.log(x) - beta * np.log(80_000))
+    ll_f = compute_loglikelihood_stacked(f, fraction_data)
+    return ll_s, ll_f
+
+
+def compute_cfg_loglikelihoods(abm_files, covid_index_data, fraction_data, beta, num_cores=1) :
+    """ The log-likelihoods (averaged over the files) of each of the cfgs of abm_files (file_loaders.ABM_simulations),
+        in the order of abm_files.cfgs. Returns the arrays lls_s (covid index) and lls_f (B.1.1.7 fraction).
+    """
+    cfgs = list(abm_files.iter_cfgs())
+    filenames_per_cfg = [abm_files.d.get(cfg.hash, []) for cfg in cfgs]
+    filenames = [filename for filenames_cfg in filenames_per_cfg for filename in filenames_cfg]
+    N_tot = [cfg.network.N_tot for cfg, filenames_cfg in zip(cfgs, filenames_per_cfg) for _ in filenames_cfg]
+
+    ll_s, ll_f = compute_loglikelihoods(filenames, N_tot, covid_index_data, fraction_data, beta, num_cores)
+
+    lls_s = np.full(len(cfgs), np.nan)
+    lls_f = np.full(len(cfgs), np.nan)
+    i_start = 0
+    for i, filenames_cfg in enumerate(filenames_per_cfg) :
+        i_stop = i_start + len(filenames_cfg)
+        if i_stop > i_start :
+            lls_s[i] = np.mean(ll_s[i_start:i_stop])
+            lls_f[i] = np.mean(ll_f[i_start:i_stop])
+        i_start = i_stop
+    return lls_s, lls_f
+
+
 def load_covid_index(start_date) :
 
     # Load the covid index data
@@ -0,0 +1,215 @@
+import numpy as np
+import datetime
+
+import numba as nb
+
+from src.utils import utils
+from src.simulation import simulation
+from src.simulation import cost_model
+from src.analysis import helpers
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # Likelihood  # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def load_fit_data(start_date) :
+    " The data the simulations are compared to : the covid index and the fraction of B.1.1.7 "
+    if isinstance(start_date, datetime.datetime) :
+        start_date = start_date.date()
+    logK, logK_sigma, beta, covid_index_offset, _ = helpers.load_covid_index(start_date)
+    fraction, fraction_sigma, fraction_offset, _ = helpers.load_b117_fraction()
+    return {
+        "covid_index" : (logK, logK_sigma, covid_index_offset),
+        "beta" : beta,
+        "fraction" : (fraction, fraction_sigma, fraction_offset),
+    }
+
+
+def compute_cfg_loglikelihood(cfg, data, base_dir="Output/ABM") :
+    """ Log-likelihood of the simulations of cfg (averaged over the network IDs),
+        the sum of the log-likelihoods of the covid index and the B.1.1.7 fraction (as in ML_sweep.py).
+        Returns nan if there are no simulations of cfg.
+    """
+    filenames = utils.hash_to_filenames(cfg.hash, base_dir)
+    if len(filenames) == 0 :
+        return np.nan
+
+    N_tot = [cfg.network.N_tot] * len(filenames)
+    ll_s, ll_f = helpers.compute_loglikelihoods(filenames, N_tot, data["covid_index"], data["fraction"], data["beta"])
+    return np.mean(ll_s) + np.mean(ll_f)
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # Search  # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class CrossEntropySearch :
+    """
+    Adaptive search for the parameters with the highest likelihood, instead of a full Cartesian sweep.
+
+    The search runs in rounds. The first round samples the search space uniformly (the wide sweep),
+    the following rounds sample a normal distribution (independent for each parameter), which after
+    every round is moved towards the elite, the elite_fraction of the simulations with the highest likelihood
+    (the cross-entropy method). The simulations are run by simulation.run_simulations, so simulations
+    which are already in the database are not run again.
+
+    The search stops after max_rounds, when the standard deviation of every parameter is less than
+    tolerance times the width of its search space, or when the next round would exceed the budget
+    (max_simulations or the estimated max_cpu_hours, see cost_model).
+
+    - params : the parameters of the simulations (e.g. from utils.load_params), the searched parameters are overwritten
+    - search_space : {name : (low, high)} of the parameters to search
+    - data : the data to compare to, see load_fit_data
+    - N_per_round : number of parameter sets simulated in each round
+    - N_runs : number of simulations (network IDs) of each parameter set
+    - smoothing : weight of the elite in the update of the distribution (1 : only use the elite)
+    """
+
+    def __init__(
+            self,
+            params,
+            search_space,
+            data,
+            N_per_round=20,
+            N_runs=1,
+            elite_fraction=0.2,
+            smoothing=0.7,
+            max_rounds=10,
+            max_simulations=None,
+            max_cpu_hours=None,
+            tolerance=0.02,
+            seed=0,
+            num_cores_max=None,
+            verbose=False,
+            **kwargs) :
+
+        self.params = dict(params)
+        self.names = list(search_space.keys())
+        self.low = np.array([search_space[name][0] for name in self.names], dtype=float)
+        self.high = np.array([search_space[name][1] for name in self.names], dtype=float)
+        self.data = data
+        self.N_per_round = N_per_round
+        self.N_runs = N_runs
+        self.N_elite = max(int(np.ceil(elite_fraction * N_per_round)), 2)
+        self.smoothing = smoothing
+        self.max_rounds = max_rounds
+        self.max_simulations = max_simulations
+        self.max_cpu_hours = max_cpu_hours
+        self.tolerance = tolerance
+        self.rng = np.random.default_rng(seed)
+        self.num_cores_max = num_cores_max
+        self.verbose = verbose
+        self.kwargs = kwargs  # passed on to simulation.run_simulations
+
+        self.mean = None
+        self.std = None
+        self.history = []
+        self.N_simulations = 0
+        self.cpu_hours = 0.0
+
+    def _round(self, name, val) :
+        " Integer parameters are rounded to integers, the rest to 5 decimals (as in the sweeps) "
+        if isinstance(utils.spec[name], nb.types.Integer) :
+            return int(np.round(val))
+        return float(np.round(val, 5))
+
+    def propose(self) :
+        " The parameter sets of the next round "
+        if self.mean is None :
+            x = self.rng.uniform(self.low, self.high, size=(self.N_per_round, len(self.names)))
+        else :
+            x = self.rng.normal(self.mean, self.std, size=(self.N_per_round, len(self.names)))
+            x = np.clip(x, self.low, self.high)
+        return [{name : self._round(name, val) for name, val in zip(self.names, row)} for row in x]
+
+    def point_to_cfgs(self, point) :
+        " The cfgs (one for each network ID) of a parameter set "
+        d_simulation_parameters = {**self.params, **point}
+        return utils.generate_cfgs(d_simulation_parameters, N_runs=self.N_runs)
+
+    def update(self, points, lls) :
+        " Move the distribution towards the elite of the round "
+        x = np.array([[point[name] for name in self.names] for point in points], dtype=float)
+        lls = np.where(np.isnan(lls), -np.inf, lls)
+        elite = x[np.argsort(lls)[::-1][: self.N_elite]]
+
+        mean_elite = np.mean(elite, axis=0)
+        std_elite = np.std(elite, axis=0, ddof=1)
+
+        if self.mean is None :
+            self.mean, self.std = mean_elite, std_elite
+        else :
+            self.mean = self.smoothing * mean_elite + (1 - self.smoothing) * self.mean
+            self.std = self.smoothing * std_elite + (1 - self.smoothing) * self.std
+
+    def is_converged(self) :
+        if self.std is None :
+            return False
+        return bool(np.all(self.std <= self.tolerance * (self.high - self.low)))
+
+    def _exceeds_budget(self, cfgs, model) :
+        if self.max_simulations is not None and self.N_simulations + len(cfgs) > self.max_simulations :
+            return True
+        if self.max_cpu_hours is not None :
+            _, total = model.estimate(cfgs)
+            if self.cpu_hours + total["cpu_hours"] > self.max_cpu_hours :
+                return True
+            self.cpu_hours += total["cpu_hours"]
+        return False
+
+    def run(self) :
+        " Run the search, returns the best parameter set found (see best) "
+        model = cost_model.CostModel.from_past_results() if self.max_cpu_hours is not None else None
+
+        for i_round in range(self.max_rounds) :
+
+            points = self.propose()
+            cfgs_per_point = [self.point_to_cfgs(point) for point in points]
+            cfgs = [cfg for cfgs_point in cfgs_per_point for cfg in cfgs_point]
+
+            if self._exceeds_budget(cfgs, model) :
+                if self.verbose :
+                    print(f"Stopping before round {i_round}, the budget would be exceeded", flush=True)
+                break
+
+            simulation.run_simulations(cfgs, num_cores_max=self.num_cores_max, verbose=self.verbose, **self.kwargs)
+            self.N_simulations += len(cfgs)
+
+            lls = np.array([compute_cfg_loglikelihood(cfgs_point[0], self.data) for cfgs_point in cfgs_per_point])
+            for point, cfgs_point, ll in zip(points, cfgs_per_point, lls) :
+                self.history.append({"round" : i_round, **point, "hash" : cfgs_point[0].hash, "loglikelihood" : ll})
+
+            self.update(points, lls)
+
+            if self.verbose :
+                print(f"Round {i_round} : {self}", flush=True)
+
+            if self.is_converged() :
+                if self.verbose :
+                    print(f"Converged after round {i_round}", flush=True)
+                break
+
+        return self.best()
+
+    def best(self) :
+        " The parameter set (and hash and log-likelihood) with the highest likelihood so far "
+        history = [h for h in self.history if not np.isnan(h["loglikelihood"])]
+        if len(history) == 0 :
+            return None
+        return max(history, key=lambda h : h["loglikelihood"])
+
+    def __repr__(self) :
+        if self.mean is None :
+            s_distribution = "uniform"
+        else :
+            s_distribution = ", ".join(f"{name} = {m:.4g} ± {s:.2g}" for name, m, s in zip(self.names, self.mean, self.std))
+        best = self.best()
+        s_best = f", best loglikelihood {best['loglikelihood']:.3f}" if best is not None else ""
+        return f"CrossEntropySearch({s_distribution}) after {self.N_simulations} simulations{s_best}"
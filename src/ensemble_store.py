@@ -0,0 +1,248 @@
+import numpy as np
+import os
+import re
+from pathlib import Path
+from contextlib import contextmanager
+
+from src.utils import utils
+
+h5py = utils.lazy_import("h5py")
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # Ensemble store  # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# All the simulations (replicates, one for each network ID) of a hash are collected in a single hdf5 file :
+#
+#   Output/ensembles/<hash>.hdf5
+#       cfg/                    the cfg of the simulations (as in the result files)
+#       replicates/ID__<ID>/
+#           df                  the time series (as in the ABM files)
+#           daily_counts        the daily counts per state, kommune, age group and variant (if saved in the ABM files)
+#           my_state, ...       the rest of the datasets of the network files
+#
+# The simulations are saved in the per-run files by the workers, and copied into the store by the process
+# which adds them to the database (simulation.update_database), such that there is a single writer.
+# A replicate is written under a temporary name and renamed when it is complete, so an interrupted write
+# never leaves a partial replicate (it is ignored, and replaced the next time the replicate is added).
+# Once the store is closed and the copy is read back, the per-run files are deleted (unless delete_run_files is False).
+# Replicates already in the store are skipped, unless overwrite (e.g. for reruns) : hdf5 does not reclaim
+# the space of deleted groups, so every replaced replicate makes the file larger.
+# Readers get all the replicates of a hash in one open (see load_replicates). A single replicate is addressed
+# like a result file by its replicate path, <hash>.hdf5::ID__<ID> (see open_result), such that the loaders of
+# the result files (e.g. file_loaders.pandas_load_file and the catalog) read it from the store.
+
+ensemble_dir = "Output/ensembles"
+
+
+def ensemble_filename(hash_, base_dir=ensemble_dir) :
+    return str(Path(base_dir) / f"{hash_}.hdf5")
+
+
+def ensemble_exists(hash_, base_dir=ensemble_dir) :
+    return utils.file_exists(ensemble_filename(hash_, base_dir))
+
+
+replicate_separator = "::"
+
+
+def replicate_name(ID) :
+    return f"ID__{int(ID)}"
+
+
+def replicate_path(hash_, ID, base_dir=ensemble_dir) :
+    return f"{ensemble_filename(hash_, base_dir)}{replicate_separator}{replicate_name(ID)}"
+
+
+def is_replicate_path(filename) :
+    return replicate_separator in str(filename)
+
+
+def split_replicate_path(filename) :
+    " The file on disk and the replicate name (None if filename is a per-run result file) "
+    filename, _, name = str(filename).partition(replicate_separator)
+    return filename, (name if name else None)
+
+
+def replicate_path_to_run(filename) :
+    " (hash, ID) of a replicate path "
+    filename, name = split_replicate_path(filename)
+    return Path(filename).stem, int(name.split("__")[1])
+
+
+@contextmanager
+def open_result(filename) :
+    """ Opens a result file (read only), or the group of the replicate of a replicate path.
+        Both give the datasets of the simulation, e.g. f["df"] and f["my_state"]
+    """
+    filename, name = split_replicate_path(filename)
+    with h5py.File(filename, "r") as f :
+        yield f if name is None else f["replicates"][name]
+
+
+def replicate_exists(hash_, ID, base_dir=ensemble_dir) :
+    return ensemble_exists(hash_, base_dir) and int(ID) in get_replicate_IDs(hash_, base_dir)
+
+
+def get_replicate_paths(hash_, base_dir=ensemble_dir) :
+    if not ensemble_exists(hash_, base_dir) :
+        return []
+    return [replicate_path(hash_, ID, base_dir) for ID in get_replicate_IDs(hash_, base_dir)]
+
+
+def find_run_files(hash_, ID, base_dir="Output") :
+    """ The newest per-run ABM and network files of the simulation (hash_, ID), None if they do not exist """
+    filenames = []
+    for name in ["ABM", "network"] :
+        files = sorted(Path(base_dir, name, hash_).glob(f"{name}_*_{hash_}_ID__{int(ID)}.hdf5"), key=os.path.getmtime)
+        filenames.append(str(files[-1]) if files else None)
+    return tuple(filenames)
+
+
+def _add_replicate(f, hash_, ID, base_dir="Output", overwrite=False) :
+    " Copies the per-run files of the simulation (hash_, ID) into the store f, returns the copied files (None if nothing was copied) "
+    replicates = f.require_group("replicates")
+    name = replicate_name(ID)
+    if name in replicates and not overwrite :
+        return None
+
+    filename_ABM, filename_network = find_run_files(hash_, ID, base_dir)
+    if filename_ABM is None :
+        return None
+
+    name_tmp = f"{name}.tmp"
+    if name_tmp in replicates :
+        del replicates[name_tmp]
+
+    group = replicates.create_group(name_tmp)
+    with h5py.File(filename_ABM, "r") as f_ABM :
+        for key in ("df", "daily_counts") :
+            if key in f_ABM :
+                f_ABM.copy(f_ABM[key], group, key)
+        if "cfg" not in f :
+            f_ABM.copy(f_ABM["cfg"], f, "cfg")
+
+    if filename_network is not None :
+        with h5py.File(filename_network, "r") as f_network :
+            for key in f_network :
+                if key not in ("df", "cfg") :
+                    f_network.copy(f_network[key], group, key)
+
+    # replace earlier results of the same replicate (e.g. if rerun)
+    if name in replicates :
+        del replicates[name]
+    replicates.move(name_tmp, name)
+
+    return [filename for filename in (filename_ABM, filename_network) if filename is not None]
+
+
+def _is_copied(hash_, ID, run_files, store_dir=ensemble_dir) :
+    """ Whether the datasets copied from the per-run files (the ABM file first, see _add_replicate) are in the
+        replicate (hash_, ID) of the (closed) store, with the same shape and type
+    """
+    with open_result(replicate_path(hash_, ID, store_dir)) as group :
+        for i, filename in enumerate(run_files) :
+            with h5py.File(filename, "r") as f :
+                keys = [key for key in ("df", "daily_counts") if key in f] if i == 0 else [key for key in f if key not in ("df", "cfg")]
+                for key in keys :
+                    if key not in group :
+                        return False
+                    if isinstance(f[key], h5py.Dataset) and (group[key].shape != f[key].shape or group[key].dtype != f[key].dtype) :
+                        return False
+    return True
+
+
+def add_replicates(runs, base_dir="Output", store_dir=ensemble_dir, delete_run_files=True, overwrite=False, db_cfg=None) :
+    """ Copy the per-run results of the simulations runs (list of (hash, ID)) into the ensemble stores.
+        Replicates already in the store are only replaced if overwrite.
+        Unless delete_run_files is False, the per-run files are deleted once their copy is verified, and removed
+        from the catalog of db_cfg (default base_dir/db.sqlite, see file_loaders.update_catalog).
+        Must only be called from one process at a time. Returns the number of replicates added.
+    """
+    IDs_per_hash = {}
+    for hash_, ID in runs :
+        IDs_per_hash.setdefault(hash_, []).append(ID)
+
+    N_added = 0
+    deleted_files = []
+    try :
+        for hash_, IDs in IDs_per_hash.items() :
+            filename = ensemble_filename(hash_, store_dir)
+            utils.make_sure_folder_exist(filename)
+            copied = {}
+            with h5py.File(filename, "a") as f :
+                for ID in IDs :
+                    run_files = _add_replicate(f, hash_, ID, base_dir, overwrite)
+                    if run_files is not None :
+                        copied[ID] = run_files
+            N_added += len(copied)
+
+            # only delete the per-run files once the store is closed (flushed) and the copy is read back
+            if delete_run_files :
+                for ID, run_files in copied.items() :
+                    if _is_copied(hash_, ID, run_files, store_dir) :
+                        for run_file in run_files :
+                            utils.delete_file(run_file)
+                            deleted_files.append(run_file)
+    finally :
+        if len(deleted_files) > 0 :
+            if db_cfg is None :
+                db_cfg = utils.get_db_cfg(path=os.path.join(base_dir, "db.sqlite"))
+            db_cfg.remove_results(deleted_files)
+    return N_added
+
+
+def add_cfgs(cfgs, base_dir="Output", store_dir=ensemble_dir, delete_run_files=True, overwrite=False, db_cfg=None) :
+    " add_replicates for the simulations of the cfgs "
+    return add_replicates([(cfg.hash, cfg.network.ID) for cfg in cfgs], base_dir, store_dir, delete_run_files, overwrite, db_cfg)
+
+
+def filename_to_run(filename) :
+    " (hash, ID) of a per-run result file "
+    hash_, ID = re.search(r"_([^_]+)_ID__(\d+)\.hdf5$", str(filename)).groups()
+    return hash_, int(ID)
+
+
+def consolidate_ensembles(base_dir="Output", store_dir=ensemble_dir, delete_run_files=True, db_cfg=None, verbose=True) :
+    """ Collect all the per-run result files in base_dir/ABM (and base_dir/network) into ensemble stores,
+        e.g. for results from before the ensemble stores existed. Returns the number of replicates added.
+        Deleted per-run files (delete_run_files) are removed from the catalog of db_cfg (see add_replicates).
+    """
+    runs = sorted(set(filename_to_run(filename) for filename in Path(base_dir, "ABM").rglob("*.hdf5")))
+    if verbose :
+        print(f"Consolidating {len(runs)} simulations into ensemble stores in {store_dir}", flush=True)
+    return add_replicates(runs, base_dir, store_dir, delete_run_files, db_cfg=db_cfg)
+
+
+#%%
+
+
+def get_replicate_IDs(hash_, base_dir=ensemble_dir) :
+    with h5py.File(ensemble_filename(hash_, base_dir), "r") as f :
+        return sorted(int(name.split("__")[1]) for name in f.get("replicates", {}) if not name.endswith(".tmp"))
+
+
+def load_replicates(hash_, name="df", base_dir=ensemble_dir) :
+    " The dataset name of all the replicates of hash_, as a dict {ID : array}, read in a single open "
+    out = {}
+    with h5py.File(ensemble_filename(hash_, base_dir), "r") as f :
+        for key, group in f.get("replicates", {}).items() :
+            if key.endswith(".tmp") or name not in group :
+                continue
+            out[int(key.split("__")[1])] = group[name][()]
+    return dict(sorted(out.items()))
+
+
+def stack_replicates(arrays, fill_value=np.nan) :
+    """ Stack 1D arrays of (possibly) different lengths into a 2D array of shape (N_replicates, max length),
+        the missing values at the end of the shorter arrays are fill_value
+    """
+    arrays = [np.asarray(arr, dtype=float) for arr in arrays]
+    N_max = max((len(arr) for arr in arrays), default=0)
+    out = np.full((len(arrays), N_max), fill_value, dtype=float)
+    for i, arr in enumerate(arrays) :
+        out[i, : len(arr)] = arr
+    return out
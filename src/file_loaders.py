@@ -1,22 +1,35 @@
 import numpy as np
-import pandas as pd
 from pathlib import Path
 import re
-import h5py
 import os
-from tinydb import Query
 
 # from tqdm import tqdm TODO : delete line
 from src.utils import utils
+from src import ensemble_store
 from numba.typed import List, Dict  #TODO : delete Dict from line
 
+pd = utils.lazy_import("pandas")
+h5py = utils.lazy_import("h5py")
+
 
 def pandas_load_file(filename) :
     # df_raw = pd.read_csv(file)  # .convert_dtypes()
 
-    with h5py.File(filename, "r") as f :
+    # an ABM file or a replicate of an ensemble store
+    with ensemble_store.open_result(filename) as f :
         df_raw = pd.DataFrame(f["df"][()])
 
+    return format_df(df_raw)
+
+
+def pandas_load_ensemble(hash_) :
+    " The dataframes of all the simulations of hash_ from its ensemble store (read in one open), in order of ID "
+    return [format_df(pd.DataFrame(df_raw)) for df_raw in ensemble_store.load_replicates(hash_, "df").values()]
+
+
+def format_df(df_raw) :
+    " The time series of a simulation (as saved) with the E and I columns summed and duplicate times removed "
+
     df = df_raw.copy()
 
     for state in ["E", "I"] :
@@ -33,6 +46,33 @@ def pandas_load_file(filename) :
     return df
 
 
+def load_daily_counts(filename) :
+    """ The daily counts per state, kommune, age group and variant of an ABM file, shape (N_days, N_states + 1, N_kommuner, N_ages, N_variants),
+        where state i (-1 is susceptible) is at index i + 1. None if the simulation did not save them (see Simulation._save_daily_counts).
+    """
+    with ensemble_store.open_result(filename) as f :
+        if "daily_counts" not in f :
+            return None
+        return f["daily_counts"][()]
+
+
+def daily_counts_to_fractions(daily_counts, states, by="kommune") :
+    """ The fraction of the agents which are in one of the states, each day and for each kommune (or age group),
+        shape (N_days, N_kommuner). nan where there are no agents.
+        Parameters :
+            daily_counts (array) : see load_daily_counts
+            states (list) : the states to count, e.g. [8] for recovered or range(8) for exposed or infected
+            by (str) : "kommune" or "age_group"
+    """
+    axis = {"kommune" : 2, "age_group" : 3}[by]
+    other_axes = tuple(i for i in (1, 2, 3, 4) if i != axis)
+    rows = np.asarray(states, dtype=np.int64) + 1
+    N_in_states = daily_counts[:, rows].sum(axis=other_axes, dtype=np.float64)
+    N_total = daily_counts.sum(axis=other_axes, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore") :
+        return np.where(N_total > 0, N_in_states / N_total, np.nan)
+
+
 def path(file) :
     if isinstance(file, str) :
         file = Path(file)
@@ -53,7 +93,7 @@ def get_all_ABM_filenames(base_dir="Output/ABM", filetype="hdf5") :
     )
 
 def load_Network_file( filename) :
-    with h5py.File(filename, "r") as f :
+    with ensemble_store.open_result(filename) as f :
         print(list(f.keys()))
         print(filename, f)
         day_found_infected = pd.DataFrame(f["day_found_infected"][()])
@@ -74,6 +114,8 @@ def get_all_ABM_folders(filenames) :
 
 
 def filename_to_hash(filename) :
+    if ensemble_store.is_replicate_path(filename) :
+        return ensemble_store.replicate_path_to_run(filename)[0]
     filename = str(filename)
     # split at "_" and "."
     return re.split("_|\.", filename)[-5]
@@ -97,8 +139,7 @@ def folder_to_cfg(folder) :
 
 def hash_to_cfg(hash_, cfgs_dir="./Output/cfgs") :
     db_cfg = utils.get_db_cfg()
-    q = Query()
-    q_result = db_cfg.search(q.hash == hash_)
+    q_result = db_cfg.get(hash_)
     if len(q_result) == 0 :
         cfgs = [str(file) for file in Path(cfgs_dir).rglob(f"*{hash_}.yaml")]
         if len(cfgs) == 1 :
@@ -112,13 +153,12 @@ def hash_to_cfg(hash_, cfgs_dir="./Output/cfgs") :
     return cfg
 
 def query_to_hashes(subset=None, base_dir="Output") :
-    db_cfg = utils.get_db_cfg(path=os.path.join(base_dir, "db.json"))
-    q = Query()
+    db_cfg = utils.get_db_cfg(path=os.path.join(base_dir, "db.sqlite"))
 
     if subset is None :
         q_result = db_cfg.all()
     else :
-        q_result = db_cfg.search(utils.dict_to_query(subset))
+        q_result = db_cfg.search(subset)
 
     return q_result
     # if len(q_result) == 0 :
@@ -153,19 +193,188 @@ def get_cfgs(all_folders) :
     return cfgs
 
 
+#%%
+
+# The result files are listed in a catalog, the results table of the database (see utils.CfgDatabase),
+# together with their size, modification time, key cfg parameters and summary stats.
+# This way ABM_simulations does not have to scan the output folders and look up the cfg of every folder.
+# Simulations are added to the catalog when they are added to the database (simulation.update_database),
+# and the catalog of an existing output folder can be rebuilt with rebuild_catalog (see rebuild_catalog.py).
+
+catalog_filetypes = ["hdf5", "csv"]
+
+
+def filename_to_ID(filename) :
+    if ensemble_store.is_replicate_path(filename) :
+        return ensemble_store.replicate_path_to_run(filename)[1]
+    return int(re.search(r"_ID__(\d+)\.", str(filename)).group(1))
+
+
+def is_hdf5(filename) :
+    " Whether filename is an hdf5 result file or a replicate of an ensemble store "
+    return ensemble_store.is_replicate_path(filename) or path(filename).suffix == ".hdf5"
+
+
+def catalog_entry(filename, cfg=None) :
+    """ The catalog row of a result file (see utils.CfgDatabase.add_results).
+        The key cfg parameters are read from the file if no cfg is given,
+        the summary stats (peak number of infected and final number of recovered) are only read from ABM hdf5 files.
+        A replicate of an ensemble store (see ensemble_store.replicate_path) is cataloged as an ABM hdf5 file,
+        with the size and modification time of its store.
+    """
+    if ensemble_store.is_replicate_path(filename) :
+        kind, filetype = "ABM", "hdf5"
+        stat = path(ensemble_store.split_replicate_path(filename)[0]).stat()
+    else :
+        filename = path(filename)
+        kind = filename.name.split("_")[0]
+        filetype = filename.suffix[1:]
+        stat = filename.stat()
+
+    entry = {
+        "path" : str(filename),
+        "hash" : filename_to_hash(filename),
+        "network_ID" : filename_to_ID(filename),
+        "kind" : kind,
+        "filetype" : filetype,
+        "size" : stat.st_size,
+        "mtime" : stat.st_mtime,
+    }
+
+    if cfg is None and filetype == "hdf5" :
+        cfg = utils.read_cfg_from_hdf5_file(str(filename))
+
+    if cfg is not None :
+        entry["version"] = float(cfg["version"])
+        entry["N_tot"] = int(cfg["network"]["N_tot"])
+        entry["day_max"] = int(cfg["day_max"])
+        entry["beta"] = float(cfg["beta"])
+
+    if kind == "ABM" and filetype == "hdf5" :
+        df = pandas_load_file(filename)
+        # e.g. a simulation which stopped at t = 0
+        if len(df) > 0 :
+            entry["I_max"] = float(df["I"].max())
+            entry["R_inf"] = float(df["R"].iloc[-1])
+
+    return entry
+
+
+def get_run_filenames(hash_, ID, base_dir="Output", store_dir=None) :
+    """ The ABM and network files (of all filetypes) of the simulation (hash_, ID). If the simulation is in
+        an ensemble store in store_dir (default base_dir/ensembles), its replicate replaces its hdf5 files
+    """
+    if store_dir is None :
+        store_dir = os.path.join(base_dir, "ensembles")
+    in_store = ensemble_store.replicate_exists(hash_, ID, store_dir)
+
+    filenames = [ensemble_store.replicate_path(hash_, ID, store_dir)] if in_store else []
+    for kind in ["ABM", "network"] :
+        for filetype in catalog_filetypes :
+            if in_store and filetype == "hdf5" :
+                continue
+            filenames.extend(file for file in Path(base_dir, kind, hash_).glob(f"{kind}_*_{hash_}_ID__{int(ID)}.{filetype}") if not file_is_empty(file))
+    return filenames
+
+
+def update_catalog(db_cfg, cfgs, base_dir="Output", store_dir=None) :
+    """ Add the result files of the simulations of cfgs to the catalog (see get_run_filenames).
+        Must only be called from one process at a time (see simulation.update_database).
+    """
+    entries = []
+    for cfg in cfgs :
+        for filename in get_run_filenames(cfg["hash"], cfg["network"]["ID"], base_dir, store_dir) :
+            entries.append(catalog_entry(filename, cfg))
+    db_cfg.add_results(entries)
+    return len(entries)
+
+
+def rebuild_catalog(db_cfg=None, base_dir="Output", store_dir=None, insert_cfgs=True, verbose=True) :
+    """ Rebuild the catalog from all the result files in base_dir/ABM and base_dir/network and the ensemble stores
+        in store_dir (default base_dir/ensembles), e.g. for results from before the catalog existed or if files
+        have been moved or deleted. The simulations in the ensemble stores are cataloged as their replicates.
+        With insert_cfgs, the cfgs of the files which are not in the database are inserted as well.
+        Returns the number of files in the catalog.
+    """
+    if db_cfg is None :
+        db_cfg = utils.get_db_cfg(path=os.path.join(base_dir, "db.sqlite"))
+    if store_dir is None :
+        store_dir = os.path.join(base_dir, "ensembles")
+
+    replicates = [
+        replicate for filename in sorted(Path(store_dir).glob("*.hdf5"))
+        for replicate in ensemble_store.get_replicate_paths(filename.stem, store_dir)
+    ]
+    runs_in_store = set(ensemble_store.replicate_path_to_run(replicate) for replicate in replicates)
+
+    filenames = list(replicates)
+    for kind in ["ABM", "network"] :
+        for filetype in catalog_filetypes :
+            filenames.extend(
+                file for file in Path(base_dir, kind).rglob(f"*.{filetype}")
+                if not file_is_empty(file) and not (filetype == "hdf5" and (filename_to_hash(file), filename_to_ID(file)) in runs_in_store)
+            )
+    if verbose :
+        print(f"Cataloging {len(filenames)} files in {base_dir}", flush=True)
+
+    entries = []
+    cfgs = {}
+    for filename in sorted(filenames, key=lambda filename : not is_hdf5(filename)) :
+        run = (filename_to_hash(filename), filename_to_ID(filename))
+        try :
+            if run not in cfgs and is_hdf5(filename) :
+                cfg = utils.read_cfg_from_hdf5_file(str(filename))
+                cfg.hash = run[0]
+                cfgs[run] = cfg
+            entries.append(catalog_entry(filename, cfgs.get(run)))
+        except (OSError, KeyError) as e :
+            # unfinished or old file
+            if verbose :
+                print(f"Skipping {filename} : {e}", flush=True)
+
+    if insert_cfgs :
+        db_cfg.insert_multiple(list(cfgs.values()))
+
+    db_cfg.clear_results()
+    db_cfg.add_results(entries)
+    if verbose :
+        print(f"Catalog contains {len(entries)} files of {len(set(entry['hash'] for entry in entries))} hashes", flush=True)
+    return len(entries)
+
+
 class ABM_simulations :
-    def __init__(self, base_dir="Output/ABM", filetype="hdf5", subset=None, verbose=False) :
+    """
+    The ABM result files in base_dir (with the given filetype) and their cfgs, optionally only the subset
+    of cfgs matching the key-value pairs in subset.
+
+    The files are found in the catalog (see update_catalog) of db_cfg (default Output/db.sqlite)
+    if it contains any files in base_dir, otherwise (or if use_catalog is False) by scanning base_dir.
+    The simulations in the ensemble stores of store_dir (see ensemble_store) are listed as their replicates,
+    which the loaders (e.g. pandas_load_file) read like the files.
+    """
+
+    def __init__(self, base_dir="Output/ABM", filetype="hdf5", subset=None, verbose=False, use_catalog=True, db_cfg=None, store_dir=None) :
         self.base_dir = utils.path(base_dir)
+        # the ensemble stores of the same output folder, e.g. Output/ensembles for Output/ABM
+        self.store_dir = utils.path(store_dir) if store_dir is not None else self.base_dir.parent / "ensembles"
         self.filetype = filetype
         self.subset = subset
         self.verbose = verbose
+        self.db_cfg = db_cfg if db_cfg is not None else utils.get_db_cfg()
         if verbose :
             print("Loading ABM_simulations \n", flush=True)
 
+        results = self._get_catalog_results() if use_catalog else []
+
+        if len(results) > 0 :
+            self._load_from_catalog(results)
+            return None
+
         if self.subset is None:
             self.all_filenames = get_all_ABM_filenames(base_dir, filetype)
             self.all_folders   = get_all_ABM_folders(self.all_filenames)
             self.cfgs          = get_cfgs(self.all_folders)
+            hashes             = None
 
         else :
             # Steps:
@@ -173,12 +382,11 @@ class ABM_simulations :
             # Get the hashes for the relevent subset
             # Only load these
 
-            db = utils.get_db_cfg()
-            q = Query()
-            
-            query = q.version == 2.1
+            db = self.db_cfg
+
+            query = {"version" : 2.1}
             for key, val in subset.items() :
-                query = query & (q[key] == val)
+                query[key] = val
 
             cfgs = db.search(query)
 
@@ -189,9 +397,62 @@ class ABM_simulations :
 
             self.all_folders   = get_all_ABM_folders(self.all_filenames)
             self.cfgs          = get_cfgs(self.all_folders)
+            hashes             = [cfg["hash"] for cfg in cfgs]
 
 
         self.d = self._convert_all_files_to_dict(filetype)
+        self._add_ensembles(hashes)
+
+    def _get_catalog_results(self) :
+        " The files of the catalog in base_dir and the replicates in store_dir (the paths are compared relative to the working directory) "
+        base_dir = os.path.relpath(self.base_dir) + os.sep
+        store_dir = os.path.relpath(self.store_dir) + os.sep
+        return [
+            result for result in self.db_cfg.get_results("ABM", self.filetype)
+            if os.path.relpath(result["path"]).startswith(store_dir if ensemble_store.is_replicate_path(result["path"]) else base_dir)
+        ]
+
+    def _add_ensembles(self, hashes=None) :
+        " Add the simulations (of the hashes, default all) which are only in the ensemble stores of store_dir, as their replicates "
+        if self.filetype != "hdf5" :
+            return None
+
+        if hashes is None :
+            hashes = [filename.stem for filename in sorted(self.store_dir.glob("*.hdf5"))]
+
+        hashes_known = set(cfg.hash for cfg in self.cfgs)
+        for hash_ in hashes :
+            if hash_ in hashes_known or not ensemble_store.ensemble_exists(hash_, self.store_dir) :
+                continue
+            cfg = utils.read_cfg_from_hdf5_file(ensemble_store.ensemble_filename(hash_, self.store_dir))
+            cfg.hash = hash_
+            self.cfgs.append(cfg)
+            hashes_known.add(hash_)
+            self.d[hash_] = utils.hash_to_filenames(hash_, self.base_dir, self.filetype, self.store_dir)
+
+        self.all_filenames = [filename for filenames in self.d.values() for filename in filenames]
+
+    def _load_from_catalog(self, results) :
+        db = self.db_cfg
+
+        if self.subset is not None :
+            query = {"version" : 2.1, **self.subset}
+            hashes = set(cfg["hash"] for cfg in db.search(query))
+            results = [result for result in results if result["hash"] in hashes]
+
+        self.results = results
+        self.all_filenames = [result["path"] for result in results]
+        self.all_folders = get_all_ABM_folders(self.all_filenames)
+
+        self.d = {}
+        for result in results :
+            self.d.setdefault(result["hash"], []).append(result["path"])
+
+        self.cfgs = []
+        for hash_ in self.d :
+            cfgs = db.get(hash_, ID=0) or db.get(hash_)
+            if len(cfgs) > 0 :
+                self.cfgs.append(cfgs[0])
 
     def _convert_all_files_to_dict(self, filetype) :
         """
@@ -200,7 +461,7 @@ class ABM_simulations :
         """
         d = {}
         for cfg in self.cfgs :
-            d[cfg.hash] = utils.hash_to_filenames(cfg.hash, self.base_dir, self.filetype)
+            d[cfg.hash] = utils.hash_to_filenames(cfg.hash, self.base_dir, self.filetype, self.store_dir)
         return d
 
     def iter_all_files(self) :
@@ -259,6 +520,10 @@ from zipfile import ZipFile
 import urllib.request
 from urllib.error import HTTPError
 import datetime
+from functools import lru_cache
+
+
+SSI_snapshot_dir = "Data/SSI_snapshots"
 
 
 def load_SSI_url(SSI_data_url) :
@@ -267,26 +532,73 @@ def load_SSI_url(SSI_data_url) :
     return df
 
 
-def load_newest_SSI_data(max_days_back=30) :
-    # SSI_data_url = "https ://files.ssi.dk/Data-Epidemiologiske-Rapport-22102020-20mg"
+def download_newest_SSI_data(max_days_back=30) :
+    """ Download the newest SSI data. Returns the data and the date of the report """
+    # SSI_data_url = "https://files.ssi.dk/Data-Epidemiologiske-Rapport-22102020-20mg"
     today = datetime.date.today()
     for i in range(max_days_back) :
         day = today - datetime.timedelta(days=i)
         s_day = day.strftime("%d%m%Y")
-        SSI_data_url = f"https ://files.ssi.dk/Data-Epidemiologiske-Rapport-{s_day}-20mg"
+        SSI_data_url = f"https://files.ssi.dk/Data-Epidemiologiske-Rapport-{s_day}-20mg"
         try :
             df = load_SSI_url(SSI_data_url)
-            return df
+            return df, day
         except HTTPError :
             continue
     raise AssertionError("Could not find any data from SSI")
 
 
-def load_kommune_data(df_coordinates) :
-    my_kommune = List(df_coordinates["kommune"].tolist())
-    df = load_newest_SSI_data().set_index("date_sample")
+def load_newest_SSI_data(max_days_back=30) :
+    return download_newest_SSI_data(max_days_back)[0]
+
+
+def SSI_snapshot_filename(snapshot_date, base_dir=SSI_snapshot_dir) :
+    return str(path(base_dir) / f"Municipality_cases_time_series_{snapshot_date}.feather")
+
+
+def ingest_SSI_data(max_days_back=30, base_dir=SSI_snapshot_dir) :
+    """ Download the newest SSI data (needs internet) and save it as a local snapshot,
+        which is what load_kommune_data reads. Returns the filename of the snapshot.
+    """
+    df, day = download_newest_SSI_data(max_days_back)
+    filename = SSI_snapshot_filename(day.isoformat(), base_dir)
+    utils.make_sure_folder_exist(filename)
+    df.reset_index(drop=True).to_feather(filename)
+    return filename
+
+
+def get_SSI_snapshot_dates(base_dir=SSI_snapshot_dir) :
+    "sorted dates (as YYYY-MM-DD strings) of all local SSI snapshots"
+    files = path(base_dir).glob(SSI_snapshot_filename("*", base_dir="."))
+    return sorted(file.stem.split("_")[-1] for file in files)
+
+
+@lru_cache(maxsize=None)
+def _load_SSI_snapshot(snapshot_date, base_dir) :
+    return pd.read_feather(SSI_snapshot_filename(snapshot_date, base_dir)).set_index("date_sample")
+
+
+def load_SSI_snapshot(snapshot_date=None, base_dir=SSI_snapshot_dir) :
+    """ Load a local SSI snapshot, by default the newest one.
+        The snapshot is only read once per process (memoized on the snapshot date).
+    """
+    if snapshot_date is None :
+        snapshot_dates = get_SSI_snapshot_dates(base_dir)
+        if len(snapshot_dates) == 0 :
+            raise AssertionError(
+                f"No local SSI snapshots in {base_dir}. "
+                "Run 'python ingest_SSI_data.py' on a computer with internet access first."
+            )
+        snapshot_date = snapshot_dates[-1]
+    return _load_SSI_snapshot(str(snapshot_date), str(base_dir))
+
+
+def load_kommune_data(kommune_names, snapshot_date=None) :
+    """ Number of positive tests during the last 8 days of SSI data for each kommune in kommune_names.
+        Uses the local SSI snapshot from snapshot_date (default: newest), see ingest_SSI_data.
+    """
+    df = load_SSI_snapshot(snapshot_date)
     dates = df.index[-8 :]
-    kommune_names = List(set(my_kommune))
     infected_per_kommune_ints = np.zeros(len(kommune_names))
     for date in dates :
         infected_per_kommune_series = df.loc[date]
@@ -298,4 +610,4 @@ def load_kommune_data(df_coordinates) :
                 infected_per_kommune_ints[ith_kommune] += infected_per_kommune_series["Copenhagen"]
             else :
                 infected_per_kommune_ints[ith_kommune] += infected_per_kommune_series[kommune]
-    return infected_per_kommune_ints, kommune_names, my_kommune
\ No newline at end of file
+    return infected_per_kommune_ints
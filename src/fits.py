@@ -245,18 +245,32 @@ def fit_single_file(filename, cfg, ts=0.1, dt=0.01, y_max=0.01):
 
 from collections import Counter
 
+# the settings of fit_single_file used by fit_multiple_files and get_fit_results
+fit_settings = {"ts" : 0.1, "dt" : 0.01}
+
+
+def _fit_single_file_and_cfg(filename_and_cfg, y_max=0.01):
+    filename, cfg = filename_and_cfg
+    return fit_single_file(filename, cfg, y_max=y_max, **fit_settings)
 
-def fit_multiple_files(cfg, filenames, num_cores=1, do_tqdm=True, y_max=0.01, verbose=False):
 
-    func = partial(fit_single_file, cfg=cfg, y_max=y_max)
+def _fit_files(filenames_and_cfgs, num_cores=1, do_tqdm=True, y_max=0.01):
+    """ fit_single_file for each (filename, cfg) in filenames_and_cfgs, in parallel if num_cores > 1.
+        Returns a list of (filename, fit_object or the reason it was rejected)
+    """
+    func = partial(_fit_single_file_and_cfg, y_max=y_max)
 
     if num_cores == 1:
         if do_tqdm:
-            filenames = tqdm(filenames)
-        results = [func(filename) for filename in filenames]
+            filenames_and_cfgs = tqdm(filenames_and_cfgs)
+        return [func(filename_and_cfg) for filename_and_cfg in filenames_and_cfgs]
+
+    return p_umap(func, filenames_and_cfgs, num_cpus=num_cores, disable=not do_tqdm)
 
-    else:
-        results = p_umap(func, filenames, num_cpus=num_cores, disable=True)
+
+def fit_multiple_files(cfg, filenames, num_cores=1, do_tqdm=True, y_max=0.01, verbose=False):
+
+    results = _fit_files([(filename, cfg) for filename in filenames], num_cores=num_cores, do_tqdm=do_tqdm and num_cores == 1, y_max=y_max)
 
     reject_counter = Counter()
 
@@ -277,53 +291,83 @@ def fit_multiple_files(cfg, filenames, num_cores=1, do_tqdm=True, y_max=0.01, ve
     return fit_objects, reject_counter
 
 
-def get_fit_results(abm_files, force_rerun=False, num_cores=1, y_max=0.01):
-
-    all_fits_file = f"Data/fits_ymax_{y_max}.joblib"
+def fit_cache_filename(y_max=0.01):
+    return f"Data/fits/fit_cache_ymax_{y_max}.joblib"
 
-    if Path(all_fits_file).exists() and not force_rerun:
-        print("Loading all Imax fits", flush=True)
-        return joblib.load(all_fits_file)
 
-    else:
+def get_fit_results(abm_files, force_rerun=False, num_cores=1, y_max=0.01):
+    """ The fits of all the files of abm_files (file_loaders.ABM_simulations), as {hash : {filename : fit_object}}.
+
+    The fit (or the reason it was rejected) of each file is cached (see fit_cache_filename), together with
+    the modification time of the file and the fit settings (y_max and fit_settings). Only files which are new,
+    have changed or were fitted with other settings are fitted (all of them if force_rerun), and the entries of
+    files which no longer exist are evicted.
+    """
+
+    cache_file = fit_cache_filename(y_max)
+    settings = {"y_max" : y_max, **fit_settings}
+
+    cache = {}
+    if Path(cache_file).exists() and not force_rerun:
+        cache = joblib.load(cache_file)
+
+    # Evict the fits of deleted files
+    N_evicted = 0
+    for filename in list(cache.keys()):
+        if not Path(filename).exists():
+            del cache[filename]
+            N_evicted += 1
+
+    # Find the files which are not in the cache (or have changed)
+    files_to_fit = []
+    mtimes = {}
+    N_hits = 0
+    for cfg, filenames in abm_files.iter_folders():
+        for filename in filenames:
+            mtimes[filename] = Path(filename).stat().st_mtime
+            entry = cache.get(filename)
+            if entry is not None and entry["mtime"] == mtimes[filename] and entry["settings"] == settings:
+                N_hits += 1
+            else:
+                files_to_fit.append((filename, cfg))
 
-        all_fits = {}
-        print(
-            f"Fitting {len(abm_files.all_filenames)} files with {len(abm_files.cfgs)} different simulation parameters, please wait.",
-            flush=True,
-        )
+    print(
+        f"Fit cache : {N_hits} hits, {len(files_to_fit)} misses and {N_evicted} evicted. "
+        f"Fitting {len(files_to_fit)} files, please wait.",
+        flush=True,
+    )
 
-        reject_counter = Counter()
+    if len(files_to_fit) > 0:
+        with warnings.catch_warnings():
+            warnings.filterwarnings(
+                "ignore", message="covariance is not positive-semidefinite."
+            )
+            results = _fit_files(files_to_fit, num_cores=num_cores, y_max=y_max)
 
-        desc = "Fitting ABM simulations"
-        for cfg, filenames in tqdm(abm_files.iter_folders(), total=len(abm_files.cfgs), desc=desc):
-            # break
-            output_filename = Path("Data/fits") / f"fits_{cfg.hash}_ymax_{y_max}.joblib"
-            utils.make_sure_folder_exist(output_filename)
+        for filename, fit_result in results:
+            cache[filename] = {"mtime" : mtimes[filename], "settings" : settings, "result" : fit_result}
 
-            if output_filename.exists():
-                all_fits[cfg.hash] = joblib.load(output_filename)
+    if len(files_to_fit) > 0 or N_evicted > 0:
+        with utils.atomic_write(cache_file) as cache_file_tmp:
+            joblib.dump(cache, cache_file_tmp)
 
+    # Collect the fits of abm_files
+    all_fits = {}
+    reject_counter = Counter()
+    for cfg, filenames in abm_files.iter_folders():
+        fit_objects = {}
+        for filename in filenames:
+            fit_result = cache[filename]["result"]
+            if isinstance(fit_result, str):
+                reject_counter[fit_result.lower()] += 1
             else:
-                with warnings.catch_warnings():
-                    warnings.filterwarnings(
-                        "ignore", message="covariance is not positive-semidefinite."
-                    )
-                    fit_results, reject_counter_tmp = fit_multiple_files(
-                        cfg,
-                        filenames,
-                        num_cores=num_cores,
-                        y_max=y_max,
-                    )
-
-                joblib.dump(fit_results, output_filename)
-                all_fits[cfg.hash] = fit_results
-                reject_counter += reject_counter_tmp
-
-        print(reject_counter)
-
-        joblib.dump(all_fits, all_fits_file)
-        return all_fits
+                fit_objects[filename] = fit_result
+                reject_counter["no rejection"] += 1
+        all_fits[cfg.hash] = fit_objects
+
+    print(reject_counter)
+
+    return all_fits
 
 
 if False:
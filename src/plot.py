@@ -18,6 +18,7 @@ try:
 
     # from src import simulation_utils
     from src import file_loaders
+    from src import ensemble_store
     from src import SIR
     from src import database
     from src import fits
@@ -26,6 +27,7 @@ except ImportError:
 
     # import simulation_utils
     import file_loaders
+    import ensemble_store
     import SIR
     import database
     import fits
@@ -88,11 +90,15 @@ def plot_single_ABM_simulation(
     d_label_loc=None,
 ):
 
-    filenames = abm_files.cfg_to_filenames(cfg)
-
     if not isinstance(cfg, utils.DotDict):
         cfg = utils.DotDict(cfg)
 
+    # all the simulations of the cfg in one read if they are in an ensemble store
+    if ensemble_store.ensemble_exists(cfg.hash):
+        dfs = file_loaders.pandas_load_ensemble(cfg.hash)
+    else:
+        dfs = [file_loaders.pandas_load_file(filename) for filename in abm_files.cfg_to_filenames(cfg)]
+
     d_ylabel = {"I": "Fraction Infected", "R": "Fraction Recovered"}
     if d_label_loc is None:
         d_label_loc = {"I": "upper right", "R": "lower right"}
@@ -103,16 +109,15 @@ def plot_single_ABM_simulation(
     fig.subplots_adjust(top=0.75)
 
     T_max = 0
-    lw = 0.3 * 10 / np.sqrt(len(filenames))
+    lw = 0.3 * 10 / np.sqrt(len(dfs))
     lw_SEIR = 4
 
     stochastic_noise_I = []
     stochastic_noise_R = []
 
     # file, i = abm_files[ABM_parameter][0], 0
-    for i, filename in enumerate(filenames):
+    for i, df in enumerate(dfs):
         # break
-        df = file_loaders.pandas_load_file(filename)
         t = df["time"].values
         label = r"ABM" if i == 0 else None
 
@@ -165,7 +170,7 @@ def plot_single_ABM_simulation(
                 fontsize=12,
             )
 
-    title = utils.dict_to_title(cfg, len(filenames))
+    title = utils.dict_to_title(cfg, len(dfs))
     fig.suptitle(title, fontsize=15)
     plt.subplots_adjust(wspace=0.4)
 
@@ -868,7 +873,7 @@ import h5py
 
 
 def _load_my_state_and_my_number_of_contacts(filename):
-    with h5py.File(filename, "r") as f:
+    with ensemble_store.open_result(filename) as f:
         my_state = f["my_state"][()]
         my_number_of_contacts = f["my_number_of_contacts"][()]
     return my_state, my_number_of_contacts
@@ -1554,7 +1559,7 @@ def make_MCMC_plots(
 
 
 def _load_corona_type_data(filename, day_max=None):
-    with h5py.File(filename, "r") as f:
+    with ensemble_store.open_result(filename) as f:
         days_total = len(f["my_state"])
         my_corona_type = f["my_corona_type"][()]
         my_state = f["my_state"][slice(0, day_max)]
@@ -0,0 +1,289 @@
+import numpy as np
+import os
+from pathlib import Path
+
+from src.utils import utils
+from src.simulation import scheduler
+
+h5py = utils.lazy_import("h5py")
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # Cost models # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def cfg_to_cost_parameters(cfg) :
+    " The parameters of a cfg which the cost of its simulation depends on "
+    return {
+        "N_tot" : float(cfg["network"]["N_tot"]),
+        "mu" : float(cfg["network"]["mu"]),
+        "day_max" : float(cfg["day_max"]),
+        "N_events" : float(cfg["N_events"]),
+        "do_interventions" : float(bool(cfg["do_interventions"])),
+    }
+
+
+class LogLinearModel :
+    """
+    Model of a (positive) cost y of a simulation, which is assumed to be log-normal distributed :
+
+        log(y) = features(parameters) @ coefficients + N(0, sigma)
+
+    The coefficients and sigma are fitted to the costs of earlier simulations (see fit), and default to
+    rough estimates when there are too few of these. With log(y) in the features, each coefficient is
+    the power the cost scales with, e.g. a coefficient of 1 for log(N_tot) means the cost is proportional to N_tot.
+    """
+
+    name = "cost"
+    default_coefficients = np.array([0.0])
+    default_sigma = np.log(3)
+
+    def __init__(self, coefficients=None, sigma=None) :
+        if coefficients is None :
+            coefficients = self.default_coefficients
+        if sigma is None :
+            sigma = self.default_sigma
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.sigma = sigma
+        self.N_calibration_jobs = 0
+
+    @staticmethod
+    def features(p) :
+        return np.array([1.0])
+
+    def fit(self, parameters, y, min_jobs=10) :
+        """ Fit the coefficients and sigma to the measured costs y of earlier simulations.
+            Parameters :
+                parameters (list of dicts) : see cfg_to_cost_parameters
+                y (array) : the measured costs
+                min_jobs (int) : keep the default coefficients if fewer simulations have been measured
+        """
+        y = np.asarray(y, dtype=float)
+        mask = y > 0
+        if mask.sum() < min_jobs :
+            return self
+
+        X = np.array([self.features(p) for p, m in zip(parameters, mask) if m])
+        log_y = np.log(y[mask])
+
+        # Only fit the terms that vary between the jobs, keep the default for the rest
+        coefficients = self.coefficients.copy()
+        varies = np.ptp(X, axis=0) > 0
+        varies[0] = True
+        offset = X[:, ~varies] @ coefficients[~varies]
+        fit, *_ = np.linalg.lstsq(X[:, varies], log_y - offset, rcond=None)
+        coefficients[varies] = fit
+
+        residuals = log_y - X @ coefficients
+        N_dof = max(len(log_y) - varies.sum(), 1)
+
+        self.coefficients = coefficients
+        self.sigma = np.sqrt(np.sum(residuals ** 2) / N_dof)
+        self.N_calibration_jobs = len(log_y)
+        return self
+
+    def predict(self, parameters) :
+        """ Mean and standard deviation of the cost of a simulation with the given parameters
+            (of the log-normal distribution)
+        """
+        mu = float(self.features(parameters) @ self.coefficients)
+        mean = np.exp(mu + self.sigma ** 2 / 2)
+        std = mean * np.sqrt(np.expm1(self.sigma ** 2))
+        return mean, std
+
+    def __repr__(self) :
+        s_coefficients = ", ".join(f"{c:.3g}" for c in self.coefficients)
+        return (
+            f"{self.__class__.__name__}(coefficients=[{s_coefficients}], sigma={self.sigma:.3g}, "
+            f"calibrated on {self.N_calibration_jobs} jobs)"
+        )
+
+
+class TimeModel(LogLinearModel) :
+    """
+    CPU time (seconds) of a single simulation :
+
+        log(time) = c_0 + c_1 log(N_tot) + c_2 log(mu) + c_3 log(day_max + 1) + c_4 log(N_events + 1) + c_5 do_interventions
+
+    The default is proportional to N_tot * mu * (day_max + 1), within a factor of 3.
+    """
+
+    name = "time"
+    default_coefficients = np.array([np.log(2e-6), 1.0, 1.0, 1.0, 0.0, 0.0])
+    default_sigma = np.log(3)
+
+    @staticmethod
+    def features(p) :
+        return np.array([
+            1.0,
+            np.log(p["N_tot"]),
+            np.log(p["mu"]),
+            np.log(p["day_max"] + 1),
+            np.log(p["N_events"] + 1),
+            p["do_interventions"],
+        ])
+
+
+class OutputModel(LogLinearModel) :
+    """
+    Size (bytes) of the output files of a single simulation :
+
+        log(bytes) = c_0 + c_1 log(N_tot) + c_2 log(day_max + 1)
+
+    The default is dominated by the daily state of every agent (my_state), within a factor of 1.5.
+    """
+
+    name = "output"
+    default_coefficients = np.array([np.log(1.4), 1.0, 1.0])
+    default_sigma = np.log(1.5)
+
+    @staticmethod
+    def features(p) :
+        return np.array([1.0, np.log(p["N_tot"]), np.log(p["day_max"] + 1)])
+
+
+def get_past_results(base_dir="Output", N_max=1000) :
+    """ The cost parameters, the time (the time_elapsed dataset) and the size of the output files
+        of the (N_max newest) simulations in base_dir/network, then of those in the ensemble stores in base_dir/ensembles
+        (whose per-run files are deleted, see ensemble_store). The size includes the ABM file of the simulation.
+    """
+    filenames = sorted(Path(base_dir, "network").rglob("*.hdf5"), key=os.path.getmtime, reverse=True)
+
+    results = []
+    for filename in filenames :
+        if N_max is not None and len(results) >= N_max :
+            break
+        try :
+            with h5py.File(filename, "r") as f :
+                if "time_elapsed" not in f :
+                    continue
+                time_elapsed = float(f["time_elapsed"][()])
+                cfg = utils.read_cfg_from_hdf5_file_recursively(f)
+        except (OSError, KeyError) :
+            # unfinished or old file
+            continue
+
+        filename_ABM = Path(base_dir, "ABM", filename.parent.name, filename.name.replace("network_", "ABM_", 1))
+        output_bytes = filename.stat().st_size
+        if filename_ABM.exists() :
+            output_bytes += filename_ABM.stat().st_size
+
+        results.append({**cfg_to_cost_parameters(cfg), "time_elapsed" : time_elapsed, "output_bytes" : output_bytes})
+
+    stores = sorted(Path(base_dir, "ensembles").glob("*.hdf5"), key=os.path.getmtime, reverse=True)
+    for filename in stores :
+        if N_max is not None and len(results) >= N_max :
+            break
+        try :
+            with h5py.File(filename, "r") as f :
+                cfg = utils.read_cfg_from_hdf5_file_recursively(f)
+                for name, group in f.get("replicates", {}).items() :
+                    if name.endswith(".tmp") or "time_elapsed" not in group :
+                        continue
+                    time_elapsed = float(group["time_elapsed"][()])
+                    # the size of the replicate, i.e. of its per-run files
+                    output_bytes = sum(dataset.id.get_storage_size() for dataset in group.values() if isinstance(dataset, h5py.Dataset))
+                    results.append({**cfg_to_cost_parameters(cfg), "time_elapsed" : time_elapsed, "output_bytes" : output_bytes})
+        except (OSError, KeyError) :
+            continue
+
+    return results[:N_max]
+
+
+def network_filename(cfg) :
+    return f"Initialized_networks/{utils.cfg_to_hash(cfg.network, exclude_ID=False)}.hdf5"
+
+
+class CostModel :
+    """
+    Predicted cost of a sweep : CPU time, peak memory per job, size of the output files
+    and the number of networks that have to be generated or can be reused.
+
+    - time_model (TimeModel) : CPU time of a simulation
+    - output_model (OutputModel) : size of the output files of a simulation
+    - memory_model (scheduler.MemoryModel) : peak memory of a simulation
+
+    Use from_past_results to fit the models to the earlier simulations.
+    """
+
+    def __init__(self, time_model=None, output_model=None, memory_model=None) :
+        self.time_model = time_model if time_model is not None else TimeModel()
+        self.output_model = output_model if output_model is not None else OutputModel()
+        self.memory_model = memory_model if memory_model is not None else scheduler.MemoryModel()
+
+    @classmethod
+    def from_past_results(cls, db_cfg=None, base_dir="Output", N_max=1000, min_jobs=10) :
+        """ Fit the time and output models to the simulations in base_dir (see get_past_results)
+            and the memory model to the job stats in the database.
+        """
+        results = get_past_results(base_dir, N_max)
+        time_model = TimeModel().fit(results, [r["time_elapsed"] for r in results], min_jobs)
+        output_model = OutputModel().fit(results, [r["output_bytes"] for r in results], min_jobs)
+
+        if db_cfg is None :
+            db_cfg = utils.get_db_cfg(path=os.path.join(base_dir, "db.sqlite"))
+        memory_model = scheduler.MemoryModel.from_job_stats(db_cfg.get_job_stats(N_max=N_max), min_jobs)
+
+        return cls(time_model, output_model, memory_model)
+
+    def estimate_job(self, cfg) :
+        " Estimated cost (mean and standard deviation) of the simulation of a single cfg "
+        parameters = cfg_to_cost_parameters(cfg)
+        time_mean, time_std = self.time_model.predict(parameters)
+        output_mean, output_std = self.output_model.predict(parameters)
+        return {
+            "hash" : cfg.hash,
+            "ID" : cfg.network.ID,
+            "time" : time_mean,
+            "time_std" : time_std,
+            "peak_memory" : self.memory_model.estimate(cfg),
+            "output_bytes" : output_mean,
+            "output_bytes_std" : output_std,
+        }
+
+    def estimate(self, cfgs, num_cores=1) :
+        """ Estimated cost of running all the cfgs. Returns (jobs, total) :
+            jobs is a list of the estimates of each job (see estimate_job) and total the sums of these.
+            The uncertainties of the totals assume independent errors of the jobs, which underestimates
+            them if the model is off in the same direction for all the jobs.
+        """
+        jobs = [self.estimate_job(cfg) for cfg in cfgs]
+
+        network_files = set(network_filename(cfg) for cfg in cfgs)
+        N_networks_to_build = sum(not utils.file_exists(filename) for filename in network_files)
+
+        time = sum(job["time"] for job in jobs)
+        time_std = np.sqrt(sum(job["time_std"] ** 2 for job in jobs))
+
+        total = {
+            "N_jobs" : len(jobs),
+            "cpu_hours" : time / 3600,
+            "cpu_hours_std" : time_std / 3600,
+            "wall_hours" : time / 3600 / num_cores,
+            "peak_memory_max" : max((job["peak_memory"] for job in jobs), default=0.0),
+            "output_bytes" : sum(job["output_bytes"] for job in jobs),
+            "output_bytes_std" : np.sqrt(sum(job["output_bytes_std"] ** 2 for job in jobs)),
+            "N_networks_to_build" : N_networks_to_build,
+            "N_networks_reused" : len(jobs) - N_networks_to_build,
+        }
+        return jobs, total
+
+    def report(self, cfgs, num_cores=1) :
+        _, total = self.estimate(cfgs, num_cores)
+        return (
+            f"Estimated cost of {total['N_jobs']} simulations :\n"
+            f"  CPU time : {total['cpu_hours']:.1f} ± {total['cpu_hours_std']:.1f} hours "
+            f"(at least {total['wall_hours']:.1f} hours on {num_cores} cores)\n"
+            f"  Peak memory per job : up to {total['peak_memory_max'] / 1e9:.2f} GB\n"
+            f"  Output : {total['output_bytes'] / 1e9:.2f} ± {total['output_bytes_std'] / 1e9:.2f} GB\n"
+            f"  Networks : {total['N_networks_to_build']} to generate, {total['N_networks_reused']} jobs reuse a network\n"
+            f"  {self.time_model}\n"
+            f"  {self.output_model}\n"
+            f"  {self.memory_model}"
+        )
+
+    def __repr__(self) :
+        return f"CostModel(\n  {self.time_model},\n  {self.output_model},\n  {self.memory_model}\n)"
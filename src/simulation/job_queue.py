@@ -0,0 +1,357 @@
+import os
+import json
+import time
+import socket
+import multiprocessing as mp
+from pathlib import Path
+
+from src.utils import utils
+from src.simulation import nb_simulation
+from src.simulation import scheduler
+from src.simulation import result_writer
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # Job queue # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def get_worker_name() :
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue :
+    """
+    Durable queue of simulation jobs. Each job is a JSON file in one of the folders
+    base_dir/pending, base_dir/running, base_dir/done, base_dir/collected or base_dir/failed.
+    Done jobs are moved to collected once they are added to the database (see mark_collected),
+    such that the coordinator only adds each finished job once.
+    Jobs change state by renaming the file, which is atomic, so every job is in exactly one state
+    and only one process can claim a pending job. The queue survives crashes, see simulation.resume_simulations.
+    The heartbeat of a running job is the modification time of its file.
+
+    A job contains :
+    - cfg : the cfg to simulate (when done : the cfg returned by the simulation)
+    - kwargs : the keyword arguments of the simulation, e.g. output_level (see simulation.run_single_simulation),
+      such that resumed jobs and jobs run by other workers are run in the same way
+    - attempts : the number of times the job has been started
+    - not_before : unix time before which a pending job should not be started (retry backoff)
+    - worker : hostname:pid of the worker running the job
+    - stats : measured resource usage of the job, when done
+    - error : traceback of the last failure
+
+    - max_attempts : number of attempts before a job is marked as failed
+    - backoff : seconds to wait before the first retry, doubled for each failed attempt
+    - heartbeat_timeout : running jobs without a heartbeat for this many seconds are considered lost
+    """
+
+    states = ("pending", "running", "done", "collected", "failed")
+
+    def __init__(self, base_dir="Output/queue", max_attempts=3, backoff=60, heartbeat_timeout=600) :
+        self.base_dir = Path(base_dir)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.heartbeat_timeout = heartbeat_timeout
+        for state in self.states :
+            (self.base_dir / state).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def job_id(cfg) :
+        return f"{cfg['hash']}_ID__{cfg['network']['ID']}"
+
+    def _filename(self, state, job_id) :
+        return self.base_dir / state / f"{job_id}.json"
+
+    def _write(self, filename, job) :
+        with utils.atomic_write(filename) as filename_tmp, open(filename_tmp, "w") as f :
+            json.dump(job, f, default=utils._json_default)
+
+    def _read(self, filename) :
+        with open(filename, "r") as f :
+            return json.load(f)
+
+    def _move(self, job, state_from, state_to) :
+        """ Move the job from state_from to state_to (with the updated content of job).
+            Returns False if the job was no longer in state_from, e.g. claimed by another worker
+        """
+        filename_from = self._filename(state_from, job["id"])
+        filename_to = self._filename(state_to, job["id"])
+        try :
+            os.rename(filename_from, filename_to)
+        except FileNotFoundError :
+            return False
+        self._write(filename_to, job)
+        return True
+
+    def state_of(self, job_id) :
+        for state in self.states :
+            if self._filename(state, job_id).exists() :
+                return state
+        return None
+
+    def job_ids(self, state) :
+        return sorted(filename.stem for filename in (self.base_dir / state).glob("*.json"))
+
+    def jobs(self, state) :
+        jobs = []
+        for job_id in self.job_ids(state) :
+            try :
+                jobs.append(self._read(self._filename(state, job_id)))
+            except FileNotFoundError :
+                # changed state in the meantime
+                continue
+        return jobs
+
+    def counts(self) :
+        return {state : len(self.job_ids(state)) for state in self.states}
+
+    def add(self, cfgs, force=False, run_kwargs=None) :
+        """ Add the cfgs as pending jobs. Jobs which are already pending or running are skipped,
+            failed jobs get a fresh set of attempts and done (or collected) jobs are only rerun if force.
+            run_kwargs (dict) are the keyword arguments the jobs are run with, must be JSON serializable.
+            Returns the number of jobs added.
+        """
+        N_added = 0
+        for cfg in cfgs :
+            job_id = self.job_id(cfg)
+            state = self.state_of(job_id)
+
+            if state in ("pending", "running") or (state in ("done", "collected") and not force) :
+                continue
+
+            job = {"id" : job_id, "cfg" : cfg, "kwargs" : dict(run_kwargs or {}), "attempts" : 0, "not_before" : 0, "worker" : None}
+            self._write(self._filename("pending", job_id), job)
+            if state is not None :
+                utils.delete_file(self._filename(state, job_id))
+            N_added += 1
+        return N_added
+
+    def claim(self, worker=None, N_max=None) :
+        """ Claim (up to N_max) pending jobs which are ready to run and mark them as running.
+            Safe to call from several processes (and nodes) at the same time.
+        """
+        if worker is None :
+            worker = get_worker_name()
+
+        now = time.time()
+        claimed = []
+        for job in self.jobs("pending") :
+            if N_max is not None and len(claimed) >= N_max :
+                break
+            if job["not_before"] > now :
+                continue
+            job["attempts"] += 1
+            job["worker"] = worker
+            if self._move(job, "pending", "running") :
+                claimed.append(job)
+        return claimed
+
+    def heartbeat(self, jobs) :
+        " Touch the files of the running jobs "
+        for job in jobs :
+            try :
+                os.utime(self._filename("running", job["id"]))
+            except FileNotFoundError :
+                # requeued by requeue_stale in the meantime
+                continue
+
+    def complete(self, job, cfg=None, stats=None) :
+        if cfg is not None :
+            job["cfg"] = cfg
+        job["stats"] = stats
+        return self._move(job, "running", "done")
+
+    def mark_collected(self, job_ids) :
+        " Move the done jobs (job_ids) to collected, when they are added to the database. Returns the number of jobs moved "
+        N_collected = 0
+        for job_id in job_ids :
+            try :
+                os.rename(self._filename("done", job_id), self._filename("collected", job_id))
+            except FileNotFoundError :
+                continue
+            N_collected += 1
+        return N_collected
+
+    def fail(self, job, error, backoff=True) :
+        " Retry the job later (exponential backoff) or mark it as failed if out of attempts "
+        job["error"] = error
+        if job["attempts"] < self.max_attempts :
+            job["not_before"] = time.time() + self.backoff * 2 ** (job["attempts"] - 1) if backoff else 0
+            return self._move(job, "running", "pending")
+        return self._move(job, "running", "failed")
+
+    def requeue_stale(self, heartbeat_timeout=None, backoff=True) :
+        """ Running jobs without a heartbeat for heartbeat_timeout seconds are lost (the worker crashed)
+            and are retried (after the backoff, if backoff). Returns the number of requeued jobs.
+        """
+        if heartbeat_timeout is None :
+            heartbeat_timeout = self.heartbeat_timeout
+
+        N_requeued = 0
+        now = time.time()
+        for job in self.jobs("running") :
+            try :
+                heartbeat = self._filename("running", job["id"]).stat().st_mtime
+            except FileNotFoundError :
+                continue
+            if now - heartbeat >= heartbeat_timeout :
+                self.fail(job, f"Lost the heartbeat of worker {job['worker']}", backoff=backoff)
+                N_requeued += 1
+        return N_requeued
+
+    def next_retry_time(self) :
+        " Earliest time a pending job can be started, None if nothing is pending "
+        times = [job["not_before"] for job in self.jobs("pending")]
+        return min(times) if times else None
+
+    def __repr__(self) :
+        s_counts = ", ".join(f"{N} {state}" for state, N in self.counts().items())
+        return f"JobQueue(base_dir='{self.base_dir}') with {s_counts}"
+
+
+def job_to_cfg(job) :
+    " The cfg of the job in the same format as the cfgs from utils.generate_cfgs "
+    cfg = utils.DotDict(job["cfg"])
+    cfg = utils.format_cfg(cfg, nb_simulation.spec_cfg)
+    cfg.network = utils.format_cfg(cfg.network, nb_simulation.spec_network)
+    return cfg
+
+
+def job_to_kwargs(job) :
+    " The keyword arguments the job is run with (jobs from before they were saved have none) "
+    return job.get("kwargs") or {}
+
+
+def run_queue(queue, function, num_cores, memory_budget=None, memory_model=None, executor=None, verbose=True) :
+    """ Runs all the pending jobs in the queue (function(cfg, **kwargs of the job)) with the memory-aware scheduler, including the retries
+        of failed jobs, until no jobs are pending. Jobs are claimed before they are run and a heartbeat
+        is kept for them while they wait and run.
+        Yields (cfg, stats) of the jobs which succeeded, in the order they finish.
+    """
+    while True :
+
+        jobs = {job["id"] : job for job in queue.claim()}
+
+        if len(jobs) == 0 :
+            t_next = queue.next_retry_time()
+            if t_next is None :
+                break
+            if verbose :
+                print(f"Waiting {t_next - time.time():.0f} s to retry failed jobs", flush=True)
+            time.sleep(max(t_next - time.time(), 0))
+            continue
+
+        cfgs = [job_to_cfg(job) for job in jobs.values()]
+        kwargs = [job_to_kwargs(job) for job in jobs.values()]
+        heartbeat = lambda : queue.heartbeat(jobs.values())
+
+        for cfg, cfg_out, stats in scheduler.run_jobs(function, cfgs, num_cores, memory_budget, memory_model, heartbeat=heartbeat, executor=executor, verbose=verbose, kwargs=kwargs) :
+            job = jobs.pop(JobQueue.job_id(cfg))
+
+            if "error" in stats :
+                if verbose :
+                    print(f"Job {job['id']} failed (attempt {job['attempts']}) :\n{stats['error']}", flush=True)
+                queue.fail(job, stats["error"])
+            else :
+                queue.complete(job, cfg_out, stats)
+                yield cfg_out, stats
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # Workers # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def _heartbeat_loop(filename, interval, parent_pid) :
+    # stop when the job changed state or the worker died
+    while os.getppid() == parent_pid :
+        try :
+            os.utime(filename)
+        except FileNotFoundError :
+            return
+        time.sleep(interval)
+
+
+class Heartbeat :
+    """
+    Keeps the heartbeat of a running job while the worker is busy with it.
+    The heartbeat is kept by a separate process, such that it does not depend on the job releasing the GIL :
+    nb_simulation.run_simulation does (it is nogil), but the generation and loading of the network does not.
+    """
+
+    def __init__(self, queue, job, interval=60) :
+        self.filename = str(queue._filename("running", job["id"]))
+        self.interval = interval
+
+    def __enter__(self) :
+        self.process = mp.Process(target=_heartbeat_loop, args=(self.filename, self.interval, os.getpid()), daemon=True)
+        self.process.start()
+        return self
+
+    def __exit__(self, *args) :
+        self.process.terminate()
+        self.process.join()
+
+
+def _complete_when_saved(queue, job, cfg, stats, saves) :
+    """ Mark the job as done once its results are saved (the futures saves, the ones which succeeded
+        before this was submitted are already gone, see ResultWriter.futures_since), or as failed if they could not be
+    """
+    errors = result_writer.get_errors(saves)
+    if len(errors) > 0 :
+        queue.fail(job, "\n".join(errors))
+    else :
+        queue.complete(job, cfg, stats)
+
+
+def work(queue, function, poll_interval=30, wait_for_jobs=False, heartbeat_interval=60, verbose=True, writer=None) :
+    """ Worker loop : claims one job at a time from the queue, runs function(cfg, **kwargs of the job) and marks the job as done
+        (with the returned cfg and the measured stats) or failed. Any number of workers, on any number of
+        nodes sharing the queue directory, can run at the same time. Lost jobs of crashed workers are requeued.
+        Stops when no jobs are pending, unless wait_for_jobs. Returns the number of finished jobs.
+        If function saves its results through writer (result_writer.ResultWriter), the job is marked as done
+        by the writer, after the results are saved.
+    """
+    worker = get_worker_name()
+    N_done = 0
+    stats_all = []
+
+    while True :
+        queue.requeue_stale()
+
+        jobs = queue.claim(worker, N_max=1)
+
+        if len(jobs) == 0 :
+            if queue.counts()["pending"] == 0 and not wait_for_jobs :
+                break
+            time.sleep(poll_interval)
+            continue
+
+        job = jobs[0]
+        if verbose :
+            print(f"{worker} : running job {job['id']} (attempt {job['attempts']})", flush=True)
+
+        i_first_save = writer.N_submitted if writer is not None else 0
+        with Heartbeat(queue, job, heartbeat_interval) :
+            cfg_out, stats = scheduler.run_job(function, job_to_cfg(job), job_to_kwargs(job))
+
+        if "error" in stats :
+            if verbose :
+                print(f"{worker} : job {job['id']} failed :\n{stats['error']}", flush=True)
+            queue.fail(job, stats["error"])
+        elif writer is not None :
+            writer.submit(_complete_when_saved, queue, job, cfg_out, stats, writer.futures_since(i_first_save))
+            stats_all.append(stats)
+            N_done += 1
+        else :
+            queue.complete(job, cfg_out, stats)
+            stats_all.append(stats)
+            N_done += 1
+
+    print(f"{worker} : no more jobs. {scheduler.summarize_job_stats(stats_all)}", flush=True)
+
+    return N_done
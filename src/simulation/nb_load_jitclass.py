@@ -1,6 +1,4 @@
 import numpy as np
-import pandas as pd
-import h5py
 from importlib import reload
 import pickle
 import numba as nb
@@ -10,6 +8,9 @@ from numba.typed import List, Dict
 from src.utils import utils
 from src.simulation import nb_simulation
 
+pd = utils.lazy_import("pandas")
+h5py = utils.lazy_import("h5py")
+
 # hdf5_kwargs = dict(track_order=True)
 
 #%%
@@ -61,9 +62,9 @@ def save_jitclass_hdf5ready(f, jitclass_hdf5ready):
         if isinstance(val, dict):
             group = f.create_group(key)
             for k, v in val.items():
-                group.create_dataset(k, data=v)
+                utils.create_compressed_dataset(group, k, v)
         else:
-            f.create_dataset(key, data=val)
+            utils.create_compressed_dataset(f, key, val)
 
 
 # save_jitclass_hdf5ready(filename, d_out)
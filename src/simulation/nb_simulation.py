@@ -156,7 +156,9 @@ nb_cfg_network_type = Network.class_type.instance_type
 
 def initialize_nb_cfg(obj, cfg, spec) :
     for key, val in cfg.items() :
-        if isinstance(val, list) :
+        if utils.is_matrix_ref(val) :
+            val = np.array(utils.load_matrix(val), dtype=spec[key].dtype.name)
+        elif isinstance(val, list) :
             if isinstance(spec[key], nb.types.ListType) :
                 val = List(val)
             elif isinstance(spec[key], nb.types.Array) :
@@ -1077,87 +1079,95 @@ def nb_random_choice(arr, prob, size=1, replace=False, verbose=False) :
                 out.add(x)
         return set_to_array(out)
 
+@njit
+def _max_heap_sift_down(keys, indices, i) :
+    N = len(keys)
+    while True :
+        largest = i
+        left = 2 * i + 1
+        right = 2 * i + 2
+        if left < N and keys[left] > keys[largest] :
+            largest = left
+        if right < N and keys[right] > keys[largest] :
+            largest = right
+        if largest == i :
+            return
+        keys[i], keys[largest] = keys[largest], keys[i]
+        indices[i], indices[largest] = indices[largest], indices[i]
+        i = largest
+
+
+@njit
+def weighted_random_choice_without_replacement(arr, weights, size) :
+    """ Weighted random sample of size elements from arr without replacement.
+        Uses the exponential keys of Efraimidis & Spirakis : every element gets the key
+        -log(U) / weight and the size elements with the smallest keys are chosen.
+        The chosen keys are kept in a max-heap, which makes it a single O(len(arr) log(size))
+        pass with no renormalisation of the probabilities after each draw.
+        Parameters :
+            arr (array) : 1D array of values to sample from
+            weights (array) : 1D array of non-negative (unnormalised) weights for the values in arr
+            size (int) : number of values to draw
+    """
+
+    assert len(arr) == len(weights)
+
+    keys = np.full(size, np.inf, dtype=np.float64)
+    indices = np.full(size, -1, dtype=np.int64)
+
+    for i in range(len(arr)) :
+        if weights[i] <= 0 :
+            continue
+        key = -np.log(np.random.rand()) / weights[i]
+        if key < keys[0] :
+            keys[0] = key
+            indices[0] = i
+            _max_heap_sift_down(keys, indices, 0)
+
+    if size > 0 and np.min(indices) < 0 :
+        raise AssertionError("Fewer values with positive weight than the number of values to draw")
+
+    return arr[indices]
+
+
 @njit
 def exp_func(x, a, b, c) :
 
     return a * np.exp(b * x) + c
+
+
 @njit
-def make_random_initial_infections(my, possible_agents) :
+def initial_infection_degree_weight(number_of_contacts) :
+    """ Default weight for choosing an agent as initially infected, as a function of its number of contacts.
+        Exponential fit (reproduces the previously hardcoded table for 0-199 contacts within 0.2%)
+    """
+    return exp_func(number_of_contacts, 2.681464, 0.046055, 4.423330)
+
+
+@njit
+def make_random_initial_infections(my, possible_agents, N, degree_weights) :
+    """ Choose N random initial agents from possible_agents.
+        If my.cfg.weighted_random_initial_infections the agents are weighted by degree_weights[number of contacts].
+    """
     if my.cfg.weighted_random_initial_infections :
-        probs =np.array([7.09189651e+00, 7.21828639e+00, 7.35063322e+00, 7.48921778e+00,
-           7.63433406e+00, 7.78628991e+00, 7.94540769e+00, 8.11202496e+00,
-           8.28649517e+00, 8.46918845e+00, 8.66049237e+00, 8.86081276e+00,
-           9.07057458e+00, 9.29022282e+00, 9.52022345e+00, 9.76106439e+00,
-           1.00132566e+01, 1.02773350e+01, 1.05538598e+01, 1.08434177e+01,
-           1.11466230e+01, 1.14641189e+01, 1.17965788e+01, 1.21447081e+01,
-           1.25092454e+01, 1.28909638e+01, 1.32906734e+01, 1.37092218e+01,
-           1.41474972e+01, 1.46064292e+01, 1.50869914e+01, 1.55902033e+01,
-           1.61171325e+01, 1.66688966e+01, 1.72466664e+01, 1.78516673e+01,
-           1.84851830e+01, 1.91485573e+01, 1.98431976e+01, 2.05705774e+01,
-           2.13322397e+01, 2.21298006e+01, 2.29649517e+01, 2.38394649e+01,
-           2.47551954e+01, 2.57140858e+01, 2.67181702e+01, 2.77695789e+01,
-           2.88705421e+01, 3.00233956e+01, 3.12305849e+01, 3.24946711e+01,
-           3.38183358e+01, 3.52043869e+01, 3.66557650e+01, 3.81755489e+01,
-           3.97669627e+01, 4.14333825e+01, 4.31783434e+01, 4.50055472e+01,
-           4.69188701e+01, 4.89223712e+01, 5.10203005e+01, 5.32171087e+01,
-           5.55174561e+01, 5.79262227e+01, 6.04485185e+01, 6.30896942e+01,
-           6.58553529e+01, 6.87513617e+01, 7.17838642e+01, 7.49592935e+01,
-           7.82843861e+01, 8.17661957e+01, 8.54121088e+01, 8.92298599e+01,
-           9.32275478e+01, 9.74136534e+01, 1.01797057e+02, 1.06387058e+02,
-           1.11193393e+02, 1.16226259e+02, 1.21496331e+02, 1.27014792e+02,
-           1.32793346e+02, 1.38844253e+02, 1.45180349e+02, 1.51815076e+02,
-           1.58762509e+02, 1.66037386e+02, 1.73655140e+02, 1.81631931e+02,
-           1.89984681e+02, 1.98731110e+02, 2.07889773e+02, 2.17480099e+02,
-           2.27522433e+02, 2.38038079e+02, 2.49049344e+02, 2.60579589e+02,
-           2.72653273e+02, 2.85296010e+02, 2.98534620e+02, 3.12397188e+02,
-           3.26913121e+02, 3.42113214e+02, 3.58029713e+02, 3.74696383e+02,
-           3.92148580e+02, 4.10423328e+02, 4.29559396e+02, 4.49597378e+02,
-           4.70579783e+02, 4.92551123e+02, 5.15558010e+02, 5.39649249e+02,
-           5.64875947e+02, 5.91291622e+02, 6.18952312e+02, 6.47916695e+02,
-           6.78246218e+02, 7.10005221e+02, 7.43261078e+02, 7.78084340e+02,
-           8.14548879e+02, 8.52732052e+02, 8.92714861e+02, 9.34582126e+02,
-           9.78422665e+02, 1.02432948e+03, 1.07239996e+03, 1.12273608e+03,
-           1.17544463e+03, 1.23063741e+03, 1.28843153e+03, 1.34894957e+03,
-           1.41231994e+03, 1.47867705e+03, 1.54816168e+03, 1.62092124e+03,
-           1.69711008e+03, 1.77688982e+03, 1.86042971e+03, 1.94790698e+03,
-           2.03950719e+03, 2.13542468e+03, 2.23586291e+03, 2.34103497e+03,
-           2.45116395e+03, 2.56648350e+03, 2.68723825e+03, 2.81368437e+03,
-           2.94609011e+03, 3.08473635e+03, 3.22991721e+03, 3.38194069e+03,
-           3.54112929e+03, 3.70782070e+03, 3.88236856e+03, 4.06514315e+03,
-           4.25653221e+03, 4.45694175e+03, 4.66679693e+03, 4.88654292e+03,
-           5.11664591e+03, 5.35759404e+03, 5.60989844e+03, 5.87409437e+03,
-           6.15074229e+03, 6.44042909e+03, 6.74376930e+03, 7.06140644e+03,
-           7.39401435e+03, 7.74229861e+03, 8.10699809e+03, 8.48888646e+03,
-           8.88877386e+03, 9.30750861e+03, 9.74597902e+03, 1.02051153e+04,
-           1.06858914e+04, 1.11893272e+04, 1.17164909e+04, 1.22685006e+04,
-           1.28465275e+04, 1.34517977e+04, 1.40855953e+04, 1.47492649e+04,
-           1.54442143e+04, 1.61719178e+04, 1.69339191e+04, 1.77318349e+04,
-           1.85673577e+04, 1.94422602e+04, 2.03583982e+04, 2.13177153e+04,
-           2.23222466e+04, 2.33741232e+04, 2.44755764e+04, 2.56289429e+04])
-
-        proba = np.zeros(my.cfg_network.N_tot,dtype=np.float64)
-        for agent in range(my.cfg_network.N_tot) :
-            proba[agent] = probs[my.number_of_contacts[agent]]
-        return nb_random_choice(
-            possible_agents,
-            prob=proba,
-            size=my.cfg.N_init,
-            replace=False,
-        )
+        weights = np.zeros(len(possible_agents), dtype=np.float64)
+        for i, agent in enumerate(possible_agents) :
+            weights[i] = degree_weights[my.number_of_contacts[agent]]
+        return weighted_random_choice_without_replacement(possible_agents, weights, N)
     else :
         return np.random.choice(
             possible_agents,
-            size=my.cfg.N_init,
+            size=N,
             replace=False,
         )
 
 
 @njit
-def choose_initial_agents(my, possible_agents, N) :
+def choose_initial_agents(my, possible_agents, N, degree_weights) :
 
     ##  Standard outbreak type, infecting randomly
     if my.cfg.make_random_initial_infections :
-        return make_random_initial_infections(my, possible_agents)
+        return make_random_initial_infections(my, possible_agents, N, degree_weights)
 
     # Local outbreak type, infecting around a point :
     else :
@@ -1179,50 +1189,63 @@ def choose_initial_agents(my, possible_agents, N) :
 
 
 @njit
-def compute_initial_agents_to_infect_from_kommune(
-    my,
-    infected_per_kommune_start,
-    kommune_names,
-    my_kommune,
-    verbose=False,
-) :
+def compute_E_I_ratio(my, contact_number_init=1.05) :
+    """ Ratio used to split the initially infected agents (from kommune data) between the E and I states.
+        contact_number_init is used to estimate how many people are in the E state, from how many found positive.
+    """
+    time_inf = 1 / my.cfg.lambda_I
+    time_e = 1 / my.cfg.lambda_E
+    return contact_number_init * time_e / (contact_number_init * time_e + time_inf)
+
+
+@njit
+def compute_initial_infections_from_kommune_data(my, infected_per_kommune_start, contact_number_init=1.05) :
+    """ Scale the number of positive tests per kommune to the number of agents to infect initially in each kommune.
+        Parameters :
+            my (class) : Class of parameters describing the system
+            infected_per_kommune_start (array) : number of positive tests in each kommune
+            contact_number_init (float) : used to estimate how many people are in the E state, from how many found positive.
+    """
     fraction_found = 0.5  # estimate of size of fraction of positive we find. roughly speaking "mørketallet" is the inverse of this times n_found_positive- TODO : make this a function based on N_daily_test, tracking_rates and symptomatics
-    contact_number_init = (
-        1.05  # used to estimate how many people are in the E state, from how many found positive.
-    )
     N_tot_frac = my.cfg_network.N_tot / 5_800_000
     time_inf = 1 / my.cfg.lambda_I
     time_e = 1 / my.cfg.lambda_E
     norm_factor = contact_number_init / fraction_found * N_tot_frac * (1 + time_e / time_inf)
 
-    initial_agents_to_infect = List()
-    # num_infected = 0
+    initial_infections_per_kommune = np.zeros(len(infected_per_kommune_start), dtype=np.int64)
+    for ith_kommune, num_of_infected_in_kommune in enumerate(infected_per_kommune_start) :
+        initial_infections_per_kommune[ith_kommune] = np.int64(np.ceil(num_of_infected_in_kommune * norm_factor))
+    return initial_infections_per_kommune
 
-    for num_of_infected_in_kommune, kommune in zip(infected_per_kommune_start, kommune_names) :
-        num_of_infected_normed = np.int32(np.ceil(num_of_infected_in_kommune * norm_factor))
-        if verbose :
-            print(
-                "kommune",
-                kommune,
-                "num_infected",
-                num_of_infected_normed,
-                "non normed",
-                num_of_infected_in_kommune,
-            )
-        list_of_agent_in_kommune = List()
-        for agent, agent_kommune in zip(range(my.cfg_network.N_tot), my_kommune) :
-            if kommune == agent_kommune :
-                list_of_agent_in_kommune.append(agent)
-        if num_of_infected_normed != 0 :
+
+@njit
+def choose_initial_agents_from_labels(initial_infections_per_label, agents_in_label_offsets, agents_in_label, verbose=False) :
+    """ Choose initial_infections_per_label[i] random agents among the agents with label i (without replacement).
+        The agents with label i are agents_in_label[agents_in_label_offsets[i] : agents_in_label_offsets[i+1]].
+        Uses a partial Fisher-Yates shuffle inside each label, so the cost of the shuffles is proportional to
+        the number of chosen agents. The shuffles are done on a copy, so agents_in_label (which is cached,
+        see Simulation._get_agents_in_kommune) is unchanged and the same seed gives the same agents.
+    """
+    agents_in_label = agents_in_label.copy()
+    initial_agents_to_infect = np.zeros(np.sum(initial_infections_per_label), dtype=np.uint32)
+
+    N = 0
+    for label, N_label in enumerate(initial_infections_per_label) :
+        start = agents_in_label_offsets[label]
+        N_agents_in_label = agents_in_label_offsets[label + 1] - start
+
+        if N_label > N_agents_in_label :
             if verbose :
-                print("kommune", kommune, "num_infected", num_of_infected_normed)
-            liste = np.random.choice(
-                np.asarray(list_of_agent_in_kommune), size=num_of_infected_normed, replace=False
-            )
-            for entry in liste :
-                initial_agents_to_infect.append(entry)
-    E_I_ratio = contact_number_init * time_e / (contact_number_init * time_e + time_inf)
-    return initial_agents_to_infect, E_I_ratio
+                print("label", label, "has only", N_agents_in_label, "agents,", N_label, "were requested to be infected")
+            N_label = N_agents_in_label
+
+        for k in range(N_label) :
+            j = start + k + np.random.randint(N_agents_in_label - k)
+            agents_in_label[start + k], agents_in_label[j] = agents_in_label[j], agents_in_label[start + k]
+            initial_agents_to_infect[N] = agents_in_label[start + k]
+            N += 1
+
+    return initial_agents_to_infect[:N]
 
 
 @njit
@@ -1264,6 +1287,7 @@ def initialize_states(
     agents_in_state,
     agents_in_age_group,
     initial_ages_exposed,
+    degree_weights,
     #N_infectious_states,
     N_states,
     verbose=False) :
@@ -1281,7 +1305,7 @@ def initialize_states(
 
     if my.cfg.R_init > 0 :
 
-        initial_agents_to_immunize = choose_initial_agents(my, possible_agents, my.cfg.R_init)
+        initial_agents_to_immunize = choose_initial_agents(my, possible_agents, my.cfg.R_init, degree_weights)
 
         #  Now make initial immunizations
         for _, agent in enumerate(initial_agents_to_immunize) :
@@ -1294,7 +1318,7 @@ def initialize_states(
 
         update_infection_list_for_newly_infected_agent(my, g, agent)
 
-    initial_agents_to_infect   = choose_initial_agents(my, possible_agents, my.cfg.N_init)
+    initial_agents_to_infect   = choose_initial_agents(my, possible_agents, my.cfg.N_init, degree_weights)
 
     #  Now make initial infections
     for _, agent in enumerate(initial_agents_to_infect) :
@@ -1414,48 +1438,40 @@ def initialize_states(
 
 
 @njit
-def make_initial_infections_from_kommune_data(
+def make_initial_infections_from_labels(
     my,
     g,
     state_total_counts,
     agents_in_state,
     SIR_transition_rates,
-    agents_in_age_group,
-    initial_ages_exposed,
-    # N_infectious_states,
     N_states,
-    infected_per_kommune_ints,
-    kommune_names,
-    my_kommune,
+    initial_infections_per_label,
+    agents_in_label_offsets,
+    agents_in_label,
     verbose=False,
 ) :
+    """ Make the initial infections from a seeding vector, e.g. number of infected per kommune or grid cell.
+        Parameters :
+            initial_infections_per_label (array) : number of agents to infect with each label
+            agents_in_label_offsets, agents_in_label : the agents with each label (CSR layout, see utils.compute_agents_in_label)
+    """
 
-    # version 2 has age groups
-    if my.cfg.version >= 2 :
-        possible_agents = List()
-        for age_exposed in initial_ages_exposed :
-            for agent in agents_in_age_group[age_exposed] :
-                possible_agents.append(agent)
-        possible_agents = np.asarray(possible_agents, dtype=np.uint32)
-    # version 1 has no age groups
-    else :
-        possible_agents = np.arange(my.cfg_network.N_tot, dtype=np.uint32)
-
-    initial_agents_to_infect, E_I_ratio = compute_initial_agents_to_infect_from_kommune(
-        my,
-        infected_per_kommune_ints,
-        kommune_names,
-        my_kommune,
+    initial_agents_to_infect = choose_initial_agents_from_labels(
+        initial_infections_per_label,
+        agents_in_label_offsets,
+        agents_in_label,
         verbose,
     )
+    E_I_ratio = compute_E_I_ratio(my)
+
     # initial_agents_to_infect.flatten()
     g.total_sum_of_state_changes = 0.0
 
     ##  Now make initial infections
     for _, agent in enumerate(initial_agents_to_infect) :
-        new_state = np.random.randint(N_states - 1)  # E1-E4 or I1-I4, uniformly distributed
+        new_state = np.random.randint((N_states - 1) // 2)  # E1-E4 or I1-I4, uniformly distributed
         if np.random.rand() < E_I_ratio :
-            new_state += 4
+            new_state += (N_states - 1) // 2
         my.state[agent] = new_state
 
         agents_in_state[new_state].append(np.uint32(agent))
@@ -1601,12 +1617,75 @@ def update_infection_list_for_newly_infected_agent(my, g, agent_getting_infected
 # # # # # # # # # # # # # # # # SIMULATION  # # # # # # # # # # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+# The output levels of a simulation, i.e. what run_simulation records (and Simulation.save writes) :
+#   summary       : the counts (states, variants and age groups) at every sampled time (10 times per day),
+#                   which the analysis (e.g. helpers.aggregate_array) assumes for every level
+#   timeseries    : as summary, and the daily counts per state, kommune, age group and variant (see count_daily_aggregates)
+#   spatial_daily : as timeseries, and the state of every agent each day (my_state)
+#   full          : as spatial_daily, and the daily R_true and freedom impact
+OUTPUT_SUMMARY = 0
+OUTPUT_TIMESERIES = 1
+OUTPUT_SPATIAL_DAILY = 2
+OUTPUT_FULL = 3
+
+output_levels = {
+    "summary" : OUTPUT_SUMMARY,
+    "timeseries" : OUTPUT_TIMESERIES,
+    "spatial_daily" : OUTPUT_SPATIAL_DAILY,
+    "full" : OUTPUT_FULL,
+}
+
+
+# Set to True (before the simulation is compiled) to recount the daily aggregates from the state of every agent
+# each day and check them against the counts updated at the state transitions (see update_daily_aggregates)
+DEBUG_DAILY_AGGREGATES = False
+
+
+@njit
+def count_daily_aggregates(my, kommune, N_kommuner, N_states, N_ages, N_variants) :
+    """ Number of agents in each state, kommune, age group and variant, shape (N_states + 1, N_kommuner, N_ages, N_variants).
+        The susceptible agents (state -1) are in the first row, state i in row i + 1.
+    """
+    counts = np.zeros((N_states + 1, N_kommuner, N_ages, N_variants), dtype=np.int64)
+    for agent in range(my.cfg_network.N_tot) :
+        counts[my.state[agent] + 1, kommune[agent], my.age[agent], my.corona_type[agent]] += 1
+    return counts
+
+
+@njit
+def update_daily_aggregates(counts, my, kommune, agent, change) :
+    """ Adds change to the count of the current state, kommune, age group and variant of agent (see count_daily_aggregates).
+        Called with -1 before and +1 after the state (or variant) of agent changes.
+    """
+    counts[my.state[agent] + 1, kommune[agent], my.age[agent], my.corona_type[agent]] += change
+
 
 @njit
+def check_daily_aggregates(counts, my, kommune) :
+    " Checks the counts against a recount from the state of every agent, see DEBUG_DAILY_AGGREGATES "
+    N_states, N_kommuner, N_ages, N_variants = counts.shape
+    if not np.all(counts == count_daily_aggregates(my, kommune, N_kommuner, N_states - 1, N_ages, N_variants)) :
+        raise AssertionError("The daily aggregates differ from the recount of the state of every agent")
+
+
+@njit
+def _grow_output_buffers(out_time, out_counts) :
+    " Copies of the output buffers with twice the number of rows "
+    N = 2 * len(out_time)
+    out_time_new = np.zeros(N, dtype=out_time.dtype)
+    out_counts_new = np.zeros((N, out_counts.shape[1]), dtype=out_counts.dtype)
+    out_time_new[: len(out_time)] = out_time
+    out_counts_new[: len(out_time)] = out_counts
+    return out_time_new, out_counts_new
+
+
+# nogil, such that the results of the previous simulation can be saved in the background (see result_writer)
+@njit(nogil=True)
 def run_simulation(
     my,
     g,
     intervention,
+    event_grid,
     SIR_transition_rates,
     state_total_counts,
     variant_counts,
@@ -1615,17 +1694,30 @@ def run_simulation(
     N_states,
     N_infectious_states,
     nts,
-    verbose=False) :
+    kommune,
+    verbose=False,
+    output_level=OUTPUT_FULL) :
 
     if verbose :
         print("Apply intervention", intervention.apply_interventions)
 
     # Define outputs
-    out_time = List()                       # Sampled times
-    out_state_counts = List()               # Tne counts of the SEIR states
-    out_variant_counts = List()             # The counts of viral strains
-    out_infected_per_age_group = List()     # The counts of infected per age group
+    # The sampled times and the counts at each of them : the SEIR states, the viral strains and
+    # the infected per age group (in that order). Preallocated for 10 samples per day, grown if day_max is 0 (no limit)
+    N_states_out = len(state_total_counts)
+    N_variants_out = len(variant_counts)
+    N_samples_max = 10 * (my.cfg.day_max + 2) if my.cfg.day_max > 0 else 1000
+    out_time = np.zeros(N_samples_max, dtype=np.float64)
+    out_counts = np.zeros((N_samples_max, N_states_out + N_variants_out + len(infected_per_age_group)), dtype=np.uint32)
+    N_samples = 0
+
     out_my_state = List()
+    out_daily_counts = List()               # The counts per state, kommune, age group and variant, each day
+
+    N_kommuner = kommune.max() + 1
+
+    # The number of agents in each state, kommune, age group and variant, updated at every state transition
+    daily_aggregates = count_daily_aggregates(my, kommune, N_kommuner, len(state_total_counts), len(infected_per_age_group), len(variant_counts))
 
     daily_counter = 0
     day = 0
@@ -1672,7 +1764,9 @@ def run_simulation(
             agents_in_state[state_after].append(agent)
             agents_in_state[state_now].remove(agent)
 
+            update_daily_aggregates(daily_aggregates, my, kommune, agent, -1)
             my.state[agent] += 1
+            update_daily_aggregates(daily_aggregates, my, kommune, agent, 1)
 
             state_total_counts[state_now]   -= 1
             state_total_counts[state_after] += 1
@@ -1749,9 +1843,11 @@ def run_simulation(
                                 where_infections_happened_counter[
                                     my.connections_type[agent][ith_contact]
                                 ] += 1
+                                update_daily_aggregates(daily_aggregates, my, kommune, contact, -1)
                                 my.state[contact] = 0
 
                                 my.corona_type[contact] = my.corona_type[agent]
+                                update_daily_aggregates(daily_aggregates, my, kommune, contact, 1)
 
                                 agents_in_state[0].append(np.uint32(contact))
                                 state_total_counts[0] += 1
@@ -1785,13 +1881,17 @@ def run_simulation(
         while nts * click  < real_time :
 
             daily_counter += 1
-            if ((len(out_time) == 0) or (real_time != out_time[-1])) and day >= 0 :
+            if ((N_samples == 0) or (real_time != out_time[N_samples - 1])) and day >= 0 :
+
+                if N_samples == len(out_time) :
+                    out_time, out_counts = _grow_output_buffers(out_time, out_counts)
 
                 # Update the output variables
-                out_time.append(real_time)
-                out_state_counts.append(state_total_counts.copy())
-                out_variant_counts.append(variant_counts.copy())
-                out_infected_per_age_group.append(infected_per_age_group.copy())
+                out_time[N_samples] = real_time
+                out_counts[N_samples, : N_states_out] = state_total_counts
+                out_counts[N_samples, N_states_out : N_states_out + N_variants_out] = variant_counts
+                out_counts[N_samples, N_states_out + N_variants_out :] = infected_per_age_group
+                N_samples += 1
 
             if daily_counter >= 10 :
 
@@ -1826,11 +1926,14 @@ def run_simulation(
                     add_daily_events(
                         my,
                         g,
+                        event_grid,
                         day,
                         agents_in_state,
                         state_total_counts,
                         SIR_transition_rates,
-                        where_infections_happened_counter)
+                        where_infections_happened_counter,
+                        daily_aggregates,
+                        kommune)
 
 
                 if verbose :
@@ -1841,9 +1944,15 @@ def run_simulation(
                     print("R_true_list_brit : ", np.round(intervention.R_true_list_brit[-1], 3))
 
 
-                if day >= 0 :
+                if day >= 0 and output_level >= OUTPUT_TIMESERIES :
+                    if DEBUG_DAILY_AGGREGATES :
+                        check_daily_aggregates(daily_aggregates, my, kommune)
+                    out_daily_counts.append(daily_aggregates.astype(np.uint32))
+
+                if day >= 0 and output_level >= OUTPUT_SPATIAL_DAILY :
                     out_my_state.append(my.state.copy())
 
+                if day >= 0 and output_level >= OUTPUT_FULL :
                     intervention.R_true_list.append(calculate_R_True(my, g))
                     intervention.freedom_impact_list.append(calculate_population_freedom_impact(intervention))
                     intervention.R_true_list_brit.append(calculate_R_True_brit(my, g))
@@ -1890,8 +1999,7 @@ def run_simulation(
         # print("N_daily_tests", intervention.N_daily_tests)
         # print("N_positive_tested", N_positive_tested)
 
-    return out_time, out_state_counts, out_variant_counts, out_infected_per_age_group, out_my_state, intervention
-    #return out_time, out_state_counts, out_variant_counts, out_my_state, intervention
+    return out_time[: N_samples], out_counts[: N_samples], out_my_state, out_daily_counts, intervention
 
 
 #%%
@@ -2043,14 +2151,12 @@ def initialize_tents(my, N_tents) :
     for i in range(N_tents) :
         tent_positions[i] = my.coordinates[np.random.randint(N_tot)]
 
+    closest_tents = utils.assign_to_nearest_facility(my.coordinates, tent_positions)
+
     tent_counter = np.zeros(N_tents, np.uint32)
     for agent in range(N_tot) :
-        distances = np.array(
-            [utils.haversine_scipy(my.coordinates[agent], p_tent) for p_tent in tent_positions]
-        )
-        closest_tent = np.argmin(distances)
-        my.tent[agent] = closest_tent
-        tent_counter[closest_tent] += 1
+        my.tent[agent] = closest_tents[agent]
+        tent_counter[closest_tents[agent]] += 1
 
     return tent_positions, tent_counter
 
@@ -2890,15 +2996,207 @@ def test_tagged_agents(my, g, intervention, day, click) :
 #
 
 
+spec_event_grid = {
+    "N_tot" : nb.uint32,
+    "rho" : nb.float64,
+    "epsilon_rho" : nb.float64,
+    "max_distance" : nb.float64,
+    "lon_min" : nb.float64,
+    "lat_min" : nb.float64,
+    "d_lon" : nb.float64,
+    "d_lat" : nb.float64,
+    "N_lon" : nb.int64,
+    "N_lat" : nb.int64,
+    "N_lon_neighbours" : nb.int64,
+    "N_lat_neighbours" : nb.int64,
+    "cell_offsets" : nb.int64[:],
+    "cell_agents" : nb.uint32[:],
+    "infected_at_event" : nb.boolean[:],
+}
+
+
+@jitclass(spec_event_grid)
+class EventGrid(object) :
+    """
+    - cell_offsets, cell_agents : agents sorted by grid cell (CSR layout).
+        The agents in cell c are cell_agents[cell_offsets[c] : cell_offsets[c+1]]
+        and cell c = i_lat * N_lon + i_lon.
+
+    - d_lon, d_lat : size of a grid cell in degrees (roughly cell_size x cell_size km)
+
+    - rho : characteristic inverse distance of the event kernel exp(-rho * dist)
+
+    - epsilon_rho : fraction of guests that are drawn independent of distance
+
+    - max_distance : cells further away than this (in km) are ignored by the kernel,
+        since exp(-rho * max_distance) = kernel_cutoff
+
+    - infected_at_event : bitmap of agents that got infected at any event on the current day
+
+    """
+
+    def __init__(self, my, cell_size=2.0, rho=0.5, epsilon_rho=0.04, kernel_cutoff=1e-4) :
+
+        self.N_tot = my.cfg_network.N_tot
+        self.rho = rho
+        self.epsilon_rho = epsilon_rho
+        self.max_distance = -np.log(kernel_cutoff) / rho
+
+        lon = my.coordinates[:, 0]
+        lat = my.coordinates[:, 1]
+
+        km_per_degree = 6367 * np.pi / 180
+        self.lon_min = np.min(lon)
+        self.lat_min = np.min(lat)
+        self.d_lat = cell_size / km_per_degree
+        self.d_lon = self.d_lat / np.cos(np.radians(np.mean(lat)))
+        self.N_lon = np.int64((np.max(lon) - self.lon_min) / self.d_lon) + 1
+        self.N_lat = np.int64((np.max(lat) - self.lat_min) / self.d_lat) + 1
+
+        # the cells are narrowest (in km) at the northernmost latitude
+        lon_width_min = self.d_lon * km_per_degree * np.cos(np.radians(np.max(lat)))
+        self.N_lon_neighbours = np.int64(np.ceil(self.max_distance / lon_width_min))
+        self.N_lat_neighbours = np.int64(np.ceil(self.max_distance / cell_size))
+
+        # Counting sort of the agents into the grid cells
+        N_cells = self.N_lon * self.N_lat
+        cells = np.zeros(self.N_tot, dtype=np.int64)
+        self.cell_offsets = np.zeros(N_cells + 1, dtype=np.int64)
+        for agent in range(self.N_tot) :
+            cells[agent] = self._cell(my.coordinates[agent, 0], my.coordinates[agent, 1])
+            self.cell_offsets[cells[agent] + 1] += 1
+        self.cell_offsets = np.cumsum(self.cell_offsets)
+
+        fill = self.cell_offsets[:-1].copy()
+        self.cell_agents = np.zeros(self.N_tot, dtype=np.uint32)
+        for agent in range(self.N_tot) :
+            self.cell_agents[fill[cells[agent]]] = agent
+            fill[cells[agent]] += 1
+
+        self.infected_at_event = np.zeros(self.N_tot, dtype=nb.boolean)
+
+    def _lon_index(self, lon) :
+        return min(max(np.int64((lon - self.lon_min) / self.d_lon), 0), self.N_lon - 1)
+
+    def _lat_index(self, lat) :
+        return min(max(np.int64((lat - self.lat_min) / self.d_lat), 0), self.N_lat - 1)
+
+    def _cell(self, lon, lat) :
+        return self._lat_index(lat) * self.N_lon + self._lon_index(lon)
+
+    def _neighbouring_cells(self, lon, lat) :
+        """ Find the non-empty cells within max_distance of (lon, lat) together with
+            the largest possible kernel value of any agent in each cell (upper bound).
+        """
+        i_lon = self._lon_index(lon)
+        i_lat = self._lat_index(lat)
+
+        N_max = (2 * self.N_lat_neighbours + 1) * (2 * self.N_lon_neighbours + 1)
+        cells = np.zeros(N_max, dtype=np.int64)
+        kernel_max = np.zeros(N_max, dtype=np.float64)
+
+        N = 0
+        for j_lat in range(max(i_lat - self.N_lat_neighbours, 0), min(i_lat + self.N_lat_neighbours + 1, self.N_lat)) :
+            lat_low = self.lat_min + j_lat * self.d_lat
+            lat_closest = min(max(lat, lat_low), lat_low + self.d_lat)
+            for j_lon in range(max(i_lon - self.N_lon_neighbours, 0), min(i_lon + self.N_lon_neighbours + 1, self.N_lon)) :
+                cell = j_lat * self.N_lon + j_lon
+                if self.cell_offsets[cell + 1] == self.cell_offsets[cell] :
+                    continue
+                lon_low = self.lon_min + j_lon * self.d_lon
+                lon_closest = min(max(lon, lon_low), lon_low + self.d_lon)
+                distance_min = utils.haversine(lon, lat, lon_closest, lat_closest)
+                if distance_min > self.max_distance :
+                    continue
+                cells[N] = cell
+                kernel_max[N] = np.exp(-self.rho * distance_min)
+                N += 1
+
+        return cells[:N], kernel_max[:N]
+
+    def sample_guests(self, my, event_id, event_size) :
+        """ Draw event_size guests for an event placed at agent event_id.
+            Each agent is drawn with a probability proportional to
+            epsilon_rho + (1 - epsilon_rho) * exp(-rho * dist(event_id, agent)),
+            which is the same distribution as drawing random agents and accepting
+            them with my.dist_accepted(event_id, agent, rho) or epsilon_rho.
+            Instead of trying random agents from the whole population, a cell is drawn
+            by its (upper bound) kernel weight and the agent is accepted with the
+            ratio between its own kernel value and the upper bound.
+        """
+        lon = my.coordinates[event_id, 0]
+        lat = my.coordinates[event_id, 1]
+        cells, kernel_max = self._neighbouring_cells(lon, lat)
+
+        cell_weights = np.zeros(len(cells), dtype=np.float64)
+        for i, cell in enumerate(cells) :
+            cell_weights[i] = (self.cell_offsets[cell + 1] - self.cell_offsets[cell]) * kernel_max[i]
+        cumulative_weights = np.cumsum(cell_weights)
+
+        weight_uniform = self.epsilon_rho * self.N_tot
+        weight_kernel = 0.0
+        if len(cells) > 0 :
+            weight_kernel = (1 - self.epsilon_rho) * cumulative_weights[-1]
+
+        guests = np.zeros(event_size, dtype=np.uint32)
+        N_guests = 0
+        while N_guests < event_size :
+
+            # distance independent guest
+            if np.random.rand() * (weight_uniform + weight_kernel) < weight_uniform :
+                guests[N_guests] = np.random.randint(self.N_tot)
+                N_guests += 1
+                continue
+
+            # distance dependent guest
+            i = np.searchsorted(cumulative_weights, np.random.rand() * cumulative_weights[-1], side="right")
+            cell = cells[i]
+            N_in_cell = self.cell_offsets[cell + 1] - self.cell_offsets[cell]
+            guest = self.cell_agents[self.cell_offsets[cell] + np.random.randint(N_in_cell)]
+            if np.random.rand() * kernel_max[i] < np.exp(-self.rho * my.dist(event_id, guest)) :
+                guests[N_guests] = guest
+                N_guests += 1
+
+        return guests
+
+
+@njit
+def compute_event_infection_probability(my, guests, event_duration) :
+    """ Probability that a susceptible guest gets infected at an event.
+        Each infectious guest is in contact with the susceptible guest for a time uniformly
+        distributed in [0, event_duration] and infects with probability
+        min(infection_weight * time * event_beta_scaling, 1). The average of this over time is
+        the probability q of being infected by that guest, so the total exposure is the product
+        of (1 - q) over all infectious guests, found in a single pass over the guests.
+        Parameters :
+            my (class) : Class of parameters describing the system
+            guests (array) : agents at the event
+            event_duration (float) : duration of the event in days
+    """
+    log_not_infected = 0.0
+    for agent in guests :
+        if my.agent_is_infectious(agent) :
+            c = my.infection_weight[agent] * event_duration * my.cfg.event_beta_scaling
+            if c <= 1 :
+                q = c / 2
+            else :
+                q = 1 - 1 / (2 * c)
+            log_not_infected += np.log1p(-q)
+    return 1 - np.exp(log_not_infected)
+
+
 @njit
 def add_daily_events(
     my,
     g,
+    event_grid,
     day,
     agents_in_state,
     state_total_counts,
     SIR_transition_rates,
     where_infections_happened_counter,
+    daily_aggregates,
+    kommune,
 ) :
     N_tot = my.cfg_network.N_tot
     event_size_max = my.cfg.event_size_max
@@ -2912,8 +3210,6 @@ def add_daily_events(
             my.cfg.N_events * my.cfg.event_weekend_multiplier
         )  #  randomness x XXX
 
-    # agents_in_event = List()
-
     agents_getting_infected_at_any_event = List()
 
     for _ in range(my.cfg.N_events) :
@@ -2926,33 +3222,31 @@ def add_daily_events(
 
         event_id = np.random.randint(N_tot)
 
-        agents_in_this_event = List()
-        while len(agents_in_this_event) < event_size :
-            guest = np.random.randint(N_tot)
-            rho_tmp = 0.5
-            epsilon_rho_tmp = 4 / 100
-            if my.dist_accepted(event_id, guest, rho_tmp) or np.random.rand() < epsilon_rho_tmp :
-                agents_in_this_event.append(np.uint32(guest))
+        agents_in_this_event = event_grid.sample_guests(my, event_id, event_size)
 
-        # extract all agents that are infectious and then
-        for agent in agents_in_this_event :
-            if my.agent_is_infectious(agent) :
-                for guest in agents_in_this_event :
-                    if guest != agent and my.agent_is_susceptible(guest) :
-                        time = np.random.uniform(0, event_duration)
-                        probability = my.infection_weight[agent] * time * my.cfg.event_beta_scaling
-                        if np.random.rand() < probability :
-                            if guest not in agents_getting_infected_at_any_event :
-                                agents_getting_infected_at_any_event.append(np.uint32(guest))
+        # the exposure is the same for all susceptible guests
+        probability = compute_event_infection_probability(my, agents_in_this_event, event_duration)
+        if probability == 0 :
+            continue
+
+        for guest in agents_in_this_event :
+            if my.agent_is_susceptible(guest) and not event_grid.infected_at_event[guest] :
+                if np.random.rand() < probability :
+                    event_grid.infected_at_event[guest] = True
+                    agents_getting_infected_at_any_event.append(np.uint32(guest))
 
     for agent_getting_infected_at_event in agents_getting_infected_at_any_event :
 
+        event_grid.infected_at_event[agent_getting_infected_at_event] = False
+
         # XXX this update was needed
+        update_daily_aggregates(daily_aggregates, my, kommune, agent_getting_infected_at_event, -1)
         my.state[agent_getting_infected_at_event] = 0
+        update_daily_aggregates(daily_aggregates, my, kommune, agent_getting_infected_at_event, 1)
         where_infections_happened_counter[3] += 1
         agents_in_state[0].append(np.uint32(agent_getting_infected_at_event))
         state_total_counts[0] += 1
         g.total_sum_of_state_changes += SIR_transition_rates[0]
         g.cumulative_sum_of_state_changes += SIR_transition_rates[0]
 
-        update_infection_list_for_newly_infected_agent(my, g, agent_getting_infected_at_event)
\ No newline at end of file
+        update_infection_list_for_newly_infected_agent(my, g, agent_getting_infected_at_event)
@@ -0,0 +1,119 @@
+import atexit
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from src.utils import utils
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # Result writer # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+class ResultWriter :
+    """
+    Saves the results of the simulations in a background thread, such that the next simulation can start
+    while the results of the previous one are converted and written (see run_single_simulation(writer=...)).
+    The tasks (e.g. Simulation.save and then simulation.update_database) are run one at a time in the order
+    they are submitted. The simulation itself releases the GIL (nb_simulation.run_simulation is nogil),
+    so the writing overlaps with it.
+
+    - max_pending : the number of tasks which can wait to be written, submit blocks while there are more
+      (back-pressure, each pending save keeps the results of a simulation in memory)
+
+    All the tasks are run before close returns, which is called when leaving the with-block and at exit.
+    futures only keeps the tasks which are running, waiting or failed (until the next flush),
+    each future has the index of its task (the number of tasks submitted before it), see futures_since.
+    """
+
+    def __init__(self, max_pending=2) :
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ResultWriter")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.N_submitted = 0
+        self.closed = False
+        atexit.register(self.close)
+
+    def _release(self, future) :
+        # the futures of succeeded tasks are not needed anymore
+        if future.exception() is None :
+            with self.lock :
+                if future in self.futures :
+                    self.futures.remove(future)
+        self.slots.release()
+
+    def submit(self, function, *args, **kwargs) :
+        " Run function(*args, **kwargs) in the background, returns its future. Blocks while max_pending tasks are waiting "
+        if self.closed :
+            raise AssertionError("The ResultWriter is closed")
+        self.slots.acquire()
+        with self.lock :
+            future = self.executor.submit(function, *args, **kwargs)
+            future.index = self.N_submitted
+            self.N_submitted += 1
+            self.futures.append(future)
+        future.add_done_callback(self._release)
+        return future
+
+    def futures_since(self, index) :
+        " The futures of the tasks submitted since index (N_submitted at the time) which are not done or have failed "
+        with self.lock :
+            return [future for future in self.futures if future.index >= index]
+
+    def flush(self) :
+        """ Wait for all the submitted tasks. Raises the first exception of the tasks since the last flush,
+            if any of them failed (which has not been handled by the submitter, see job_queue.work)
+        """
+        with self.lock :
+            futures, self.futures = self.futures, []
+        wait(futures)
+        for future in futures :
+            if future.exception() is not None and not getattr(future, "handled", False) :
+                raise future.exception()
+
+    def close(self) :
+        " Flush and stop the background thread "
+        if self.closed :
+            return None
+        self.closed = True
+        try :
+            self.flush()
+        finally :
+            self.executor.shutdown(wait=True)
+            atexit.unregister(self.close)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
+
+    def __repr__(self) :
+        N_pending = sum(not future.done() for future in self.futures)
+        return f"ResultWriter with {N_pending} pending tasks (max {self.max_pending})"
+
+
+def get_errors(futures) :
+    " The tracebacks of the failed tasks (futures), which are then marked as handled (see ResultWriter.flush) "
+    errors = []
+    for future in futures :
+        exception = future.exception()
+        if exception is not None :
+            future.handled = True
+            errors.append("".join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+    return errors
+
+
+_thread_local = threading.local()
+
+
+def get_thread_db_cfg(path="Output/db.sqlite") :
+    " The database, with a connection of the calling thread (SQLite connections can only be used in the thread that made them) "
+    if getattr(_thread_local, "db_cfg", None) is None or _thread_local.db_cfg.path != path :
+        _thread_local.db_cfg = utils.get_db_cfg(path)
+    return _thread_local.db_cfg
@@ -0,0 +1,335 @@
+import numpy as np
+import os
+import time
+import resource
+import traceback
+import multiprocessing as mp
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from tqdm import tqdm
+
+from src.utils import utils
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # Memory usage  # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def get_total_memory() :
+    "Physical memory of the node in bytes"
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def reset_peak_memory() :
+    """ Resets the peak memory (VmHWM) of the current process, such that the peak of the next job
+        can be measured in a reused worker process. Only possible on Linux.
+    """
+    try :
+        with open("/proc/self/clear_refs", "w") as f :
+            f.write("5")
+        return True
+    except OSError :
+        return False
+
+
+def get_peak_memory() :
+    "Peak memory (resident set size) of the current process in bytes"
+    try :
+        with open("/proc/self/status", "r") as f :
+            for line in f :
+                if line.startswith("VmHWM:") :
+                    return int(line.split()[1]) * 1024
+    except OSError :
+        pass
+    # ru_maxrss is in kilobytes on Linux, is never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryModel :
+    """
+    Linear model of the peak memory of a single simulation (in bytes) :
+
+        peak = c_0 + c_1 * N_tot + c_2 * N_tot * mu + c_3 * N_tot * (day_max + 1)
+
+    The terms are : the python process and compiled code, the per-agent arrays,
+    the contacts and the daily output of the state of every agent (out_my_state).
+    The coefficients are fitted to the measured peaks of earlier runs (see from_job_stats),
+    and default to rough estimates when there are too few of these.
+
+    - safety_factor : the estimates are multiplied by this factor when scheduling
+    """
+
+    default_coefficients = np.array([500e6, 1000.0, 60.0, 1.0])
+
+    def __init__(self, coefficients=None, safety_factor=1.25) :
+        if coefficients is None :
+            coefficients = self.default_coefficients
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.safety_factor = safety_factor
+        self.N_calibration_jobs = 0
+
+    @staticmethod
+    def features(N_tot, mu, day_max) :
+        return np.array([1.0, N_tot, N_tot * mu, N_tot * (day_max + 1)], dtype=float)
+
+    @classmethod
+    def cfg_to_features(cls, cfg) :
+        return cls.features(cfg.network.N_tot, cfg.network.mu, cfg.day_max)
+
+    @classmethod
+    def from_job_stats(cls, job_stats, min_jobs=10, **kwargs) :
+        """ Fit the coefficients to the measured peak memory of earlier jobs.
+            Parameters :
+                job_stats (list of dicts) : with the keys N_tot, mu, day_max and peak_memory
+                min_jobs (int) : use the default coefficients if fewer jobs have been measured
+        """
+        model = cls(**kwargs)
+        job_stats = [stats for stats in job_stats if stats.get("peak_memory")]
+
+        if len(job_stats) < min_jobs :
+            return model
+
+        X = np.array([cls.features(stats["N_tot"], stats["mu"], stats["day_max"]) for stats in job_stats])
+        y = np.array([stats["peak_memory"] for stats in job_stats], dtype=float)
+
+        # Only fit the terms that vary between the jobs, keep the default for the rest
+        coefficients = model.coefficients.copy()
+        varies = np.ptp(X, axis=0) > 0
+        varies[0] = True
+        fit, *_ = np.linalg.lstsq(X[:, varies], y - X[:, ~varies] @ coefficients[~varies], rcond=None)
+        coefficients[varies] = np.clip(fit, 0, None)
+
+        model.coefficients = coefficients
+        model.N_calibration_jobs = len(job_stats)
+        return model
+
+    def estimate(self, cfg) :
+        "Estimated peak memory in bytes of the simulation of cfg (including the safety factor)"
+        return self.safety_factor * float(self.cfg_to_features(cfg) @ self.coefficients)
+
+    def __repr__(self) :
+        s_coefficients = ", ".join(f"{c:.3g}" for c in self.coefficients)
+        return f"{type(self).__name__}(coefficients=[{s_coefficients}], calibrated on {self.N_calibration_jobs} jobs)"
+
+
+class NetworkMemoryModel(MemoryModel) :
+    """
+    Linear model of the peak memory of generating (and saving) a network, see MemoryModel :
+
+        peak = c_0 + c_1 * N_tot + c_2 * N_tot * mu
+
+    There is no daily output, but the contacts are kept twice while the network is converted to be saved.
+    """
+
+    default_coefficients = np.array([500e6, 1000.0, 120.0])
+
+    @staticmethod
+    def features(N_tot, mu, day_max=None) :
+        return np.array([1.0, N_tot, N_tot * mu], dtype=float)
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # Scheduler # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+def run_job(function, cfg, kwargs=None) :
+    """ Runs function(cfg, **kwargs) in a worker and measures the peak memory and time of the job.
+        function can either return out or (out, timings), where timings is a dict with the time
+        spent in each step. If it contains time_simulation, the rest of the time of the job
+        is saved as time_overhead.
+        If the job fails, out is None and the traceback is returned as stats["error"]
+    """
+    reset_peak_memory()
+    t_start = time.time()
+    stats = {}
+    try :
+        out = function(cfg, **(kwargs or {}))
+        if isinstance(out, tuple) :
+            out, timings = out
+            stats.update(timings)
+    except Exception :
+        out = None
+        stats["error"] = traceback.format_exc()
+    stats.update({
+        "N_tot" : cfg.network.N_tot,
+        "mu" : cfg.network.mu,
+        "day_max" : cfg.day_max,
+        "peak_memory" : get_peak_memory(),
+        "time_elapsed" : time.time() - t_start,
+        "finished" : time.time(),
+    })
+    if "time_simulation" in stats :
+        stats["time_overhead"] = stats["time_elapsed"] - stats["time_simulation"]
+    return out, stats
+
+
+def summarize_job_stats(stats) :
+    " Average time of the simulations and of the overhead (network, initial states, saving etc.) of the jobs "
+    stats = [stat for stat in stats if "time_simulation" in stat]
+    if len(stats) == 0 :
+        return "No finished jobs"
+    time_simulation = np.mean([stat["time_simulation"] for stat in stats])
+    time_overhead = np.mean([stat["time_overhead"] for stat in stats])
+    fraction = time_overhead / (time_simulation + time_overhead)
+    return (
+        f"{len(stats)} jobs : on average {time_simulation:.1f} s simulating and "
+        f"{time_overhead:.1f} s overhead per job ({fraction:.1%} of the time)"
+    )
+
+
+def _create_pool(**pool_kwargs) :
+    " ProcessPoolExecutor which remembers its arguments, such that it can be recreated if it breaks (see run_jobs) "
+    executor = ProcessPoolExecutor(**pool_kwargs)
+    executor.pool_kwargs = pool_kwargs
+    return executor
+
+
+def create_worker_pool(num_cores, warm_up=None, verbose=True) :
+    """ Pool of worker processes which are kept alive across jobs (see run_jobs).
+        warm_up is a function which compiles the numba code. With the fork start method, the code
+        is compiled once in this process and inherited by all the workers, otherwise each worker
+        compiles it when it starts. Either way it is not part of the time of the jobs.
+    """
+    if warm_up is None :
+        return _create_pool(max_workers=num_cores)
+
+    if "fork" in mp.get_all_start_methods() :
+        time_warm_up = warm_up()
+        if verbose :
+            print(f"Compiled in {time_warm_up:.1f} s", flush=True)
+        return _create_pool(max_workers=num_cores, mp_context=mp.get_context("fork"))
+
+    return _create_pool(max_workers=num_cores, initializer=warm_up)
+
+
+def _broken_job_stats(exception) :
+    " The stats of a job whose worker died, e.g. killed by the OOM killer "
+    error = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+    return {"error" : f"The worker running the job died (e.g. killed for using too much memory) :\n{error}", "finished" : time.time()}
+
+
+class Utilisation :
+    " Keeps track of the fraction of the cores and the memory budget in use over time "
+
+    def __init__(self, num_cores, memory_budget) :
+        self.num_cores = num_cores
+        self.memory_budget = memory_budget
+        self.t_start = self.t_last = time.time()
+        self.core_seconds = 0.0
+        self.memory_seconds = 0.0
+
+    def update(self, cores_in_use, memory_in_use) :
+        t = time.time()
+        self.core_seconds += cores_in_use * (t - self.t_last)
+        self.memory_seconds += memory_in_use * (t - self.t_last)
+        self.t_last = t
+
+    def report(self) :
+        duration = max(self.t_last - self.t_start, 1e-9)
+        core_utilisation = self.core_seconds / (duration * self.num_cores)
+        memory_utilisation = self.memory_seconds / (duration * self.memory_budget)
+        return (
+            f"Used {core_utilisation:.1%} of {self.num_cores} cores and "
+            f"{memory_utilisation:.1%} of the {self.memory_budget / 1e9:.1f} GB memory budget (estimated) "
+            f"during {utils.format_time(duration)}"
+        )
+
+
+def run_jobs(function, cfgs, num_cores, memory_budget=None, memory_model=None, heartbeat=None, heartbeat_interval=60, executor=None, verbose=True, kwargs=None) :
+    """ Runs function(cfg) for all cfgs in parallel, such that the estimated peak memory of the running jobs
+        stays below memory_budget and at most num_cores jobs run at a time.
+        The largest jobs are started first and the smaller jobs fill the gaps.
+        Yields (cfg, function(cfg), stats) in the order the jobs finish, where stats contains the measured
+        peak memory and time of the job, and the traceback as stats["error"] if the job failed.
+        If a worker dies (e.g. killed by the OOM killer), the jobs running in the pool fail
+        and the rest of the jobs are run in a new pool.
+
+        Parameters :
+            function (callable) : function of a single cfg, must be picklable (e.g. a partial of a module function)
+            cfgs (list) : the cfgs to run
+            num_cores (int) : maximum number of simultaneous jobs
+            memory_budget (float) : in bytes, defaults to 90% of the memory of the node
+            memory_model (MemoryModel) : used to estimate the peak memory of the jobs
+            heartbeat (callable) : called every heartbeat_interval seconds while the jobs are running
+            executor (ProcessPoolExecutor) : reuse the workers of this pool (see create_worker_pool),
+                otherwise a new pool is used for these jobs
+            kwargs (list of dicts) : keyword arguments of function for each of the cfgs
+    """
+
+    if memory_budget is None :
+        memory_budget = 0.9 * get_total_memory()
+
+    if memory_model is None :
+        memory_model = MemoryModel()
+
+    estimates = [memory_model.estimate(cfg) for cfg in cfgs]
+    pending = sorted(range(len(cfgs)), key=lambda i : estimates[i], reverse=True)
+
+    for i in pending :
+        if estimates[i] > memory_budget :
+            print(f"Warning: cfg {cfgs[i].hash} is estimated to use {estimates[i] / 1e9:.1f} GB, "
+                  f"more than the memory budget. It will be run on its own.", flush=True)
+
+    utilisation = Utilisation(num_cores, memory_budget)
+    running = {}
+    memory_in_use = 0.0
+
+    if executor is None :
+        executor = _create_pool(max_workers=num_cores)
+        pools_to_close = [executor]
+    else :
+        pools_to_close = []
+
+    try :
+        with tqdm(total=len(cfgs), disable=not verbose) as pbar :
+            while pending or running :
+
+                # Start as many of the pending jobs as possible, largest first
+                for i in list(pending) :
+                    if len(running) >= num_cores :
+                        break
+                    if memory_in_use + estimates[i] <= memory_budget or len(running) == 0 :
+                        try :
+                            future = executor.submit(run_job, function, cfgs[i], kwargs[i] if kwargs is not None else None)
+                        except BrokenProcessPool :
+                            # a worker died, the jobs of the old pool fail (below) and the rest run in a new pool
+                            if verbose :
+                                print("A worker died, restarting the worker pool", flush=True)
+                            executor.shutdown(wait=False)
+                            executor = _create_pool(**getattr(executor, "pool_kwargs", dict(max_workers=num_cores)))
+                            pools_to_close.append(executor)
+                            future = executor.submit(run_job, function, cfgs[i], kwargs[i] if kwargs is not None else None)
+                        running[future] = i
+                        memory_in_use += estimates[i]
+                        pending.remove(i)
+
+                utilisation.update(len(running), memory_in_use)
+                done, _ = wait(running, timeout=heartbeat_interval, return_when=FIRST_COMPLETED)
+                utilisation.update(len(running), memory_in_use)
+
+                if heartbeat is not None :
+                    heartbeat()
+
+                for future in done :
+                    i = running.pop(future)
+                    memory_in_use -= estimates[i]
+                    pbar.update(1)
+                    try :
+                        out, stats = future.result()
+                    except BrokenProcessPool as e :
+                        out, stats = None, _broken_job_stats(e)
+                    stats["estimated_peak_memory"] = estimates[i]
+                    yield cfgs[i], out, stats
+    finally :
+        for pool in pools_to_close :
+            pool.shutdown(wait=True)
+
+    if verbose :
+        print(utilisation.report(), flush=True)
@@ -5,12 +5,11 @@ import numpy as np
 # import matplotlib.pyplot as plt TODO : Delete line
 from pathlib import Path
 # import multiprocessing as mp TODO : Delete line
-import h5py
 # from resource import getrusage, RUSAGE_SELF TODO : Delete line
 import warnings
+import time
 # from importlib import reload TODO : Delete line
 import os
-from IPython.display import display
 from contexttimer import Timer
 
 # import yaml TODO : Delete line
@@ -28,10 +27,9 @@ from numba.core.errors import (
 )
 
 
-from tinydb import TinyDB, Query
 from tqdm import tqdm
 from functools import partial
-from p_tqdm import p_umap, p_uimap
+from contextlib import nullcontext
 
 # import awkward as awkward0  # conda install awkward0, conda install -c conda-forge pyarrow    TODO : Delete line
 # import awkward1 as ak  # pip install awkward1 TODO : Delete line
@@ -49,18 +47,40 @@ while True :
 from src.utils import utils
 from src.simulation import nb_simulation
 from src.simulation import nb_load_jitclass
+from src.simulation import scheduler
+from src.simulation import job_queue
+from src.simulation import cost_model
+from src.simulation import result_writer
 from src import file_loaders
+from src import ensemble_store
+from src import timeseries_store
+
+h5py = utils.lazy_import("h5py")
 
 
 hdf5_kwargs = dict(track_order=True)
 np.set_printoptions(linewidth=200)
 
+# Number of initialized networks kept in memory by each process, the least recently used is dropped first
+# (see Simulation._load_initialized_network). The key is the filename and modification time of the network file
+network_cache_size = 1
+network_cache = {}
+
 
 class Simulation :
 
-    def __init__(self, cfg, verbose=False) :
+    def __init__(self, cfg, verbose=False, output_level="full") :
+        """ output_level (see nb_simulation.output_levels) sets what is recorded and saved :
+            summary only saves the time series (at every sampled time), timeseries also the daily counts
+            per state, kommune, age group and variant, spatial_daily also saves the daily state of every agent and full everything.
+            The output level is not part of the cfg (and its hash), so use force_rerun to get more output of a simulation.
+        """
+
+        if output_level not in nb_simulation.output_levels :
+            raise AssertionError(f"output_level must be one of {list(nb_simulation.output_levels)}, got {output_level}")
 
         self.verbose = verbose
+        self.output_level = output_level
 
         self.cfg = cfg.deepcopy()
         self.cfg.pop("hash")
@@ -127,8 +147,8 @@ class Simulation :
                 self.my,
                 N_ages,
                 mu_counter,
-                np.array(self.cfg.network.work_matrix),
-                np.array(self.cfg.network.other_matrix),
+                np.array(utils.load_matrix(self.cfg.network.work_matrix)),
+                np.array(utils.load_matrix(self.cfg.network.other_matrix)),
                 agents_in_age_group,
                 verbose=self.verbose)
 
@@ -152,10 +172,9 @@ class Simulation :
     def _save_initialized_network(self, filename) :
         if self.verbose :
             print(f"Saving initialized network to {filename}", flush=True)
-        utils.make_sure_folder_exist(filename)
         my_hdf5ready = nb_load_jitclass.jitclass_to_hdf5_ready_dict(self.my)
 
-        with h5py.File(filename, "w", **hdf5_kwargs) as f :
+        with utils.atomic_write(filename) as filename_tmp, h5py.File(filename_tmp, "w", **hdf5_kwargs) as f :
             group_my = f.create_group("my")
             nb_load_jitclass.save_jitclass_hdf5ready(group_my, my_hdf5ready)
             utils.NestedArray(self.agents_in_age_group).add_to_hdf5_file(f, "agents_in_age_group")
@@ -165,14 +184,32 @@ class Simulation :
     def _load_initialized_network(self, filename) :
         if self.verbose :
             print(f"Loading previously initialized network, please wait", flush=True)
-        with h5py.File(filename, "r") as f :
-            self.agents_in_age_group = utils.NestedArray.from_hdf5(
-                f, "agents_in_age_group"
-            ).to_nested_numba_lists()
-            self.N_ages = f["N_ages"][()]
-
-            my_hdf5ready = nb_load_jitclass.load_jitclass_to_dict(f["my"])
-            self.my = nb_load_jitclass.load_My_from_dict(my_hdf5ready, self.cfg)
+
+        # Networks are kept in memory, such that a worker running several simulations
+        # on the same network only reads it once (a regenerated network file has a new modification time)
+        key = (filename, os.path.getmtime(filename))
+        if key not in network_cache :
+            with h5py.File(filename, "r") as f :
+                agents_in_age_group = utils.NestedArray.from_hdf5(f, "agents_in_age_group")
+                N_ages = f["N_ages"][()]
+                my_hdf5ready = nb_load_jitclass.load_jitclass_to_dict(f["my"])
+
+            while len(network_cache) >= network_cache_size > 0 :
+                network_cache.pop(next(iter(network_cache)))
+            if network_cache_size > 0 :
+                network_cache[key] = (agents_in_age_group, N_ages, my_hdf5ready)
+        else :
+            # most recently used last
+            network_cache[key] = network_cache.pop(key)
+            agents_in_age_group, N_ages, my_hdf5ready = network_cache[key]
+
+        # The simulation changes the arrays of my, so never use the cached ones directly. Only the arrays are copied,
+        # the nested arrays (e.g. the connections) are converted to new numba lists by load_My_from_dict anyway
+        my_hdf5ready = {key : val.copy() if isinstance(val, np.ndarray) else val for key, val in my_hdf5ready.items()}
+        self.agents_in_age_group = agents_in_age_group.to_nested_numba_lists()
+        self.N_ages = N_ages
+        self.my = nb_load_jitclass.load_My_from_dict(my_hdf5ready, self.cfg)
+
         self.df_coordinates = utils.load_df_coordinates(self.N_tot, self.cfg.network.ID)
 
         # Update connection weights
@@ -213,7 +250,29 @@ class Simulation :
         elif not only_initialize_network :
             self._load_initialized_network(filename)
 
-    def initialize_states(self) :
+    def _get_agents_in_kommune(self) :
+        """ Kommune names and the agents in each kommune (CSR layout). Computed once and reused """
+        if not hasattr(self, "agents_in_kommune") :
+            self.kommune_labels, self.kommune_names = utils.df_coordinates_to_kommune_labels(self.df_coordinates)
+            self.agents_in_kommune = utils.compute_agents_in_label(self.kommune_labels, len(self.kommune_names))
+        return self.agents_in_kommune
+
+    def initialize_states(self, degree_weight_function=None, initial_infections_per_label=None, labels=None) :
+        """ Make the initial infections.
+            degree_weight_function : function mapping an array of number of contacts to the (unnormalised)
+            weight of being chosen as initially infected. Only used with cfg.weighted_random_initial_infections.
+            Defaults to nb_simulation.initial_infection_degree_weight
+            initial_infections_per_label : seeding vector, number of agents to infect initially with each label,
+            e.g. per kommune or per grid cell. If given, it is used instead of cfg.make_initial_infections_at_kommune
+            and the random initial infections.
+            labels : integer label of each agent, indexing initial_infections_per_label (which must then be given).
+            Defaults to the kommune index of the agents (ordered as self.kommune_names)
+        """
+        if labels is not None :
+            if initial_infections_per_label is None :
+                raise ValueError("labels requires initial_infections_per_label, the number of agents to infect with each label")
+            if len(labels) != self.N_tot :
+                raise ValueError(f"labels must have a label for each of the {self.N_tot} agents, got {len(labels)}")
         utils.set_numba_random_seed(utils.hash_to_seed(self.hash))
 
         if self.verbose :
@@ -237,28 +296,40 @@ class Simulation :
         self.SIR_transition_rates = utils.initialize_SIR_transition_rates(
             self.N_states, self.N_infectious_states, self.cfg
         )
-        if self.cfg.make_initial_infections_at_kommune :
-            infected_per_kommune_ints, kommune_names, my_kommune = file_loaders.load_kommune_data(self.df_coordinates)
+        if self.cfg.make_initial_infections_at_kommune or initial_infections_per_label is not None :
 
             if self.cfg.R_init > 0 :
                 raise ValueError("R_init not implemented when using kommune configuration")
 
-            nb_simulation.make_initial_infections_from_kommune_data(
+            if labels is None :
+                agents_in_label = self._get_agents_in_kommune()
+            else :
+                agents_in_label = utils.compute_agents_in_label(labels, len(initial_infections_per_label))
+
+            if initial_infections_per_label is None :
+                infected_per_kommune = file_loaders.load_kommune_data(self.kommune_names)
+                initial_infections_per_label = nb_simulation.compute_initial_infections_from_kommune_data(self.my, infected_per_kommune)
+
+            nb_simulation.make_initial_infections_from_labels(
                 self.my,
                 self.g,
                 self.state_total_counts,
                 self.agents_in_state,
                 self.SIR_transition_rates,
-                self.agents_in_age_group,
-                self.initial_ages_exposed,
-                # self.N_infectious_states,
                 self.N_states,
-                infected_per_kommune_ints,
-                kommune_names,
-                my_kommune,
+                np.asarray(initial_infections_per_label, dtype=np.int64),
+                agents_in_label.offsets,
+                agents_in_label.content,
                 verbose=self.verbose)
 
         else :
+            if degree_weight_function is None :
+                degree_weight_function = nb_simulation.initial_infection_degree_weight
+
+            # Weights are computed once per number of contacts and looked up per agent
+            degrees = np.arange(np.max(self.my.number_of_contacts) + 1)
+            degree_weights = np.asarray(degree_weight_function(degrees), dtype=np.float64)
+
             nb_simulation.initialize_states(
                 self.my,
                 self.g,
@@ -269,6 +340,7 @@ class Simulation :
                 self.agents_in_state,
                 self.agents_in_age_group,
                 self.initial_ages_exposed,
+                degree_weights,
                 #self.N_infectious_states,
                 self.N_states,
                 verbose=self.verbose)
@@ -313,10 +385,14 @@ class Simulation :
             other_matrix_restrict = np.array(other_matrix_restrict),
             verbose=verbose_interventions)
 
+        # Spatial grid used to draw the guests of the daily events
+        self.event_grid = nb_simulation.EventGrid(self.my)
+
         res = nb_simulation.run_simulation(
             self.my,
             self.g,
             self.intervention,
+            self.event_grid,
             self.SIR_transition_rates,
             self.state_total_counts,
             self.variant_counts,
@@ -325,16 +401,17 @@ class Simulation :
             self.N_states,
             self.N_infectious_states,
             self.nts,
-            self.verbose)
+            np.asarray(self.df_coordinates["idx"].values, dtype=np.int64),
+            self.verbose,
+            nb_simulation.output_levels[self.output_level])
 
 
-        out_time, out_state_counts, out_variant_counts, out_infected_per_age_group, out_my_state, intervention = res
-        #out_time, out_state_counts, out_variant_counts, out_my_state, intervention = res
+        out_time, out_counts, out_my_state, out_daily_counts, intervention = res
 
         self.out_time = out_time
         self.my_state = np.array(out_my_state)
-        self.df = utils.counts_to_df(out_time, out_state_counts, out_variant_counts, out_infected_per_age_group)
-        #self.df = utils.counts_to_df(out_time, out_state_counts, out_variant_counts)
+        self.daily_counts = np.array(out_daily_counts)
+        self.df = utils.counts_to_df(out_time, out_counts, len(self.state_total_counts), len(self.variant_counts))
         self.intervention = intervention
 
         return self.df
@@ -356,21 +433,35 @@ class Simulation :
 
         utils.add_cfg_to_hdf5_file(f, cfg)
 
-    def _save_dataframe(self, save_csv=False, save_hdf5=True) :
+    def _save_dataframe(self, save_csv=False, save_hdf5=True, save_parquet=False) :
 
         # Save CSV
         if save_csv :
             filename_csv = self._get_filename(name="ABM", filetype="csv")
-            utils.make_sure_folder_exist(filename_csv)
-            self.df.to_csv(filename_csv, index=False)
+            with utils.atomic_write(filename_csv) as filename_tmp :
+                self.df.to_csv(filename_tmp, index=False)
 
         if save_hdf5 :
             filename_hdf5 = self._get_filename(name="ABM", filetype="hdf5")
-            utils.make_sure_folder_exist(filename_hdf5)
-            with h5py.File(filename_hdf5, "w", **hdf5_kwargs) as f :  #
-                f.create_dataset("df", data=utils.dataframe_to_hdf5_format(self.df))
+            with utils.atomic_write(filename_hdf5) as filename_tmp, h5py.File(filename_tmp, "w", **hdf5_kwargs) as f :  #
+                utils.create_compressed_dataset(f, "df", utils.dataframe_to_hdf5_format(self.df))
+                self._save_daily_counts(f)
                 self._add_cfg_to_hdf5_file(f)
 
+        # Save Parquet (see timeseries_store)
+        if save_parquet :
+            timeseries_store.write_run(self.df, self.hash, self.cfg.network.ID)
+
+        return None
+
+    def _save_daily_counts(self, f) :
+        " The daily counts per state, kommune, age group and variant (see nb_simulation.count_daily_aggregates) "
+        if self.daily_counts.ndim != 5 :
+            return None
+        # read one day at a time
+        dataset = utils.create_compressed_dataset(f, "daily_counts", self.daily_counts, chunks=(1, *self.daily_counts.shape[1:]))
+        dataset.attrs["axes"] = ["day", "state", "kommune", "age_group", "variant"]
+        dataset.attrs["state_offset"] = 1  # state i (-1 is susceptible) is at index i + 1
         return None
 
     def _save_simulation_results(self, save_only_ID_0=False, time_elapsed=None) :
@@ -379,20 +470,21 @@ class Simulation :
             return None
 
         filename_hdf5 = self._get_filename(name="network", filetype="hdf5")
-        utils.make_sure_folder_exist(filename_hdf5)
-
-        with h5py.File(filename_hdf5, "w", **hdf5_kwargs) as f :  #
-            f.create_dataset("my_state", data=self.my_state)
-            f.create_dataset("my_corona_type", data=self.my.corona_type)
-            f.create_dataset("my_number_of_contacts", data=self.my.number_of_contacts)
-            f.create_dataset("day_found_infected", data=self.intervention.day_found_infected)
-            f.create_dataset("coordinates", data=self.my.coordinates)
-            # import ast; ast.literal_eval(str(cfg))
-            f.create_dataset("cfg_str", data=str(self.cfg))
-            f.create_dataset("R_true", data=self.intervention.R_true_list)
-            f.create_dataset("freedom_impact", data=self.intervention.freedom_impact_list)
-            f.create_dataset("R_true_brit", data=self.intervention.R_true_list_brit)
-            f.create_dataset("df", data=utils.dataframe_to_hdf5_format(self.df))
+
+        with utils.atomic_write(filename_hdf5) as filename_tmp, h5py.File(filename_tmp, "w", **hdf5_kwargs) as f :  #
+            # my_state is read one day (row) at a time
+            utils.create_compressed_dataset(f, "my_state", self.my_state, chunks=(1, self.my_state.shape[1]) if self.my_state.ndim == 2 else True)
+            utils.create_compressed_dataset(f, "my_corona_type", self.my.corona_type)
+            utils.create_compressed_dataset(f, "day_found_infected", self.intervention.day_found_infected)
+            utils.create_compressed_dataset(f, "coordinates", self.my.coordinates)
+            if self.output_level == "full" :
+                utils.create_compressed_dataset(f, "my_number_of_contacts", self.my.number_of_contacts)
+                # import ast; ast.literal_eval(str(cfg))
+                f.create_dataset("cfg_str", data=str(self.cfg))
+                f.create_dataset("R_true", data=self.intervention.R_true_list)
+                f.create_dataset("freedom_impact", data=self.intervention.freedom_impact_list)
+                f.create_dataset("R_true_brit", data=self.intervention.R_true_list_brit)
+            utils.create_compressed_dataset(f, "df", utils.dataframe_to_hdf5_format(self.df))
             # f.create_dataset(
             #     "df_coordinates",
             #     data=utils.dataframe_to_hdf5_format(self.df_coordinates, cols_to_str="kommune"),
@@ -405,10 +497,13 @@ class Simulation :
 
         return None
 
-    def save(self, save_csv=False, save_hdf5=True, save_only_ID_0=False, time_elapsed=None) :
-        self._save_cfg()
-        self._save_dataframe(save_csv=save_csv, save_hdf5=save_hdf5)
-        self._save_simulation_results(save_only_ID_0=save_only_ID_0, time_elapsed=time_elapsed)
+    def save(self, save_csv=False, save_hdf5=True, save_parquet=False, save_only_ID_0=False, time_elapsed=None) :
+        " Save the results, the network file (with the state of every agent) only for the output levels spatial_daily and full "
+        if self.output_level != "summary" :
+            self._save_cfg()
+        self._save_dataframe(save_csv=save_csv, save_hdf5=save_hdf5, save_parquet=save_parquet)
+        if nb_simulation.output_levels[self.output_level] >= nb_simulation.OUTPUT_SPATIAL_DAILY :
+            self._save_simulation_results(save_only_ID_0=save_only_ID_0, time_elapsed=time_elapsed)
 
 
 #%%
@@ -421,7 +516,21 @@ def run_single_simulation(
     only_initialize_network=False,
     save_initial_network=False,
     save_csv=False,
+    save_parquet=False,
+    output_level="full",
+    writer=None,
+    after_save=None,
+    return_timings=False,
 ) :
+    """ Simulate cfg and save the results (what is saved depends on output_level, see Simulation).
+        With a writer (result_writer.ResultWriter), the results are saved in the background
+        and time_save is only the time spent waiting for the writer.
+        after_save(cfg) is called once the results are saved (in the same task of the writer),
+        and not if saving failed, e.g. to add the simulation to the database.
+        If return_timings, also returns the time spent in each step :
+        time_network, time_states, time_simulation (the simulation itself) and time_save
+    """
+    timings = {}
     with Timer() as t, warnings.catch_warnings() :
         if not verbose :
             # ignore warning about run_algo
@@ -429,74 +538,249 @@ def run_single_simulation(
             warnings.simplefilter("ignore", NumbaTypeSafetyWarning)
             # warnings.simplefilter("ignore", NumbaPendingDeprecationWarning)
 
-        simulation = Simulation(cfg, verbose)
+        with Timer() as t_step :
+            simulation = Simulation(cfg, verbose, output_level=output_level)
 
-        simulation.initialize_network(
-            force_rerun=force_rerun, save_initial_network=save_initial_network, only_initialize_network=only_initialize_network
-        )
+            simulation.initialize_network(
+                force_rerun=force_rerun, save_initial_network=save_initial_network, only_initialize_network=only_initialize_network
+            )
+        timings["time_network"] = t_step.elapsed
 
         if only_initialize_network :
-            return None
+            return (None, timings) if return_timings else None
 
-        simulation.initialize_states()
+        with Timer() as t_step :
+            simulation.initialize_states()
+        timings["time_states"] = t_step.elapsed
+
+        with Timer() as t_step :
+            simulation.run_simulation()
+        timings["time_simulation"] = t_step.elapsed
+
+        with Timer() as t_step :
+            save_kwargs = dict(time_elapsed=t.elapsed, save_hdf5=True, save_csv=save_csv, save_parquet=save_parquet)
+            if writer is None :
+                _save(simulation, save_kwargs, after_save, cfg)
+            else :
+                writer.submit(_save, simulation, save_kwargs, after_save, cfg)
+        timings["time_save"] = t_step.elapsed
 
+    return (cfg, timings) if return_timings else cfg
+
+
+def _save(simulation, save_kwargs, after_save=None, cfg=None) :
+    simulation.save(**save_kwargs)
+    if after_save is not None :
+        after_save(cfg)
+
+
+def warm_up(cfg, N_tot=10_000, verbose=False) :
+    """ Compile the numba code by simulating a small version of cfg (nothing is saved),
+        such that the compilation is not part of the first real job. Returns the time it took.
+    """
+    with Timer() as t, warnings.catch_warnings() :
+        if not verbose :
+            warnings.simplefilter("ignore", NumbaExperimentalFeatureWarning)
+            warnings.simplefilter("ignore", NumbaTypeSafetyWarning)
+
+        cfg = utils.DotDict(cfg).deepcopy()
+        cfg.network.N_tot = min(cfg.network.N_tot, N_tot)
+        cfg.N_init = min(cfg.N_init, cfg.network.N_tot // 10)
+        cfg.R_init = min(cfg.R_init, cfg.network.N_tot // 10)
+        # day_max = 0 is no limit
+        cfg.day_max = 2 if cfg.day_max <= 0 else min(cfg.day_max, 2)
+        cfg.hash = utils.cfg_to_hash(cfg)
+
+        simulation = Simulation(cfg, verbose)
+        simulation.initialize_network(force_rerun=True)
+        simulation.initialize_states()
         simulation.run_simulation()
 
-        simulation.save(time_elapsed=t.elapsed, save_hdf5=True, save_csv=save_csv)
+    return t.elapsed
 
-    return cfg
 
+def update_database(db_cfg, cfgs, stats=None, overwrite=False) :
+    """ Insert the cfgs (a single cfg or a list of cfgs) which are not already in the database, and their stats,
+        and add their results to the ensemble stores (see ensemble_store), which deletes their per-run hdf5 files,
+        and to the catalog (see file_loaders.update_catalog). Replicates already in the ensemble stores are only
+        replaced if overwrite (e.g. for reruns).
+    """
+    if isinstance(cfgs, dict) :
+        cfgs = [cfgs]
+        stats = None if stats is None else [stats]
+    db_cfg.insert_multiple(cfgs)
+    if stats :
+        db_cfg.add_job_stats(cfgs, stats)
+    ensemble_store.add_cfgs(cfgs, overwrite=overwrite, db_cfg=db_cfg)
+    file_loaders.update_catalog(db_cfg, cfgs)
 
-def update_database(db_cfg, q, cfg) :
 
-    if not db_cfg.contains((q.hash == cfg.hash) & (q.network.ID == cfg.network.ID)) :
-        db_cfg.insert(cfg)
+def _update_database_from_writer(db_path, cfgs, stats=None, overwrite=False) :
+    " update_database from the thread of a result_writer.ResultWriter, which has its own connection to the database "
+    update_database(result_writer.get_thread_db_cfg(db_path), cfgs, stats, overwrite)
 
 
-def run_simulations(
-        simulation_parameters,
-        N_runs=2,
-        num_cores_max=None,
-        N_tot_max=False,
-        verbose=False,
-        force_rerun=False,
-        dry_run=False,
-        **kwargs) :
+def _update_database_from_queue(queue, db_cfg, cfgs, stats, overwrite=False) :
+    " update_database for the finished jobs (cfgs) of the queue, which are then marked as collected "
+    update_database(db_cfg, cfgs, stats, overwrite)
+    queue.mark_collected([job_queue.JobQueue.job_id(cfg) for cfg in cfgs])
+
+
+def _initialize_networks(cfgs, num_cores, memory_budget, memory_model=None, executor=None, verbose=False, **kwargs) :
+    """ Generate and save the networks of the cfgs, each unique network only once.
+        The memory of the jobs is estimated with memory_model, default scheduler.NetworkMemoryModel
+    """
+    if memory_model is None :
+        memory_model = scheduler.NetworkMemoryModel()
+
+    # Get the network hashes
+    network_hashes = set([utils.cfg_to_hash(cfg.network, exclude_ID=False) for cfg in cfgs])
+
+    # Get list of unique cfgs
+    cfgs_network = []
+    for cfg in cfgs :
+        network_hash = utils.cfg_to_hash(cfg.network, exclude_ID=False)
+
+        if network_hash in network_hashes :
+            cfgs_network.append(cfg)
+            network_hashes.remove(network_hash)
+
+    f_single_network = partial(run_single_simulation, only_initialize_network=True, save_initial_network=True, verbose=verbose, **kwargs)
+
+    for _, _, stats in scheduler.run_jobs(f_single_network, cfgs_network, num_cores, memory_budget, memory_model, executor=executor, verbose=verbose) :
+        if "error" in stats :
+            # the simulation jobs will generate the network themselves (and fail through the queue)
+            print(f"Could not generate network :\n{stats['error']}", flush=True)
+
+
+def _run_queue(queue, db_cfg, num_cores, memory_budget=None, db_batch_size=100, verbose=False, overwrite=False, **kwargs) :
+    " Run the pending jobs in the queue and add the finished ones to the database (in batches) "
+
+    memory_model = scheduler.MemoryModel.from_job_stats(db_cfg.get_job_stats(N_max=1000))
+    if verbose :
+        print(memory_model)
+
+    cfgs = [job_queue.job_to_cfg(job) for job in queue.jobs("pending")]
+    if len(cfgs) == 0 :
+        return None
+
+    # The workers are kept alive for all the jobs (and retries), and the numba code is compiled before the first job
+    with scheduler.create_worker_pool(num_cores, warm_up=partial(warm_up, cfgs[0]), verbose=verbose) as executor :
+
+        # First generate the networks
+        print("Generating networks. Please wait")
+        _initialize_networks(cfgs, num_cores, memory_budget, executor=executor, verbose=verbose, **kwargs)
+
+        # Then run the simulations on the network
+        print("Running simulations. Please wait")
+        f_single_simulation = partial(run_single_simulation, return_timings=True, verbose=verbose, **kwargs)
+
+        cfgs_finished = []
+        stats_finished = []
+        stats_all = []
+        try :
+            for cfg, stats in job_queue.run_queue(queue, f_single_simulation, num_cores, memory_budget, memory_model, executor=executor, verbose=verbose) :
+                cfgs_finished.append(cfg)
+                stats_finished.append(stats)
+                stats_all.append(stats)
+                if len(cfgs_finished) >= db_batch_size :
+                    _update_database_from_queue(queue, db_cfg, cfgs_finished, stats_finished, overwrite)
+                    cfgs_finished = []
+                    stats_finished = []
+        finally :
+            _update_database_from_queue(queue, db_cfg, cfgs_finished, stats_finished, overwrite)
+
+    print(scheduler.summarize_job_stats(stats_all), flush=True)
+
+    counts = queue.counts()
+    if counts["failed"] > 0 :
+        print(f"{counts['failed']} jobs failed, see the tracebacks in {queue.base_dir / 'failed'}", flush=True)
+
+
+def resume_simulations(queue_dir="Output/queue", num_cores_max=None, memory_budget=None, verbose=False, db_batch_size=100, requeue_running=True, **kwargs) :
+    """ Continue an interrupted sweep from the job queue in queue_dir.
+        Finished jobs missing in the database are added, jobs that were running when the sweep
+        was interrupted are started again (unless requeue_running is False, e.g. if workers on other
+        nodes are still running, then only jobs without a heartbeat are started again)
+        and all the pending jobs are run. The jobs are run with the kwargs saved in them (see JobQueue.add),
+        the kwargs given here only apply where a job does not set them.
+    """
+    queue = job_queue.JobQueue(queue_dir)
+    db_cfg = utils.get_db_cfg()
+
+    collect_simulations(queue, db_cfg)
+
+    if requeue_running :
+        N_requeued = queue.requeue_stale(heartbeat_timeout=0, backoff=False)
+    else :
+        N_requeued = queue.requeue_stale()
+
+    print(f"Resuming {queue}, {N_requeued} interrupted jobs were requeued", flush=True)
+
+    num_cores = utils.get_num_cores(num_cores_max)
+    _run_queue(queue, db_cfg, num_cores, memory_budget, db_batch_size, verbose, **kwargs)
+
+    return queue.counts()
+
+
+def _get_cfgs_to_run(db_cfg, simulation_parameters, N_runs=2, N_tot_max=False, force_rerun=False, verbose=False) :
+    " The cfgs of simulation_parameters which are not in the database already (all of them if force_rerun) "
 
     if isinstance(simulation_parameters, dict) :
         simulation_parameters = utils.format_simulation_paramters(simulation_parameters)
         cfgs_all = utils.generate_cfgs(simulation_parameters, N_runs, N_tot_max, verbose=verbose)
 
-        N_tot_max = utils.d_num_cores_N_tot[utils.extract_N_tot_max(simulation_parameters)]
-
     elif isinstance(simulation_parameters[0], utils.DotDict) :
         cfgs_all = simulation_parameters
 
-        N_tot_max = np.max([cfg.network.N_tot for cfg in cfgs_all])
-
     else :
         raise ValueError(f"simulation_parameters not of the correct type")
 
     if len(cfgs_all) == 0 :
-        N_files = 0
-        return N_files
-
-    db_cfg = utils.get_db_cfg()
-    q = Query()
+        return []
 
-    db_counts  = np.array([db_cfg.count((q.hash == cfg.hash) & (q.network.ID == cfg.network.ID)) for cfg in cfgs_all])
+    db_counts  = np.array(db_cfg.count_cfgs(cfgs_all))
 
     assert np.max(db_counts) <= 1
 
     # keep only cfgs that are not in the database already
     if force_rerun :
-        cfgs = cfgs_all
-    else :
-        cfgs = [cfg for (cfg, count) in zip(cfgs_all, db_counts) if count == 0]
+        return cfgs_all
+    return [cfg for (cfg, count) in zip(cfgs_all, db_counts) if count == 0]
+
+
+def run_simulations(
+        simulation_parameters,
+        N_runs=2,
+        num_cores_max=None,
+        N_tot_max=False,
+        verbose=False,
+        force_rerun=False,
+        dry_run=False,
+        db_batch_size=100,
+        memory_budget=None,
+        queue_dir="Output/queue",
+        async_save=True,
+        **kwargs) :
+    """ Run the simulations of all the cfgs (of simulation_parameters) which are not already in the database.
+        The jobs are run in parallel by the memory-aware scheduler : at most num_cores at a time and such
+        that their estimated peak memory stays below memory_budget (in bytes, default 90% of the node).
+        The memory estimates are calibrated on the measured peaks of earlier runs.
+        The jobs go through the durable job queue in queue_dir, so an interrupted sweep can be
+        continued with resume_simulations.
+        If dry_run, nothing is run and the estimated cost of the simulations is printed (see estimate_simulations).
+        With async_save, a serial run (num_cores = 1) saves the results in the background (see result_writer).
+        The kwargs are passed on to run_single_simulation, e.g. output_level="summary" to only save the time series.
+    """
+
+    db_cfg = utils.get_db_cfg()
+
+    cfgs = _get_cfgs_to_run(db_cfg, simulation_parameters, N_runs, N_tot_max, force_rerun, verbose)
 
     N_files = len(cfgs)
 
-    num_cores = utils.get_num_cores_N_tot(N_tot_max, num_cores_max)
+    # The memory is handled by the scheduler, so use all the cores available
+    num_cores = utils.get_num_cores(num_cores_max)
 
     if isinstance(simulation_parameters, dict) :
         s_simulation_parameters = str(simulation_parameters)
@@ -511,39 +795,121 @@ def run_simulations(
            "Please wait. \n",
            flush=True)
 
+    if dry_run and N_files > 0 :
+        print(cost_model.CostModel.from_past_results(db_cfg).report(cfgs, num_cores), flush=True)
+
     if dry_run or N_files == 0 :
         return N_files
 
     # kwargs = {}
     if num_cores == 1 :
-        for cfg in tqdm(cfgs) :
-            cfg_out = run_single_simulation(cfg, save_initial_network=True, verbose=verbose, **kwargs)
-            update_database(db_cfg, q, cfg_out)
+        with (result_writer.ResultWriter() if async_save else nullcontext()) as writer :
+            # the simulation is only added to the database once its results are saved
+            after_save = partial(_update_database_from_writer, db_cfg.path, overwrite=force_rerun) if writer is not None else None
+            for cfg in tqdm(cfgs) :
+                cfg_out = run_single_simulation(cfg, save_initial_network=True, verbose=verbose, writer=writer, after_save=after_save, **kwargs)
+                if writer is None :
+                    update_database(db_cfg, cfg_out, overwrite=force_rerun)
 
     else :
-        # First generate the networks
-        f_single_network = partial(run_single_simulation, only_initialize_network=True, save_initial_network=True, verbose=verbose, **kwargs)
+        queue = job_queue.JobQueue(queue_dir)
+        queue.add(cfgs, force=force_rerun, run_kwargs=kwargs)
 
-        # Get the network hashes
-        network_hashes = set([utils.cfg_to_hash(cfg.network, exclude_ID=False) for cfg in cfgs])
+        _run_queue(queue, db_cfg, num_cores, memory_budget, db_batch_size, verbose, overwrite=force_rerun, **kwargs)
 
-        # Get list of unique cfgs
-        cfgs_network = []
-        for cfg in cfgs :
-            network_hash = utils.cfg_to_hash(cfg.network, exclude_ID=False)
+    return N_files
 
-            if network_hash in network_hashes :
-                cfgs_network.append(cfg)
-                network_hashes.remove(network_hash)
 
-        # Generate the networks
-        print("Generating networks. Please wait")
-        p_umap(f_single_network, cfgs_network, num_cpus=num_cores)
+def estimate_simulations(simulation_parameters, N_runs=2, num_cores_max=None, N_tot_max=False, force_rerun=False, verbose=False) :
+    """ Estimated cost of the simulations which run_simulations would run, without running anything.
+        The cost models are fitted to the earlier simulations, see cost_model.CostModel.from_past_results.
+        Returns (jobs, total), the estimates of each job and of all of them, see cost_model.CostModel.estimate.
+    """
+    db_cfg = utils.get_db_cfg()
+    cfgs = _get_cfgs_to_run(db_cfg, simulation_parameters, N_runs, N_tot_max, force_rerun, verbose)
+    num_cores = utils.get_num_cores(num_cores_max)
+    model = cost_model.CostModel.from_past_results(db_cfg)
+    if verbose :
+        print(model.report(cfgs, num_cores), flush=True)
+    return model.estimate(cfgs, num_cores)
 
-        # Then run the simulations on the network
-        print("Running simulations. Please wait")
-        f_single_simulation = partial(run_single_simulation, verbose=verbose, **kwargs)
-        for cfg in p_uimap(f_single_simulation, cfgs, num_cpus=num_cores) :
-            update_database(db_cfg, q, cfg)
 
-    return N_files
\ No newline at end of file
+#%%
+
+# Sweeps on several nodes : the coordinator adds the jobs to the queue in a directory shared by all nodes
+# (submit_simulations), any number of workers on any node run them (run_worker) and the coordinator
+# adds the finished jobs to the database (collect_simulations). Only the coordinator writes to the database.
+
+
+def submit_simulations(simulation_parameters, N_runs=2, N_tot_max=False, queue_dir="Output/queue", force_rerun=False, verbose=False, **kwargs) :
+    """ Add the simulations which are not in the database already to the job queue. Returns the number of jobs added.
+        The kwargs (e.g. output_level) are saved in the jobs and passed on to run_single_simulation by the workers
+    """
+    db_cfg = utils.get_db_cfg()
+    cfgs = _get_cfgs_to_run(db_cfg, simulation_parameters, N_runs, N_tot_max, force_rerun, verbose)
+    queue = job_queue.JobQueue(queue_dir)
+    return queue.add(cfgs, force=force_rerun, run_kwargs=kwargs)
+
+
+def collect_simulations(queue, db_cfg=None, overwrite=False) :
+    """ Add the jobs of the queue which finished since the last collection (and their stats) to the database,
+        and mark them as collected. Returns the number of jobs collected (overwrite : see update_database)
+    """
+    if isinstance(queue, (str, Path)) :
+        queue = job_queue.JobQueue(queue)
+    if db_cfg is None :
+        db_cfg = utils.get_db_cfg()
+
+    jobs_done = [job for job in queue.jobs("done") if job.get("stats")]
+    if len(jobs_done) == 0 :
+        return 0
+    _update_database_from_queue(queue, db_cfg, [utils.DotDict(job["cfg"]) for job in jobs_done], [job["stats"] for job in jobs_done], overwrite)
+    return len(jobs_done)
+
+
+def run_worker(queue_dir="Output/queue", poll_interval=30, wait_for_jobs=False, verbose=False, async_save=True, **kwargs) :
+    """ Run jobs from the queue in queue_dir until no jobs are pending (see job_queue.work).
+        Start as many workers on as many nodes as the memory allows, e.g. with sweep_worker.py
+        With async_save, the results of a job are saved in the background while the next job runs (see result_writer).
+        The jobs are run with the kwargs saved in them (see submit_simulations), the kwargs given here only apply where a job does not set them.
+    """
+    queue = job_queue.JobQueue(queue_dir)
+    writer = result_writer.ResultWriter() if async_save else None
+    f_single_simulation = partial(run_single_simulation, save_initial_network=True, return_timings=True, verbose=verbose, writer=writer, **kwargs)
+
+    # compile the numba code before the first job, based on one of the pending jobs
+    jobs = queue.jobs("pending")
+    if len(jobs) > 0 :
+        time_warm_up = warm_up(job_queue.job_to_cfg(jobs[0]))
+        print(f"{job_queue.get_worker_name()} : compiled in {time_warm_up:.1f} s", flush=True)
+
+    with (writer if writer is not None else nullcontext()) :
+        return job_queue.work(queue, f_single_simulation, poll_interval=poll_interval, wait_for_jobs=wait_for_jobs, verbose=verbose, writer=writer)
+
+
+def coordinate_simulations(simulation_parameters, N_runs=2, N_tot_max=False, queue_dir="Output/queue", force_rerun=False, poll_interval=60, verbose=False, **kwargs) :
+    """ Submit the simulations to the queue in queue_dir and collect the results into the database
+        until all jobs are done or failed. The jobs are run by workers started separately (run_worker),
+        with the kwargs (see submit_simulations).
+    """
+    N_added = submit_simulations(simulation_parameters, N_runs, N_tot_max, queue_dir, force_rerun, verbose, **kwargs)
+    queue = job_queue.JobQueue(queue_dir)
+    db_cfg = utils.get_db_cfg()
+    print(f"Added {N_added} jobs to {queue}", flush=True)
+
+    while True :
+        counts = queue.counts()
+        if counts["pending"] == 0 and counts["running"] == 0 :
+            break
+        queue.requeue_stale()
+        collect_simulations(queue, db_cfg, overwrite=force_rerun)
+        print(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} : {counts}", flush=True)
+        time.sleep(poll_interval)
+
+    collect_simulations(queue, db_cfg, overwrite=force_rerun)
+    counts = queue.counts()
+    N_done = counts["collected"]
+    if counts["failed"] > 0 :
+        print(f"{counts['failed']} jobs failed, see the tracebacks in {queue.base_dir / 'failed'}", flush=True)
+
+    return N_done
@@ -0,0 +1,140 @@
+import numpy as np
+from pathlib import Path
+
+from src.utils import utils
+from src import file_loaders
+from src import ensemble_store
+
+pd = utils.lazy_import("pandas")
+pa = utils.lazy_import("pyarrow")
+
+
+#%%
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # Time series store # # # # # # # # # # # # # # #
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# The time series (df) of the simulations as Parquet files (needs pyarrow), in the format of file_loaders.format_df
+# (E and I summed, duplicate times removed), with the hash and network ID of the simulation as extra columns :
+#
+#   Output/timeseries/<hash>/ID__<ID>.parquet     a single simulation (see write_run, Simulation.save(save_parquet=True))
+#   Output/timeseries/<hash>/ensemble.parquet     all the simulations of the hash (see export_ensemble)
+#
+# load_timeseries reads the selected columns of many simulations in a single columnar scan,
+# and only the rows matching the filters (which are pushed down to the Parquet reader).
+
+timeseries_dir = "Output/timeseries"
+compression = "zstd"
+
+
+def run_filename(hash_, ID, base_dir=timeseries_dir) :
+    return str(Path(base_dir) / hash_ / f"ID__{int(ID)}.parquet")
+
+
+def ensemble_filename(hash_, base_dir=timeseries_dir) :
+    return str(Path(base_dir) / hash_ / "ensemble.parquet")
+
+
+def _add_run_columns(df, hash_, ID) :
+    df = df.reset_index(drop=True)
+    df.insert(0, "ID", np.full(len(df), ID, dtype=np.int32))
+    df.insert(0, "hash", hash_)
+    return df
+
+
+def _write_df(df, filename) :
+    import pyarrow.parquet as pq
+    with utils.atomic_write(filename) as filename_tmp :
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), filename_tmp, compression=compression)
+
+
+def write_run(df, hash_, ID, base_dir=timeseries_dir, formatted=False) :
+    """ Save the time series of a single simulation.
+        Parameters :
+            df (DataFrame) : the time series, as from utils.counts_to_df (or file_loaders.format_df if formatted)
+            hash_ (str), ID (int) : the hash and network ID of the simulation
+    """
+    if not formatted :
+        df = file_loaders.format_df(df)
+    filename = run_filename(hash_, ID, base_dir)
+    _write_df(_add_run_columns(df, hash_, ID), filename)
+    return filename
+
+
+def export_ensemble(hash_, base_dir=timeseries_dir, store_dir=ensemble_store.ensemble_dir) :
+    """ Save the time series of all the simulations of hash_ in its ensemble store as a single file,
+        and delete the per-run files of these simulations. Returns the number of simulations.
+    """
+    replicates = ensemble_store.load_replicates(hash_, "df", store_dir)
+    if len(replicates) == 0 :
+        return 0
+
+    dfs = [_add_run_columns(file_loaders.format_df(pd.DataFrame(df_raw)), hash_, ID) for ID, df_raw in replicates.items()]
+    _write_df(pd.concat(dfs, ignore_index=True), ensemble_filename(hash_, base_dir))
+
+    for ID in replicates :
+        utils.delete_file(run_filename(hash_, ID, base_dir))
+    return len(replicates)
+
+
+def export_ensembles(hashes=None, base_dir=timeseries_dir, store_dir=ensemble_store.ensemble_dir, verbose=True) :
+    " export_ensemble for the hashes (default all the ensemble stores), returns the number of simulations "
+    if hashes is None :
+        hashes = sorted(file.stem for file in Path(store_dir).glob("*.hdf5"))
+    if verbose :
+        print(f"Exporting the time series of {len(hashes)} ensembles to {base_dir}", flush=True)
+    return sum(export_ensemble(hash_, base_dir, store_dir) for hash_ in hashes)
+
+
+#%%
+
+
+def get_filenames(hashes=None, base_dir=timeseries_dir) :
+    " The Parquet files of the hashes (default all) "
+    if hashes is None :
+        folders = [folder for folder in Path(base_dir).glob("*") if folder.is_dir()]
+    else :
+        folders = [Path(base_dir) / hash_ for hash_ in hashes]
+    return sorted(str(file) for folder in folders for file in folder.glob("*.parquet"))
+
+
+def _filters_to_expression(filters) :
+    """ A pyarrow expression from a dict {column : value}, where value is either
+        a list (the column is one of the values), a tuple (low, high) (low <= column <= high) or a single value
+    """
+    import pyarrow.dataset as ds
+    expression = None
+    for column, value in filters.items() :
+        field = ds.field(column)
+        if isinstance(value, list) :
+            condition = field.isin(value)
+        elif isinstance(value, tuple) :
+            low, high = value
+            condition = (field >= low) & (field <= high)
+        else :
+            condition = field == value
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def load_timeseries(hashes=None, columns=None, filters=None, base_dir=timeseries_dir) :
+    """ The time series of many simulations in a single columnar scan, as one DataFrame (with the columns hash and ID).
+        Parameters :
+            hashes (list) : only the simulations of these hashes (default all)
+            columns (list) : only these columns (hash and ID are always included)
+            filters (dict or pyarrow expression) : only the rows matching the filters, e.g. {"time" : (0, 50), "ID" : [0, 1]}
+                (see _filters_to_expression)
+    """
+    filenames = get_filenames(hashes, base_dir)
+    if len(filenames) == 0 :
+        return pd.DataFrame(columns=["hash", "ID"] + (list(columns) if columns is not None else []))
+
+    if columns is not None :
+        columns = ["hash", "ID"] + [column for column in columns if column not in ("hash", "ID")]
+    if isinstance(filters, dict) :
+        filters = _filters_to_expression(filters)
+
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(filenames, format="parquet")
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
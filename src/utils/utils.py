@@ -1,6 +1,5 @@
 from numba.core.types.scalars import Float
 import numpy as np
-import pandas as pd
 import multiprocessing as mp
 from pathlib import Path
 import yaml
@@ -11,13 +10,39 @@ from numba.typed import List, Dict
 # import platform #TODO delete line
 import datetime
 import os
-
-import awkward1 as ak
-import dict_hash
+import copy
+import hashlib
+import uuid
+from functools import lru_cache
+from contextlib import contextmanager
+import importlib.util
+import sys
 
 from attrdict import AttrDict
 
-from tinydb import TinyDB, Query
+
+def lazy_import(name) :
+    """ Returns the module name, which is only imported when one of its attributes is first used.
+        Used for the heavy dependencies which are only needed by some of the functions (e.g. pandas, h5py),
+        such that importing the simulation (e.g. in a worker) does not import them.
+        See the import time profile in benchmark_startup.py.
+    """
+    if name in sys.modules :
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None :
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pd = lazy_import("pandas")
+ak = lazy_import("awkward1")
+dict_hash = lazy_import("dict_hash")
 
 
 
@@ -78,6 +103,22 @@ def make_sure_folder_exist(filename, delete_file_if_exists=False) :
         filename.unlink()
 
 
+@contextmanager
+def atomic_write(filename) :
+    """ Yields a temporary filename to write to, which is renamed to filename when the writing is done.
+        This way filename is never half-written, e.g. if the simulation is killed while saving.
+        The temporary filename is unique, also across the nodes sharing a filesystem (where process IDs collide).
+    """
+    make_sure_folder_exist(filename)
+    filename_tmp = f"{filename}.{uuid.uuid4().hex}.tmp"
+    try :
+        yield filename_tmp
+        os.replace(filename_tmp, filename)
+    finally :
+        if os.path.exists(filename_tmp) :
+            os.remove(filename_tmp)
+
+
 def load_yaml(filename) :
     with open(filename) as file :
         tmp = yaml.safe_load(file)
@@ -120,6 +161,124 @@ def haversine_scipy(p1, p2) :
     return haversine(lon1, lat1, lon2, lat2)
 
 
+@njit
+def _grid_index(x, x_min, dx, N) :
+    return min(max(np.int64((x - x_min) / dx), 0), N - 1)
+
+
+@njit
+def _lon_distance_lower_bound(dlon, cos_lat_max) :
+    # hav(d) >= cos(lat1) * cos(lat2) * hav(dlon) >= cos(lat_max)**2 * hav(dlon)
+    if dlon <= 0 :
+        return 0.0
+    return 6367 * 2 * np.arcsin(min(cos_lat_max * np.sin(np.radians(min(dlon, 180.0)) / 2.0), 1.0))
+
+
+@njit
+def assign_to_nearest_facility(coordinates, facility_coordinates) :
+    """ Index of the nearest (haversine) facility for each point in coordinates.
+        Gives the same result as taking the argmin over all facilities for each point,
+        but the facilities are put in a lon/lat grid with roughly one facility per cell,
+        which is searched in rings around the point until no unsearched cell can be closer.
+
+    Parameters :
+        coordinates (array): (N, 2) array of [lon, lat] of the points (e.g. my.coordinates)
+        facility_coordinates (array): (N_facilities, 2) array of [lon, lat] of the facilities
+    """
+
+    N = len(coordinates)
+    N_facilities = len(facility_coordinates)
+    if N_facilities == 0 :
+        raise ValueError("facility_coordinates must contain at least one facility")
+
+    lon_min = min(np.min(coordinates[:, 0]), np.min(facility_coordinates[:, 0]))
+    lon_max = max(np.max(coordinates[:, 0]), np.max(facility_coordinates[:, 0]))
+    lat_min = min(np.min(coordinates[:, 1]), np.min(facility_coordinates[:, 1]))
+    lat_max = max(np.max(coordinates[:, 1]), np.max(facility_coordinates[:, 1]))
+    cos_lat_max = np.cos(np.radians(max(abs(lat_min), abs(lat_max))))
+
+    # square cells (in km) with on average one facility per cell
+    km_per_degree = 6367 * np.pi / 180
+    cos_lat_mean = np.cos(np.radians((lat_min + lat_max) / 2))
+    width = max((lon_max - lon_min) * km_per_degree * cos_lat_mean, 1e-3)
+    height = max((lat_max - lat_min) * km_per_degree, 1e-3)
+    cell_size = np.sqrt(width * height / N_facilities)
+    d_lat = cell_size / km_per_degree
+    d_lon = d_lat / cos_lat_mean
+    N_lon = np.int64((lon_max - lon_min) / d_lon) + 1
+    N_lat = np.int64((lat_max - lat_min) / d_lat) + 1
+
+    # Counting sort of the facilities into the grid cells (CSR layout)
+    cells = np.zeros(N_facilities, dtype=np.int64)
+    cell_offsets = np.zeros(N_lon * N_lat + 1, dtype=np.int64)
+    for i in range(N_facilities) :
+        i_lon = _grid_index(facility_coordinates[i, 0], lon_min, d_lon, N_lon)
+        i_lat = _grid_index(facility_coordinates[i, 1], lat_min, d_lat, N_lat)
+        cells[i] = i_lat * N_lon + i_lon
+        cell_offsets[cells[i] + 1] += 1
+    cell_offsets = np.cumsum(cell_offsets)
+    fill = cell_offsets[:-1].copy()
+    cell_facilities = np.zeros(N_facilities, dtype=np.int64)
+    for i in range(N_facilities) :
+        cell_facilities[fill[cells[i]]] = i
+        fill[cells[i]] += 1
+
+    labels = np.zeros(N, dtype=np.int64)
+    for agent in range(N) :
+        lon = coordinates[agent, 0]
+        lat = coordinates[agent, 1]
+        i_lon = _grid_index(lon, lon_min, d_lon, N_lon)
+        i_lat = _grid_index(lat, lat_min, d_lat, N_lat)
+
+        best_distance = np.inf
+        best = -1
+        r = 0
+        while True :
+            # search the cells exactly r cells away (Chebyshev distance) from the agents cell
+            for j_lat in range(max(i_lat - r, 0), min(i_lat + r, N_lat - 1) + 1) :
+                on_edge = abs(j_lat - i_lat) == r
+                step = 1 if on_edge else 2 * r
+                for j_lon in range(i_lon - r, i_lon + r + 1, max(step, 1)) :
+                    if j_lon < 0 or j_lon >= N_lon :
+                        continue
+                    cell = j_lat * N_lon + j_lon
+                    for k in range(cell_offsets[cell], cell_offsets[cell + 1]) :
+                        facility = cell_facilities[k]
+                        distance = haversine(
+                            lon,
+                            lat,
+                            facility_coordinates[facility, 0],
+                            facility_coordinates[facility, 1],
+                        )
+                        if distance < best_distance or (
+                            distance == best_distance and facility < best
+                        ) :
+                            best_distance = distance
+                            best = facility
+
+            # lower bound on the distance to any facility outside the searched cells
+            lower_bound = np.inf
+            if i_lat - r > 0 :
+                lower_bound = min(lower_bound, np.radians(lat - (lat_min + (i_lat - r) * d_lat)) * 6367)
+            if i_lat + r < N_lat - 1 :
+                lower_bound = min(lower_bound, np.radians(lat_min + (i_lat + r + 1) * d_lat - lat) * 6367)
+            if i_lon - r > 0 :
+                dlon = lon - (lon_min + (i_lon - r) * d_lon)
+                lower_bound = min(lower_bound, _lon_distance_lower_bound(dlon, cos_lat_max))
+            if i_lon + r < N_lon - 1 :
+                dlon = lon_min + (i_lon + r + 1) * d_lon - lon
+                lower_bound = min(lower_bound, _lon_distance_lower_bound(dlon, cos_lat_max))
+
+            # small slack for the floating point precision of haversine
+            if best_distance < lower_bound * (1 - 1e-6) - 1e-6 or lower_bound == np.inf :
+                break
+            r += 1
+
+        labels[agent] = best
+
+    return labels
+
+
 @njit
 def set_numba_random_seed(seed) :
     np.random.seed(seed)
@@ -605,8 +764,8 @@ class NestedArray :
 
     def add_to_hdf5_file(self, f, key) :
         group = f.create_group(key)
-        group.create_dataset("content", data=self.content)
-        group.create_dataset("offsets", data=self.offsets)
+        create_compressed_dataset(group, "content", self.content)
+        create_compressed_dataset(group, "offsets", self.offsets)
 
     @classmethod
     def from_dict(cls, d) :
@@ -690,9 +849,7 @@ class DotDict(AttrDict) :
 
     def dump_to_file(self, filename, exclude=None) :
         if any(substring in filename for substring in ["yaml", "yml"]) :
-            make_sure_folder_exist(filename)
-
-            with open(filename, "w") as yaml_file :
+            with atomic_write(filename) as filename_tmp, open(filename_tmp, "w") as yaml_file :
                 yaml.dump(self.to_dict(exclude="ID"), yaml_file, default_flow_style=False, sort_keys=False)
         else :
             raise AssertionError("This filetype is not yet implemented. Currently only yamls")
@@ -1002,10 +1159,8 @@ def numba_random_choice_list(l) :
 #%%
 
 
-from scipy.special import erf
-
-
 def get_central_confidence_intervals(x, agg_func=np.median, N_sigma=1) :
+    from scipy.special import erf
     agg = agg_func(x)
     sigma = 100 * erf(N_sigma / np.sqrt(2))
     p_lower = 50 - sigma / 2
@@ -1042,9 +1197,7 @@ from range_key_dict import RangeKeyDict  # pip install range-key-dict
 from itertools import product
 from numba import njit
 from numba.typed import List, Dict
-import pandas as pd
 from pathlib import Path
-import matplotlib.pyplot as plt
 import csv
 import numba as nb
 
@@ -1105,6 +1258,9 @@ def format_cfg(cfg, spec) :
         if key == "network" or key == "intervention" :
             continue
 
+        if is_matrix_ref(val) :
+            continue
+
         if isinstance(spec[key], nb.types.Float) :
             cfg[key] = float(val)
         elif isinstance(spec[key], nb.types.Integer) :
@@ -1195,7 +1351,7 @@ def generate_cfgs(d_simulation_parameters, N_runs=1, N_tot_max=False, verbose=Fa
                     if key == "contact_matrices_name" :
                         # TODO : fix the DotDict indexing
                         work_matix, other_matrix, work_other_ratio, _ = load_contact_matrices(scenario = d[key])
-                        cfg["network"].update({"work_matrix" : work_matix, "other_matrix" : other_matrix, "work_other_ratio" : work_other_ratio})
+                        cfg["network"].update({"work_matrix" : add_matrix_to_store(work_matix), "other_matrix" : add_matrix_to_store(other_matrix), "work_other_ratio" : work_other_ratio})
 
 
                 #elif key in spec_intervention.keys() :
@@ -1229,6 +1385,11 @@ def cfg_to_hash(cfg, N=10, exclude_ID=True, exclude_hash=True) :
     d = cfg.copy()
     d = flatten_cfg(d)
 
+    # hash the content of the matrices, not the reference to it
+    for key, val in d.items() :
+        if is_matrix_ref(val) :
+            d[key] = load_matrix(val).tolist()
+
     if exclude_ID and "ID" in d :
         d.pop("ID")
 
@@ -1285,12 +1446,18 @@ def get_num_cores_N_tot(N_tot_max, num_cores_max=None) :
         return num_cores
 
 
+@lru_cache(maxsize=None)
+def _load_GPS_coordinates(coordinates_filename) :
+    # only read once per process, the simulations only use samples of it
+    return pd.read_feather(coordinates_filename)
+
+
 def load_df_coordinates(N_tot, ID) :
     # np.random.seed(ID)
     # coordinates = np.load(coordinates_filename)
     coordinates_filename = "Data/GPS_coordinates.feather"
     df_coordinates = (
-        pd.read_feather(coordinates_filename)
+        _load_GPS_coordinates(coordinates_filename)
         .sample(N_tot, replace=False, random_state=ID)
         .reset_index(drop=True)
     )
@@ -1316,6 +1483,24 @@ def df_coordinates_to_coordinates(df_coordinates) :
     return df_coordinates[["Longitude", "Lattitude"]].values
 
 
+def df_coordinates_to_kommune_labels(df_coordinates) :
+    """ Kommune index of each agent and the (sorted) kommune names the index refers to """
+    labels, kommune_names = pd.factorize(df_coordinates["kommune"], sort=True)
+    return labels, np.asarray(kommune_names)
+
+
+def compute_agents_in_label(labels, N_labels=None) :
+    """ Group the agents by an integer label, e.g. kommune index or grid cell.
+        Returns a NestedArray (CSR layout) where agents_in_label[i] are the agents with label i.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    counts = np.bincount(labels, minlength=0 if N_labels is None else N_labels)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    content = np.argsort(labels, kind="stable").astype(np.uint32)
+    return NestedArray.from_dict({"content" : content, "offsets" : offsets})
+
+
 #%%
 
 
@@ -1441,20 +1626,17 @@ def get_hospitalization_variables(N_tot, N_ages=1) :
 #%%
 
 
-def counts_to_df(time, state_counts, variant_counts, infected_per_age_group) :  #
-#def counts_to_df(time, state_counts, variant_counts) :  #
-
-    time = np.array(time)
-    state_counts = np.array(state_counts)
-    variant_counts = np.array(variant_counts)
-    infected_per_age_group = np.array(infected_per_age_group)
+def counts_to_df(time, counts, N_states, N_variants) :
+    """ The time series of a simulation as a DataFrame, without copying the counts.
+        Parameters :
+            time (array) : the sampled times
+            counts (2D array) : the counts of the states, the variants and the infected per age group (in that order)
+                at each of the sampled times, see nb_simulation.run_simulation
+    """
 
-    N_states     = np.size(state_counts, 1)
-    N_variants   = np.size(variant_counts, 1)
-    N_age_groups = np.size(infected_per_age_group, 1)
+    N_age_groups = counts.shape[1] - N_states - N_variants
 
     header = [
-        "Time",
         "E1", "E2", "E3", "E4",
         "I1", "I2", "I3", "I4",
         "R"]
@@ -1462,24 +1644,9 @@ def counts_to_df(time, state_counts, variant_counts, infected_per_age_group) :
     header.extend(["I^V_" + str(i) for i in range(N_variants)])
     header.extend(["I^A_" + str(i) for i in range(N_age_groups)])
 
-    k_start = 0
-    k_stop  = 1
-    df_time     = pd.DataFrame(time, columns=header[k_start:k_stop])
-
-    k_start = k_stop
-    k_stop  += N_states
-    df_states   = pd.DataFrame(state_counts, columns=header[k_start:k_stop])
-
-    k_start = k_stop
-    k_stop  += N_variants
-    df_variants = pd.DataFrame(variant_counts, columns=header[k_start:k_stop])
-
-    k_start = k_stop
-    k_stop  += N_age_groups
-    df_age_groups = pd.DataFrame(infected_per_age_group, columns=header[k_start:k_stop])
-
-    df = pd.concat([df_time, df_states, df_variants, df_age_groups], axis=1)  # .convert_dtypes()
-    #df = pd.concat([df_time, df_states, df_variants], axis=1)  # .convert_dtypes()
+    # the counts are a single block, so the DataFrame is a view of them
+    df = pd.DataFrame(counts, columns=header, copy=False)
+    df.insert(0, "Time", time)
     return df
 
 
@@ -1554,6 +1721,7 @@ def plot_memory_comsumption(
     min_MemoryDiffRel=0.1,
     time_unit="min",
 ) :
+    import matplotlib.pyplot as plt
 
     colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
     colors = [col for i, col in enumerate(colors) if i != 5]
@@ -1668,10 +1836,23 @@ def path(file) :
     return file
 
 
-def hash_to_filenames(hash_, base_dir="Output/ABM", filetype="hdf5") :
+def hash_to_filenames(hash_, base_dir="Output/ABM", filetype="hdf5", store_dir=None) :
+    """ The result files of hash_ in base_dir. The simulations in the ensemble store of hash_ in store_dir
+        (default the one of the same output folder, e.g. Output/ensembles for Output/ABM) are given as their
+        replicates instead, see ensemble_store.replicate_path
+    """
     folder = path(base_dir) / hash_
     files = list(folder.rglob(f"*.{filetype}"))
-    return [str(file) for file in files]
+    filenames = [str(file) for file in files]
+    if filetype != "hdf5" :
+        return filenames
+
+    from src import ensemble_store
+    if store_dir is None :
+        store_dir = path(base_dir).parent / "ensembles"
+    replicates = ensemble_store.get_replicate_paths(hash_, store_dir)
+    IDs = set(ensemble_store.replicate_path_to_run(replicate)[1] for replicate in replicates)
+    return [filename for filename in filenames if int(re.search(r"_ID__(\d+)\.", filename).group(1)) not in IDs] + replicates
 
 
 def get_1D_scan_cfgs_all_filenames(scan_parameter, non_default_parameters) :
@@ -1684,7 +1865,7 @@ def get_1D_scan_cfgs_all_filenames(scan_parameter, non_default_parameters) :
     parameters.pop(scan_parameter)
 
     db_cfg = get_db_cfg()
-    cfgs = db_cfg.search(dict_to_query(parameters))
+    cfgs = db_cfg.search(parameters)
     cfgs = [DotDict(cfg) for cfg in cfgs]
     all_filenames = [hash_to_filenames(cfg.hash) for cfg in cfgs]
 
@@ -1951,9 +2132,15 @@ def load_contact_matrices(scenario = 'reference') :
     """ Loads and parses the contact matrices corresponding to the chosen scenario.
         The function first determines what the relationship between work activites and other activites are
         After the work_other_ratio has been calculated, the function returns the normalized contact matrices
+        The files are only read once per process.
         Parameters :
             scenario (string) : Name for the scenario to load
     """
+    return copy.deepcopy(_load_contact_matrices(scenario))
+
+
+@lru_cache(maxsize=None)
+def _load_contact_matrices(scenario) :
     # Load the contact matrices
     matrix_work,   _, age_groups_work   = load_age_stratified_file('Data/contact_matrices/' + scenario + '_work.csv')
     matrix_school, _, age_groups_school = load_age_stratified_file('Data/contact_matrices/' + scenario + '_school.csv')
@@ -1973,6 +2160,55 @@ def load_contact_matrices(scenario = 'reference') :
     return (matrix_work.tolist(), matrix_other.tolist(), work_other_ratio, age_groups_work)
 
 
+#%%
+
+# Content-addressed store for the matrices in the cfgs.
+# The cfgs only contain a reference "matrix_store:<content hash>" to the matrix,
+# such that the matrices are not copied into every cfg, database entry and output file.
+
+matrix_store_dir = "Output/matrix_store"
+matrix_ref_prefix = "matrix_store:"
+
+
+def is_matrix_ref(val) :
+    return isinstance(val, str) and val.startswith(matrix_ref_prefix)
+
+
+def add_matrix_to_store(matrix, base_dir=matrix_store_dir) :
+    """ Saves the matrix in the matrix store (if not already there) and returns the reference to it.
+        Parameters :
+            matrix (array or list of lists) : the matrix to store
+    """
+    matrix = np.ascontiguousarray(matrix)
+    content = f"{matrix.dtype.str}{matrix.shape}".encode() + matrix.tobytes()
+    content_hash = hashlib.sha256(content).hexdigest()[:16]
+
+    filename = path(base_dir) / f"{content_hash}.npy"
+    if not filename.exists() :
+        make_sure_folder_exist(filename)
+        # write to a temporary file first, such that other processes never see half a file
+        filename_tmp = path(base_dir) / f"{content_hash}.{uuid.uuid4().hex}.tmp.npy"
+        np.save(filename_tmp, matrix)
+        os.replace(filename_tmp, filename)
+
+    return matrix_ref_prefix + content_hash
+
+
+@lru_cache(maxsize=None)
+def _load_matrix_from_store(content_hash, base_dir) :
+    matrix = np.load(path(base_dir) / f"{content_hash}.npy")
+    matrix.setflags(write=False)
+    return matrix
+
+
+def load_matrix(val, base_dir=matrix_store_dir) :
+    """ Returns the matrix as a numpy array. The matrices in the store are only read once per process.
+        Parameters :
+            val (string or list of lists) : either a reference to the matrix store or the matrix itself
+    """
+    if is_matrix_ref(val) :
+        return _load_matrix_from_store(val[len(matrix_ref_prefix) :], str(base_dir))
+    return np.array(val)
 
 
 
@@ -2001,9 +2237,15 @@ def load_vaccination_schedule(cfg) :
 
 def load_vaccination_schedule_file(scenario = "reference") :
     """ Loads and parses the vaccination schedule file corresponding to the chosen scenario.
+        The files are only read once per process.
         Parameters :
             scenario (string) : Name for the scenario to load
     """
+    return copy.deepcopy(_load_vaccination_schedule_file(scenario))
+
+
+@lru_cache(maxsize=None)
+def _load_vaccination_schedule_file(scenario) :
     # Prepare output files
     vaccine_counts  = []
     schedule        = []
@@ -2078,9 +2320,12 @@ def load_kommune_shapefiles(shapefile_size, verbose=False) :
 
 #%%
 
-from tinydb import Query
+tinydb = lazy_import("tinydb")
 from functools import reduce
 from operator import iand
+import sqlite3
+import json
+import time
 
 
 def multiple_queries(*lst) :
@@ -2098,27 +2343,243 @@ def dict_to_query(d) :
     """
     lst = []
     for key, val in d.items() :
-        lst.append(Query()[key] == val)
+        lst.append(tinydb.Query()[key] == val)
     return multiple_queries(*lst)
 
-def get_db_cfg(path="Output/db.json") :
+def _json_default(obj) :
+    # numpy scalars and arrays
+    if hasattr(obj, "tolist") :
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _cfg_matches(cfg, d) :
+    "Same as dict_to_query(d)(cfg) : all the keys in d have to be in cfg with the same value"
+    for key, val in d.items() :
+        if key not in cfg or cfg[key] != val :
+            return False
+    return True
+
+
+class CfgDatabase :
+    """
+    Database of the simulated cfgs (SQLite).
+
+    Each cfg is stored as JSON together with its hash and network ID, which are indexed,
+    such that lookups on hash (and network ID) do not need to scan the entire database.
+    Cfgs without a network ID are stored with the network ID no_network_ID (-1) rather than NULL,
+    since SQLite does not consider NULLs equal in UNIQUE(hash, network_ID), so they would not be deduplicated.
+    The database is opened in WAL-mode, which allows several processes to read
+    while another one writes.
+
+    Mostly has the same interface as the TinyDB table it replaces :
+    all, search, count, contains, insert, insert_multiple, len and iteration.
+    search, count and contains take either a dict of key-value pairs (like dict_to_query)
+    or a TinyDB query.
+    """
+
+    # the columns of the results catalog besides path, hash, network_ID, kind and filetype :
+    # file size and modification time, key cfg parameters and summary stats of the simulation
+    result_columns = {
+        "size" : "INTEGER",
+        "mtime" : "REAL",
+        "version" : "REAL",
+        "N_tot" : "INTEGER",
+        "day_max" : "INTEGER",
+        "beta" : "REAL",
+        "I_max" : "REAL",
+        "R_inf" : "REAL",
+    }
+
+    no_network_ID = -1
+
+    def __init__(self, path="Output/db.sqlite", timeout=60) :
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn :
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cfg "
+                f"(hash TEXT NOT NULL, network_ID INTEGER NOT NULL DEFAULT {self.no_network_ID}, cfg TEXT NOT NULL, UNIQUE(hash, network_ID))"
+            )
+            # databases from before no_network_ID : keep one of the cfgs without a network ID for each hash
+            self.conn.execute("UPDATE OR IGNORE cfg SET network_ID = ? WHERE network_ID IS NULL", (self.no_network_ID,))
+            self.conn.execute("DELETE FROM cfg WHERE network_ID IS NULL")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cfg_network_ID ON cfg (network_ID)")
+            # measured resource usage of the simulations, e.g. peak memory and time
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_stats "
+                "(hash TEXT NOT NULL, network_ID INTEGER, created REAL, stats TEXT NOT NULL, UNIQUE(hash, network_ID, created))"
+            )
+            # catalog of the result files, see file_loaders.update_catalog
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(path TEXT NOT NULL UNIQUE, hash TEXT NOT NULL, network_ID INTEGER, kind TEXT NOT NULL, filetype TEXT NOT NULL, "
+                + ", ".join(f"{column} {type_}" for column, type_ in self.result_columns.items())
+                + ")"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_results_hash ON results (hash)")
+
+    def _rows_to_cfgs(self, rows) :
+        return [json.loads(row[0]) for row in rows]
+
+    def _get(self, hash_, ID=None) :
+        if ID is None :
+            rows = self.conn.execute("SELECT cfg FROM cfg WHERE hash = ? ORDER BY rowid", (hash_,))
+        else :
+            rows = self.conn.execute(
+                "SELECT cfg FROM cfg WHERE hash = ? AND network_ID = ? ORDER BY rowid", (hash_, int(ID))
+            )
+        return self._rows_to_cfgs(rows)
+
+    def get(self, hash_, ID=None) :
+        "All cfgs with the given hash (and network ID)"
+        return [DotDict(cfg) for cfg in self._get(hash_, ID)]
+
+    def all(self) :
+        return self._rows_to_cfgs(self.conn.execute("SELECT cfg FROM cfg ORDER BY rowid"))
+
+    def search(self, query) :
+        if isinstance(query, dict) :
+            # use the index if possible
+            if "hash" in query :
+                ID = query["network"]["ID"] if "ID" in query.get("network", {}) else None
+                cfgs = self._get(query["hash"], ID)
+            else :
+                cfgs = self.all()
+            return [cfg for cfg in cfgs if _cfg_matches(cfg, query)]
+        return [cfg for cfg in self.all() if query(cfg)]
+
+    def count(self, query) :
+        return len(self.search(query))
+
+    def contains(self, query) :
+        return self.count(query) > 0
+
+    def contains_cfg(self, cfg) :
+        "Whether the cfg (with the same hash and network ID) is in the database"
+        return len(self._get(cfg["hash"], cfg["network"]["ID"])) > 0
+
+    def count_cfgs(self, cfgs) :
+        "Number of times each cfg (same hash and network ID) is in the database (0 or 1)"
+        keys = set(
+            self.conn.execute("SELECT hash, network_ID FROM cfg WHERE network_ID != ?", (self.no_network_ID,))
+        )
+        return [int((cfg["hash"], int(cfg["network"]["ID"])) in keys) for cfg in cfgs]
+
+    def insert(self, cfg) :
+        self.insert_multiple([cfg])
+
+    def insert_multiple(self, cfgs) :
+        "Insert several cfgs in a single transaction. Cfgs already in the database are ignored"
+        rows = []
+        for cfg in cfgs :
+            ID = int(cfg["network"]["ID"]) if "network" in cfg and "ID" in cfg["network"] else self.no_network_ID
+            rows.append((str(cfg["hash"]), ID, json.dumps(cfg, default=_json_default)))
+        with self.conn :
+            self.conn.executemany("INSERT OR IGNORE INTO cfg (hash, network_ID, cfg) VALUES (?, ?, ?)", rows)
+
+    def add_job_stats(self, cfgs, stats) :
+        """ Save the measured stats (dicts) of the simulations of cfgs.
+            Stats with the same "finished" time as already saved ones are ignored.
+        """
+        rows = [
+            (str(cfg["hash"]), int(cfg["network"]["ID"]), stat.get("finished", time.time()), json.dumps(stat, default=_json_default))
+            for cfg, stat in zip(cfgs, stats)
+        ]
+        with self.conn :
+            self.conn.executemany("INSERT OR IGNORE INTO job_stats (hash, network_ID, created, stats) VALUES (?, ?, ?, ?)", rows)
+
+    def get_job_stats(self, N_max=None) :
+        "The stats of the (N_max newest) simulations, as dicts including the hash and network ID"
+        query = "SELECT hash, network_ID, stats FROM job_stats ORDER BY rowid DESC"
+        if N_max is not None :
+            query += f" LIMIT {int(N_max)}"
+        return [{"hash" : hash_, "ID" : ID, **json.loads(stats)} for hash_, ID, stats in self.conn.execute(query)]
+
+    def add_results(self, results) :
+        """ Add (or update) result files in the catalog, results are dicts with the keys
+            path, hash, network_ID, kind, filetype and (optionally) the result_columns
+        """
+        columns = ["path", "hash", "network_ID", "kind", "filetype"] + list(self.result_columns)
+        # the paths are saved relative to the working directory (as in remove_results)
+        results = [{**result, "path" : os.path.relpath(result["path"])} for result in results]
+        rows = [tuple(result.get(column) for column in columns) for result in results]
+        with self.conn :
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows
+            )
+
+    def get_results(self, kind="ABM", filetype="hdf5") :
+        "The result files of the catalog (as dicts), oldest first"
+        cursor = self.conn.execute(
+            "SELECT * FROM results WHERE kind = ? AND filetype = ? ORDER BY mtime", (kind, filetype)
+        )
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def remove_results(self, paths) :
+        "Remove the result files (paths) from the catalog, e.g. when they are deleted. Returns the number of files removed"
+        rows = [(os.path.relpath(path),) for path in paths]
+        with self.conn :
+            cursor = self.conn.executemany("DELETE FROM results WHERE path = ?", rows)
+        return cursor.rowcount
+
+    def count_results(self) :
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def clear_results(self) :
+        with self.conn :
+            self.conn.execute("DELETE FROM results")
+
+    def __len__(self) :
+        return self.conn.execute("SELECT COUNT(*) FROM cfg").fetchone()[0]
+
+    def __iter__(self) :
+        return iter(self.all())
+
+    def close(self) :
+        self.conn.close()
+
+    def __repr__(self) :
+        return f"CfgDatabase(path='{self.path}') with {len(self)} cfgs"
+
+
+def get_db_cfg(path="Output/db.sqlite") :
 
     if not (os.path.dirname(path) == '') and not os.path.exists(os.path.dirname(path)) :
         os.makedirs(os.path.dirname(path))
 
-    db = TinyDB(path, sort_keys=False, indent=4, separators=(",", " : "))
-    db_cfg = db.table("cfg", cache_size=0)
-    return db_cfg
+    return CfgDatabase(path)
+
+
+def migrate_db_json_to_sqlite(json_path="Output/db.json", sqlite_path="Output/db.sqlite", verbose=True) :
+    """ Copy all cfgs from the old TinyDB json database into the SQLite database.
+        Cfgs already in the SQLite database are skipped, so it is safe to run several times.
+    """
+    with open(json_path, "r") as f :
+        cfgs = list(json.load(f).get("cfg", {}).values())
+
+    db_cfg = get_db_cfg(sqlite_path)
+    N_before = len(db_cfg)
+    db_cfg.insert_multiple(cfgs)
+    N_after = len(db_cfg)
+    db_cfg.close()
+
+    if verbose :
+        print(f"Migrated {N_after - N_before} of {len(cfgs)} cfgs from {json_path} to {sqlite_path}")
+    return N_after - N_before
 
 
 def hash_to_cfg(hash_) :
     db_cfg = get_db_cfg()
-    return DotDict(db_cfg.search(Query().hash == hash_)[0])
+    return db_cfg.get(hash_)[0]
 
 
 def query_cfg(cfg) :
     db_cfg = get_db_cfg()
-    cfgs = db_cfg.search(dict_to_query(cfg))
+    cfgs = db_cfg.search(dict(cfg))
     return [DotDict(cfg) for cfg in cfgs]
 
 
@@ -2163,7 +2624,26 @@ def delete_every_file_with_hash(hashes, base_dir="./Output/", verbose=True) :
 
 #%%
 
-import h5py
+h5py = lazy_import("h5py")
+
+# Large datasets are chunked and compressed with the (fast) gzip level 1 and the shuffle filter,
+# which are always available in h5py. See benchmark_hdf5.py
+hdf5_compression_kwargs = dict(compression="gzip", compression_opts=1, shuffle=True)
+
+
+def create_compressed_dataset(f, name, data, chunks=True, min_size=4096) :
+    """ Create the dataset name in f (a hdf5 file or group) with the data chunked and compressed.
+        Small datasets, scalars and strings are saved as they are. Reading is transparent.
+
+    Parameters :
+        chunks (tuple or True) : shape of the chunks, should match how the dataset is read
+            (e.g. (1, N_tot) to read a single day at a time), True lets h5py choose
+        min_size (int) : datasets with fewer elements are not compressed
+    """
+    if not isinstance(data, np.ndarray) or data.size < min_size or data.dtype.kind in "OU" :
+        return f.create_dataset(name, data=data)
+    return f.create_dataset(name, data=data, chunks=chunks, **hdf5_compression_kwargs)
+
 
 def add_cfg_to_hdf5_file(f, cfg) :
 
@@ -2187,12 +2667,18 @@ def add_cfg_to_hdf5_file_recursively(f, cfg, path = 'cfg') :
 
 
 def read_cfg_from_hdf5_file(filename) :
+    " The cfg of a result file, or of a replicate of an ensemble store (<hash>.hdf5::ID__<ID>, see ensemble_store.replicate_path) "
+    filename, _, replicate = str(filename).partition("::")
     with h5py.File(filename, "r") as f :
         cfg = read_cfg_from_hdf5_file_recursively(f)
 
     cfg              = format_cfg(cfg,         nb_simulation.spec_cfg)
     cfg.network      = format_cfg(cfg.network, nb_simulation.spec_network)
 
+    # the cfg of an ensemble store is the one of its first replicate
+    if replicate :
+        cfg.network.ID = int(replicate.split("__")[1])
+
     return cfg
 
 def read_cfg_from_hdf5_file_recursively(f, path='cfg') :
@@ -2233,12 +2719,8 @@ def get_simulation_parameters() :
 
 #%%
 
-from scipy.stats import uniform as sp_uniform
-from scipy.stats import randint
-from sklearn.model_selection import ParameterSampler
-
-
 def uniform(a=0, b=1) :
+    from scipy.stats import uniform as sp_uniform
     loc = a
     scale = b - a
     return sp_uniform(loc, scale)
@@ -2271,6 +2753,8 @@ def _append_remaining_parameters(simulation_parameter, rounded_list) :
 
 
 def get_random_samples(simulation_parameter, random_state=0) :
+    from scipy.stats import randint
+    from sklearn.model_selection import ParameterSampler
     N = simulation_parameter["N_RS"]
     param_grid = {}
     for key, val in simulation_parameter["MCMC"].items() :
@@ -2287,8 +2771,8 @@ def get_random_samples(simulation_parameter, random_state=0) :
     return cfgs
 
 
-from sympy.parsing.sympy_parser import parse_expr
 def load_params(filename) :
+    from sympy.parsing.sympy_parser import parse_expr
     params = load_yaml(filename)
     params = params.to_dict()
 
@@ -0,0 +1,31 @@
+import sys
+from multiprocessing import Process
+from src.simulation import simulation
+
+# Worker for sweeps on several nodes (or several local processes).
+# Start the coordinator with distributed = True in generate_simulations.py, and start workers
+# on every node, in the same (shared) directory, with :
+#
+#   python sweep_worker.py [queue_dir] [number of workers on this node]
+#
+# The workers stop when there are no more pending jobs in the queue. The jobs are run with the arguments
+# saved in them by the coordinator (e.g. output_level), save_csv below only applies if a job does not set it.
+
+queue_dir = "Output/queue"
+N_workers = 1
+verbose = False
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1 :
+        queue_dir = sys.argv[1]
+    if len(sys.argv) > 2 :
+        N_workers = int(sys.argv[2])
+
+    workers = [Process(target=simulation.run_worker, kwargs=dict(queue_dir=queue_dir, verbose=verbose, save_csv=True)) for _ in range(N_workers)]
+    for worker in workers :
+        worker.start()
+    for worker in workers :
+        worker.join()
+
+    print(f"Finished, {N_workers} workers on queue {queue_dir}")
@@ -0,0 +1,42 @@
+import sqlite3
+import pytest
+
+pytest.importorskip("numba")
+
+from src.utils import utils
+
+
+def test_insert_multiple_deduplicates(tmp_path) :
+    db_cfg = utils.get_db_cfg(str(tmp_path / "db.sqlite"))
+    cfgs = [
+        {"hash" : "a", "network" : {"ID" : 0}, "beta" : 0.01},
+        {"hash" : "a", "network" : {"ID" : 1}, "beta" : 0.01},
+        # without a network ID
+        {"hash" : "b", "beta" : 0.02},
+    ]
+
+    db_cfg.insert_multiple(cfgs)
+    db_cfg.insert_multiple(cfgs)
+    db_cfg.insert(cfgs[2])
+
+    assert len(db_cfg) == 3
+    assert len(db_cfg.get("a")) == 2
+    assert len(db_cfg.get("b")) == 1
+    assert db_cfg.count_cfgs([cfgs[0], {"hash" : "a", "network" : {"ID" : 2}}]) == [1, 0]
+    assert db_cfg.contains({"hash" : "a", "network" : {"ID" : 1}})
+
+
+def test_null_network_IDs_are_migrated(tmp_path) :
+    path = str(tmp_path / "db.sqlite")
+
+    # a database from before no_network_ID, with duplicated cfgs without a network ID
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE cfg (hash TEXT NOT NULL, network_ID INTEGER, cfg TEXT NOT NULL, UNIQUE(hash, network_ID))")
+    conn.executemany("INSERT INTO cfg VALUES (?, ?, ?)", [("b", None, '{"hash" : "b"}')] * 3)
+    conn.commit()
+    conn.close()
+
+    db_cfg = utils.get_db_cfg(path)
+    assert len(db_cfg) == 1
+    db_cfg.insert({"hash" : "b"})
+    assert len(db_cfg) == 1
@@ -0,0 +1,95 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+h5py = pytest.importorskip("h5py")
+pytest.importorskip("numba")
+
+from src.utils import utils
+from src import ensemble_store
+
+
+def write_run_files(base_dir, hash_, ID, N_rows=100) :
+    " Fake ABM and network files of the simulation (hash_, ID), returns their filenames "
+    df = np.zeros(N_rows, dtype=[("Time", np.float64), ("I1", np.uint32), ("R", np.uint32)])
+    df["Time"] = np.arange(N_rows) / 10
+    df["I1"] = ID + 1
+
+    filenames = []
+    for name in ["ABM", "network"] :
+        filename = base_dir / name / hash_ / f"{name}_2021-01-01_{hash_}_ID__{ID}.hdf5"
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(filename, "w") as f :
+            f.create_dataset("df", data=df)
+            if name == "network" :
+                f.create_dataset("my_state", data=np.zeros((3, 10), dtype=np.int8))
+            utils.add_cfg_to_hdf5_file(f, {"version" : 2.1, "network" : {"N_tot" : 10, "ID" : ID}})
+        filenames.append(str(filename))
+    return filenames
+
+
+def test_add_replicates_twice_is_idempotent(tmp_path) :
+    store_dir = tmp_path / "ensembles"
+    db_cfg = utils.get_db_cfg(str(tmp_path / "db.sqlite"))
+    write_run_files(tmp_path, "abc", 0)
+    write_run_files(tmp_path, "abc", 1)
+    runs = [("abc", 0), ("abc", 1)]
+
+    # keep the per-run files, such that they can be added again
+    assert ensemble_store.add_replicates(runs, tmp_path, store_dir, delete_run_files=False, db_cfg=db_cfg) == 2
+    filename = ensemble_store.ensemble_filename("abc", store_dir)
+    size = os.path.getsize(filename)
+    replicates = ensemble_store.load_replicates("abc", "df", store_dir)
+
+    # adding the same replicates again neither copies them nor grows the file
+    assert ensemble_store.add_replicates(runs, tmp_path, store_dir, db_cfg=db_cfg) == 0
+    assert os.path.getsize(filename) == size
+    assert ensemble_store.get_replicate_IDs("abc", store_dir) == [0, 1]
+    replicates_again = ensemble_store.load_replicates("abc", "df", store_dir)
+    for ID in replicates :
+        np.testing.assert_array_equal(replicates_again[ID], replicates[ID])
+
+    # unless they are overwritten (e.g. reruns)
+    assert ensemble_store.add_replicates(runs[:1], tmp_path, store_dir, overwrite=True, db_cfg=db_cfg) == 1
+    assert ensemble_store.get_replicate_IDs("abc", store_dir) == [0, 1]
+
+
+def test_deleted_run_files_are_removed_from_the_catalog(tmp_path) :
+    store_dir = tmp_path / "ensembles"
+    db_cfg = utils.get_db_cfg(str(tmp_path / "db.sqlite"))
+    filenames = write_run_files(tmp_path, "abc", 0)
+    db_cfg.add_results([
+        {"path" : filename, "hash" : "abc", "network_ID" : 0, "kind" : kind, "filetype" : "hdf5"}
+        for filename, kind in zip(filenames, ["ABM", "network"])
+    ])
+
+    assert ensemble_store.add_replicates([("abc", 0)], tmp_path, store_dir, delete_run_files=True, db_cfg=db_cfg) == 1
+    assert not any(os.path.exists(filename) for filename in filenames)
+    assert db_cfg.count_results() == 0
+    with h5py.File(ensemble_store.ensemble_filename("abc", store_dir), "r") as f :
+        assert "my_state" in f["replicates/ID__0"]
+
+
+def test_loaders_read_the_replicates_of_the_deleted_run_files(tmp_path) :
+    pytest.importorskip("pandas")
+    from src import file_loaders
+
+    base_dir = tmp_path / "Output"
+    store_dir = base_dir / "ensembles"
+    db_cfg = utils.get_db_cfg(str(base_dir / "db.sqlite"))
+    filenames = write_run_files(base_dir, "abc", 0) + write_run_files(base_dir, "abc", 1)
+    cfgs = [
+        utils.DotDict({"hash" : "abc", "version" : 2.1, "day_max" : 10, "beta" : 0.01, "network" : {"N_tot" : 10, "ID" : ID}})
+        for ID in [0, 1]
+    ]
+
+    # as simulation.update_database : the per-run files are deleted by default, and the catalog lists the replicates
+    assert ensemble_store.add_cfgs(cfgs, base_dir, store_dir, db_cfg=db_cfg) == 2
+    assert not any(os.path.exists(filename) for filename in filenames)
+    assert file_loaders.update_catalog(db_cfg, cfgs, base_dir) == 2
+
+    replicates = [ensemble_store.replicate_path("abc", ID, store_dir) for ID in [0, 1]]
+    assert utils.hash_to_filenames("abc", base_dir / "ABM") == replicates
+    assert sorted(result["path"] for result in db_cfg.get_results("ABM", "hdf5")) == sorted(os.path.relpath(replicate) for replicate in replicates)
+    assert [file_loaders.filename_to_ID(replicate) for replicate in replicates] == [0, 1]
+    assert (file_loaders.pandas_load_file(replicates[1])["I"] == 2).all()
@@ -0,0 +1,55 @@
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("numba")
+
+from src.utils import utils
+from src.simulation import nb_simulation
+
+repo_dir = Path(__file__).resolve().parents[1]
+
+
+def test_choose_initial_agents_from_labels_is_reproducible() :
+    labels = np.random.default_rng(0).integers(0, 5, 1000)
+    agents_in_label = utils.compute_agents_in_label(labels, 5)
+    content = agents_in_label.content.copy()
+    initial_infections_per_label = np.array([3, 0, 10, 1, 400], dtype=np.int64)
+
+    chosen = []
+    for _ in range(2) :
+        nb_simulation.set_numba_random_seed(42)
+        chosen.append(nb_simulation.choose_initial_agents_from_labels(initial_infections_per_label, agents_in_label.offsets, agents_in_label.content))
+
+    np.testing.assert_array_equal(chosen[0], chosen[1])
+    # the (cached) index of the agents is not shuffled
+    np.testing.assert_array_equal(agents_in_label.content, content)
+    # the agents are chosen without replacement and from their own label (at most all the agents of a label)
+    assert len(np.unique(chosen[0])) == len(chosen[0]) == 3 + 10 + 1 + np.sum(labels == 4)
+    assert np.all(np.bincount(labels[chosen[0]], minlength=5) == np.minimum(initial_infections_per_label, np.bincount(labels)))
+
+
+@pytest.mark.skipif(not (repo_dir / "Data" / "GPS_coordinates.feather").exists(), reason="needs Data/GPS_coordinates.feather")
+def test_initialize_states_is_reproducible(monkeypatch) :
+    monkeypatch.chdir(repo_dir)
+    from src.simulation import simulation
+
+    cfg = utils.generate_cfgs({}, N_runs=1)[0]
+    cfg.network.N_tot = 5_000
+    cfg.R_init = 0
+    cfg.hash = utils.cfg_to_hash(cfg)
+
+    def initially_infected(sim) :
+        N_kommuner = len(sim._get_agents_in_kommune())
+        sim.initialize_states(initial_infections_per_label=np.full(N_kommuner, 2))
+        return sorted(int(agent) for agents in sim.agents_in_state for agent in agents)
+
+    sim = simulation.Simulation(cfg)
+    sim.initialize_network(force_rerun=True)
+    infected_first = initially_infected(sim)
+
+    # same seed (the hash of cfg) on the same simulation, whose index of the agents per kommune is cached
+    assert initially_infected(sim) == infected_first
+
+    with pytest.raises(ValueError) :
+        sim.initialize_states(labels=np.zeros(cfg.network.N_tot, dtype=np.int64))
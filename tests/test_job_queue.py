@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip("numba")
+
+from src.simulation import job_queue
+
+
+def make_cfg(hash_, ID=0) :
+    return {"hash" : hash_, "network" : {"ID" : ID}}
+
+
+def test_claim_complete_resume_round_trip(tmp_path) :
+    queue = job_queue.JobQueue(tmp_path / "queue", max_attempts=2, backoff=0)
+
+    assert queue.add([make_cfg("a"), make_cfg("b")], run_kwargs={"output_level" : "summary"}) == 2
+    assert queue.counts()["pending"] == 2
+
+    # two workers claim one job each, a pending job can only be claimed once
+    job_a = queue.claim("worker_1", N_max=1)[0]
+    job_b = queue.claim("worker_2", N_max=1)[0]
+    assert queue.claim("worker_3") == []
+    assert {job_a["id"], job_b["id"]} == {"a_ID__0", "b_ID__0"}
+    assert job_queue.job_to_kwargs(job_a) == {"output_level" : "summary"}
+    assert queue.counts()["running"] == 2
+
+    # job_a finishes, the worker of job_b crashes
+    assert queue.complete(job_a, job_a["cfg"], {"peak_memory" : 1})
+    assert queue.requeue_stale(heartbeat_timeout=0, backoff=False) == 1
+    assert queue.counts() == {"pending" : 1, "running" : 0, "done" : 1, "collected" : 0, "failed" : 0}
+
+    # the resumed job keeps its kwargs and counts the attempts
+    job_b = queue.claim("worker_2")[0]
+    assert job_b["attempts"] == 2
+    assert job_queue.job_to_kwargs(job_b) == {"output_level" : "summary"}
+    assert queue.complete(job_b, stats={"peak_memory" : 2})
+
+    # done jobs are collected once, and not added again unless forced
+    assert queue.mark_collected(queue.job_ids("done")) == 2
+    assert queue.mark_collected(["a_ID__0"]) == 0
+    assert queue.add([make_cfg("a"), make_cfg("b")]) == 0
+    assert queue.add([make_cfg("a")], force=True) == 1
+    assert queue.counts() == {"pending" : 1, "running" : 0, "done" : 0, "collected" : 1, "failed" : 0}
+
+
+def test_failed_jobs_are_retried_until_max_attempts(tmp_path) :
+    queue = job_queue.JobQueue(tmp_path / "queue", max_attempts=2, backoff=0)
+    queue.add([make_cfg("a")])
+
+    job = queue.claim()[0]
+    queue.fail(job, "error 1", backoff=False)
+    assert queue.state_of(job["id"]) == "pending"
+
+    job = queue.claim()[0]
+    queue.fail(job, "error 2", backoff=False)
+    assert queue.state_of(job["id"]) == "failed"
+    assert queue.jobs("failed")[0]["error"] == "error 2"
+
+    # adding a failed job again gives it a fresh set of attempts
+    assert queue.add([make_cfg("a")]) == 1
+    assert queue.claim()[0]["attempts"] == 1
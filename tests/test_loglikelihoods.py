@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+h5py = pytest.importorskip("h5py")
+pytest.importorskip("numba")
+pytest.importorskip("pandas")
+pytest.importorskip("scipy")
+
+from src.utils import utils
+from src import file_loaders
+from src.analysis import helpers
+
+
+def write_ABM_file(filename, N_days, seed) :
+    " Fake ABM file with 10 samples per day (and a duplicated time, which is removed when loading) "
+    rng = np.random.default_rng(seed)
+    N_rows = 10 * N_days + 1
+    columns = ["E1", "E2", "E3", "E4", "I1", "I2", "I3", "I4", "R", "I^V_1"]
+    df = np.zeros(N_rows, dtype=[("Time", np.float64)] + [(column, np.uint32) for column in columns])
+    df["Time"][1:] = np.arange(N_rows - 1) / 10
+    for column in columns :
+        df[column] = rng.integers(50, 500, N_rows)
+    df["I^V_1"] = rng.integers(0, 200, N_rows)
+
+    with h5py.File(filename, "w") as f :
+        f.create_dataset("df", data=df)
+    return str(filename)
+
+
+def test_compute_loglikelihoods_matches_the_per_file_path(tmp_path) :
+    N_tot = [10_000, 20_000]
+    filenames = [
+        write_ABM_file(tmp_path / "ABM_long_ID__0.hdf5", N_days=70, seed=0),
+        # too short for the covid index data, nan in both paths
+        write_ABM_file(tmp_path / "ABM_short_ID__0.hdf5", N_days=20, seed=1),
+    ]
+
+    rng = np.random.default_rng(2)
+    covid_index_data = (rng.normal(1, 0.1, 30), np.full(30, 0.5), 5)
+    fraction_data = (rng.uniform(0, 0.5, 5), np.full(5, 0.1), 1)
+    beta = 0.6
+
+    ll_s, ll_f = helpers.compute_loglikelihoods(filenames, N_tot, covid_index_data, fraction_data, beta)
+
+    for filename, N_tot_file, ll_s_file, ll_f_file in zip(filenames, N_tot, ll_s, ll_f) :
+        cfg = utils.DotDict({"network" : {"N_tot" : N_tot_file}})
+        I_tot_scaled, f = helpers.df_to_infected_and_fraction(file_loaders.pandas_load_file(filename), cfg)
+        expected_s = helpers.compute_loglikelihood(I_tot_scaled, covid_index_data, transformation_function = lambda x : np.log(x) - beta * np.log(80_000))
+        expected_f = helpers.compute_loglikelihood(f, fraction_data)
+
+        np.testing.assert_allclose(ll_s_file, expected_s, rtol=1e-12, equal_nan=True)
+        np.testing.assert_allclose(ll_f_file, expected_f, rtol=1e-12, equal_nan=True)
+
+    assert np.isfinite(ll_s[0]) and np.isnan(ll_s[1])
@@ -0,0 +1,73 @@
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+h5py = pytest.importorskip("h5py")
+for module in ["numba", "pandas", "scipy"] :
+    pytest.importorskip(module)
+
+from src.utils import utils
+from src.analysis import helpers
+
+repo_dir = Path(__file__).resolve().parents[1]
+
+
+@pytest.mark.skipif(not (repo_dir / "Data" / "GPS_coordinates.feather").exists(), reason="needs Data/GPS_coordinates.feather")
+def test_summary_output_gives_the_timeseries_loglikelihoods(tmp_path, monkeypatch) :
+    monkeypatch.chdir(repo_dir)
+    from src.simulation import simulation
+
+    cfg = utils.generate_cfgs({}, N_runs=1)[0]
+    cfg.network.N_tot = 5_000
+    cfg.day_max = 21
+    cfg.hash = utils.cfg_to_hash(cfg)
+
+    filenames = []
+    dfs = {}
+    for output_level in ["summary", "timeseries"] :
+        sim = simulation.Simulation(cfg, output_level=output_level)
+        sim.initialize_network(force_rerun=True)
+        sim.initialize_states()
+        dfs[output_level] = sim.run_simulation()
+
+        # as Simulation._save_dataframe, without the Output folder
+        filename = str(tmp_path / f"ABM_{output_level}.hdf5")
+        with h5py.File(filename, "w") as f :
+            f.create_dataset("df", data=utils.dataframe_to_hdf5_format(sim.df))
+        filenames.append(filename)
+
+    # the summary level samples the time series 10 times per day, as assumed by the analysis
+    assert len(dfs["summary"]) >= 10 * cfg.day_max
+    np.testing.assert_array_equal(dfs["summary"]["Time"].values, dfs["timeseries"]["Time"].values)
+
+    covid_index_data = (np.full(10, 1.0), np.full(10, 0.5), 2)
+    fraction_data = (np.full(2, 0.1), np.full(2, 0.1), 0)
+    ll_s, ll_f = helpers.compute_loglikelihoods(filenames, [cfg.network.N_tot] * 2, covid_index_data, fraction_data, beta=0.6)
+
+    assert not np.any(np.isnan(ll_s)) and not np.any(np.isnan(ll_f))
+    np.testing.assert_array_equal(ll_s[0], ll_s[1])
+    np.testing.assert_array_equal(ll_f[0], ll_f[1])
+
+
+@pytest.mark.skipif(not (repo_dir / "Data" / "GPS_coordinates.feather").exists(), reason="needs Data/GPS_coordinates.feather")
+def test_daily_counts_add_up_to_all_agents(monkeypatch) :
+    monkeypatch.chdir(repo_dir)
+    from src.simulation import simulation
+
+    cfg = utils.generate_cfgs({}, N_runs=1)[0]
+    cfg.network.N_tot = 5_000
+    cfg.day_max = 21
+    cfg.hash = utils.cfg_to_hash(cfg)
+
+    sim = simulation.Simulation(cfg, output_level="timeseries")
+    sim.initialize_network(force_rerun=True)
+    sim.initialize_states()
+    sim.run_simulation()
+
+    # the counts are updated at the state transitions, every agent is in exactly one state, kommune, age group and variant
+    daily_counts = sim.daily_counts.astype(np.int64)
+    assert daily_counts.ndim == 5 and len(daily_counts) > 0
+    assert np.all(daily_counts.sum(axis=(1, 2, 3, 4)) == cfg.network.N_tot)
+    # nobody becomes susceptible again, nor stops being recovered
+    assert np.all(np.diff(daily_counts[:, 0].sum(axis=(1, 2, 3))) <= 0)
+    assert np.all(np.diff(daily_counts[:, -1].sum(axis=(1, 2, 3))) >= 0)
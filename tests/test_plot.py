@@ -0,0 +1,50 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+h5py = pytest.importorskip("h5py")
+for module in ["numba", "pandas", "scipy", "matplotlib", "sklearn", "joblib", "iminuit", "p_tqdm"] :
+    pytest.importorskip(module)
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from src.utils import utils
+from src import plot
+
+
+class FakeABMFiles :
+    " The cfg_to_filenames of ABM_simulations for a single cfg "
+
+    def __init__(self, filenames) :
+        self.filenames = filenames
+
+    def cfg_to_filenames(self, cfg) :
+        return self.filenames
+
+
+def write_ABM_file(filename, N_days) :
+    " Fake ABM file with 10 samples per day where one agent recovers every sample "
+    N_rows = 10 * N_days
+    columns = ["E1", "E2", "E3", "E4", "I1", "I2", "I3", "I4", "R"]
+    df = np.zeros(N_rows, dtype=[("Time", np.float64)] + [(column, np.uint32) for column in columns])
+    df["Time"] = np.arange(N_rows) / 10
+    df["I1"] = 100
+    df["R"] = np.arange(N_rows)
+
+    with h5py.File(filename, "w") as f :
+        f.create_dataset("df", data=df)
+    return str(filename)
+
+
+def test_plot_R_eff_titles_with_the_number_of_files(tmp_path, monkeypatch) :
+    filenames = [write_ABM_file(tmp_path / f"ABM_ID__{ID}.hdf5", N_days=30) for ID in range(3)]
+    cfg = utils.DotDict({"N_tot" : 10_000})
+
+    titles = []
+    monkeypatch.setattr(utils, "dict_to_title", lambda cfg, N=None, **kwargs : titles.append(N) or "title")
+
+    fig, ax = plot.plot_R_eff(cfg, FakeABMFiles(filenames))
+    plt.close(fig)
+
+    assert titles == [len(filenames)]